@@ -3,12 +3,20 @@
 
 import json
 import time
+import uuid
 import urllib
 import threading
 from argparse import Namespace
 import requests
 import testpool.core.exceptions
 
+##
+# Seconds to wait for a reply and times a request is sent again when the
+# reply is lost.
+REQUEST_TIMEOUT = 30
+REQUEST_RETRIES = 3
+##
+
 
 class ResourceError(testpool.core.exceptions.TestpoolError):
     """ Thrown when there isn't enough resources. """
@@ -17,6 +25,29 @@ class ResourceError(testpool.core.exceptions.TestpoolError):
         super(ResourceError, self).__init__(message)
 
 
+def _request(url, params=None, timeout=REQUEST_TIMEOUT,
+             retries=REQUEST_RETRIES):
+    """ GET url, retrying with the same idempotency key.
+
+    A retry after the reply was lost or while the first request is still
+    running gets the reply of the first request, so it runs only once.
+    """
+
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+    for attempt in range(retries + 1):
+        try:
+            resp = requests.get(url, params, headers=headers,
+                                timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            continue
+        if resp.status_code != 409 or attempt == retries:
+            return resp
+        time.sleep(1)
+    return resp
+
+
 def _renew(*args, **kwargs):
     """ Renew resource acquisition. """
     # pylint: disable=unused-argument
@@ -32,18 +63,36 @@ class ResourceHndl(object):
 
     As long as the object exists, the resource acquired will be renewed.
     """
-    def __init__(self, ip_addr, pool_name, expiration=60, blocking=False):
+    # pylint: disable=too-many-instance-attributes
+    # Each option of the acquire request is kept for acquiring again.
+
+    def __init__(self, ip_addr, pool_name, expiration=60, blocking=False,
+                 attrs=None, spread=False, tenant=None, fallback=True,
+                 holder=None):
         """ Acquire a resource given the parameters.
 
         @param expiration The time in seconds.
         @param blocking Wait for resource to be available.
+        @param attrs Dictionary of attributes the resource must have.
+        @param spread Accept a resource from any pool sharing the template.
+        @param tenant Team or pipeline the resource is counted against.
+        @param fallback Accept a resource from the fallback pools of the
+                        pool when it has none READY.
+        @param holder Who the resource is leased to, the server uses the
+                      client address by default. Resources released by
+                      the holder may be handed back to it.
         """
-        # pylint: disable=invalid-name
+        # pylint: disable=invalid-name,too-many-arguments
 
         self.pool_name = pool_name
         self.ip_addr = ip_addr
         self.expiration = expiration
         self.blocking = blocking
+        self.attrs = attrs if attrs else {}
+        self.spread = spread
+        self.tenant = tenant
+        self.fallback = fallback
+        self.holder = holder
         self.vm = None
         self.threading = None
 
@@ -62,13 +111,22 @@ class ResourceHndl(object):
         self.release()
 
         blocking = self.blocking if blocking is None else blocking
-        params = {"expiration": self.expiration}
+        params = {"expiration": self.expiration,
+                  "attr": ["%s:%s" % item for item in self.attrs.items()]}
+        if self.spread:
+            params["spread"] = 1
+        if self.tenant:
+            params["tenant"] = self.tenant
+        if not self.fallback:
+            params["fallback"] = 0
+        if self.holder:
+            params["holder"] = self.holder
         interval = self.expiration/2
 
         while True:
             try:
-                resp = requests.get(self._url_get("acquire"),
-                                    urllib.urlencode(params))
+                resp = _request(self._url_get("acquire"),
+                                urllib.urlencode(params, True))
                 resp.raise_for_status()
                 self.vm = json.loads(resp.text,
                                      object_hook=lambda d: Namespace(**d))
@@ -95,23 +153,28 @@ class ResourceHndl(object):
         self.threading.cancel()
         self.threading = None
 
-        requests.get(self._url_get("release"))
+        _request(self._api_url_get("pool/release/%d" % self.vm.id))
         self.vm = None
 
     def renew(self):
         """ Return usage of the resource. """
 
-        params = {"id": self.vm.id,
-                  "expiration": 100}
-        requests.get(self._url_get("renew"), urllib.urlencode(params))
+        params = {"expiration": self.expiration}
+        _request(self._api_url_get("resource/renew/%d" % self.vm.id),
+                 urllib.urlencode(params))
 
-    def _url_get(self, action):
-        """ Create URL for the given action. """
+    def _api_url_get(self, path):
+        """ Create URL of the REST API path. """
 
         ##
         # This should be a config.
-        url = "http://%s:8000/testpool/api/v1/" % self.ip_addr
-        return url + "pool/%s/%s" % (action, self.pool_name)
+        return "http://%s:8000/testpool/api/v1/%s" % (self.ip_addr, path)
+        ##
+
+    def _url_get(self, action):
+        """ Create URL for the given action. """
+
+        return self._api_url_get("pool/%s/%s" % (action, self.pool_name))
 
     def detail_get(self):
         """ Create URL for the given action. """
@@ -119,3 +182,98 @@ class ResourceHndl(object):
         resp = requests.get(self._url_get("detail"))
         resp.raise_for_status()
         return json.loads(resp.text)
+
+
+def pool_watch(ip_addr, pool_names=None, timeout=None):
+    """ Yield pool counters and resource transitions as they happen.
+
+    Messages are dictionaries, see testpool_pool.stream. The counters of
+    every pool come first.
+    @param pool_names Only report these pools.
+    @param timeout Seconds without any data before giving up, the server
+                   sends a keepalive every 15 seconds.
+    """
+
+    url = "http://%s:8000/testpool/api/v1/pool/stream" % ip_addr
+    params = {"format": "ndjson", "pool": pool_names if pool_names else []}
+    resp = requests.get(url, urllib.urlencode(params, True), stream=True,
+                        timeout=timeout)
+    resp.raise_for_status()
+    try:
+        for line in resp.iter_lines():
+            if line:
+                yield json.loads(line)
+    finally:
+        resp.close()
+
+
+def pool_wait(ip_addr, pool_name, ready, timeout=None):
+    """ Wait until pool_name has at least ready resources READY.
+
+    @return The pool counters.
+    """
+
+    for message in pool_watch(ip_addr, [pool_name], timeout):
+        if message["type"] == "pool" and message["rsrc_ready"] >= ready:
+            return message
+        if message["type"] == "removed":
+            raise ResourceError("pool %s removed" % pool_name)
+    raise ResourceError("pool %s stream ended" % pool_name)
+
+
+def resource_list(ip_addr, **filters):
+    """ Yield every resource matching filters a page at a time.
+
+    Resources are dictionaries in id order.
+    @param filters pool, status, host, name, attr and limit as accepted by
+                   api/v1/resource/list, lists repeat a filter.
+    """
+
+    url = "http://%s:8000/testpool/api/v1/resource/list" % ip_addr
+    params = dict(filters)
+    while True:
+        resp = requests.get(url, urllib.urlencode(params, True))
+        resp.raise_for_status()
+        page = json.loads(resp.text)
+        for rsrc in page["results"]:
+            yield rsrc
+        if page["cursor"] is None:
+            return
+        params["cursor"] = page["cursor"]
+
+
+def pool_book(ip_addr, pool_name, count, start, end, holder=None,
+              tenant=None):
+    """ Book count resources of pool_name over [start, end).
+
+    The resources are leased to holder at start, see booking_get.
+    @param start datetime the resources are handed over.
+    @param end datetime the resources are reclaimed.
+    @return The booking dictionary.
+    """
+    # pylint: disable=too-many-arguments
+    # Each option is a parameter of the booking request.
+
+    url = "http://%s:8000/testpool/api/v1/pool/book/%s" % (ip_addr,
+                                                           pool_name)
+    params = {"count": count, "start": start.isoformat(),
+              "end": end.isoformat()}
+    if holder is not None:
+        params["holder"] = holder
+    if tenant is not None:
+        params["tenant"] = tenant
+    resp = requests.post(url, params=params)
+    if resp.status_code == 409:
+        raise ResourceError(json.loads(resp.text)["msg"])
+    resp.raise_for_status()
+    return json.loads(resp.text)
+
+
+def booking_get(ip_addr, booking_id):
+    """ Return the booking with the resources granted to it. """
+
+    url = "http://%s:8000/testpool/api/v1/booking/detail/%d" % (ip_addr,
+                                                                booking_id)
+    resp = requests.get(url)
+    resp.raise_for_status()
+    return json.loads(resp.text)
@@ -2,11 +2,20 @@
    Algorithm for modifying database.
 """
 import sys
+import datetime
 import logging
 import traceback
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import IntegerField
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
 from testpooldb import models
 import testpool.core.api
 import testpool.core.ext
+import testpool.core.share
 
 
 ACTION_ATTR = "attr"
@@ -15,6 +24,40 @@ ACTION_DESTROY = models.Resource.ACTION_DESTROY
 ACTION_STATUS = "status"
 ACTION_NONE = "none"
 
+##
+# Pool KVP which controls what READY resources do while waiting to be
+# acquired. Frozen spares are paused and resumed when acquired.
+SPARE_KEY = "spare"
+SPARE_RUNNING = "running"
+SPARE_FROZEN = "frozen"
+SPARE_MODES = [SPARE_RUNNING, SPARE_FROZEN]
+
+##
+# Pool KVP which controls whether templates are pulled from the registry
+# before cloning. Offline pools only use images already on the host.
+REGISTRY_KEY = "registry"
+REGISTRY_ONLINE = "online"
+REGISTRY_OFFLINE = "offline"
+REGISTRY_MODES = [REGISTRY_ONLINE, REGISTRY_OFFLINE]
+
+##
+# Resources tried when others reserve them at the same time.
+ACQUIRE_ATTEMPTS = 5
+##
+
+##
+# Pool KVP listing, comma separated and in order, the pools acquire falls
+# back to when the pool has no READY resource.
+FALLBACK_KEY = "fallback"
+##
+
+##
+# Pool KVP holding the seconds a released resource is kept for its holder
+# to acquire again without a rebuild. Absent or 0 rebuilds at once.
+REUSE_KEY = "reuse"
+##
+##
+
 
 class ResourceReleased(Exception):
     """ Resource already relased. """
@@ -53,6 +96,9 @@ def onerror(name):
 def adapt(pool_api, pool):
     """ Adapt the pool to the pool size.
 
+    The size includes resources added for bookings, see
+    Pool.resource_size.
+
     @return Returns the number of changes. Positive number indicates the
             number of resources created.
     """
@@ -64,73 +110,112 @@ def adapt(pool_api, pool):
     # Check the database for the list of existing and pending virtual
     # items.
     current = pool.resource_set.count()
+    size = pool.resource_size()
 
     ##
-    if current == pool.resource_max:
+    if current == size:
         return changes
-    elif current > pool.resource_max:
+    elif current > size:
         key = testpool.core.api.Pool.TIMING_REQUEST_DESTROY
         delta = pool_api.timing_get(key)
         ##
         # Too many resources we need to remove one.
-        how_many = current - pool.resource_max
+        how_many = current - size
         for rsrc in pool.resource_set.reverse():
             if rsrc.status in [models.Resource.READY, models.Resource.PENDING]:
-                rsrc.transition(models.Resource.PENDING, ACTION_DESTROY, delta)
+                try:
+                    rsrc.transition(models.Resource.PENDING, ACTION_DESTROY,
+                                    delta)
+                except models.Resource.Conflict:
+                    ##
+                    # Acquired meanwhile, it is reclaimed once released.
+                    continue
+                    ##
                 how_many -= 1
 
             if how_many <= 0:
                 break
     else:
-        missing = pool.resource_max - current
+        missing = size - current
         logging.debug("%s: adapt too few make %d more", pool.name, missing)
-        ##
-        # There are not enough resources. Try to reuse the range of
-        # names from 0 to resource_max. Start at 0 and walk up the range
-        # looking for free slots.
-        for count in range(pool.resource_max):
-            name = pool_api.new_name_get(pool.template_name, count)
-            logging.info("%s checking", name)
-            (rsrc, action) = models.Resource.objects.get_or_create(pool=pool,
-                                                                   name=name)
-
-            if not action:
-                # This is an existing resource. Keep looking
-                continue
-
-            state = pool_api.state_get(name)
-            logging.debug("%s status %s", name, state)
-
-            # If action is true then the database entry was just created.
-            # If state == STATE_NONE then this name does not exist.
-            if state == testpool.core.api.Pool.STATE_NONE:
-                # This is a new database entry and the resource does
-                # not exist. Clone this.
-                logging.debug("%s expanding pool resource with %s ", pool.name,
-                              name)
-                key = testpool.core.api.Pool.TIMING_REQUEST_CLONE
-                delta = pool_api.timing_get(key)
-                rsrc.transition(models.Resource.PENDING, ACTION_CLONE, delta)
-                changes += 1
-                missing -= 1
-            else:
-                logging.warning("%s: lost track of resource %s reclaiming",
-                                pool.name, rsrc.name)
-                ##
-                # Need to destroy the resource because we do not know its
-                # real state.
-                key = testpool.core.api.Pool.TIMING_REQUEST_DESTROY
-                delta = pool_api.timing_get(key)
-                rsrc.transition(models.Resource.PENDING, ACTION_DESTROY, delta)
-                ##
-                changes += 1
-                missing -= 1
-
-            if missing == 0:
-                break
+        changes = _grow(pool_api, pool, missing)
     return changes
 
 
+def _free_get(pool_api, pool, missing):
+    """ Return up to missing (slot, name) of the lowest free slots.
+
+    One query reads the slots in use.
+    """
+
+    ##
+    # Names are checked too since rows from before slots existed may not
+    # have one.
+    used = list(pool.resource_set.values_list("slot", "name"))
+    slots = set(item[0] for item in used)
+    names = set(item[1] for item in used)
+    ##
+
+    free = []
+    for slot in range(pool.resource_size()):
+        if len(free) == missing:
+            break
+        name = pool_api.new_name_get(pool.template_name, slot)
+        if slot not in slots and name not in names:
+            free.append((slot, name))
+    return free
+
+
+def _grow(pool_api, pool, missing):
+    """ Add missing resources in the lowest free slots.
+
+    Free slots come from one query, the driver states of their names from
+    one states_get and the rows from one insert.
+    @return The number of resources added.
+    """
+
+    free = _free_get(pool_api, pool, missing)
+    if not free:
+        return 0
+
+    states = pool_api.states_get([name for (_, name) in free])
+
+    current = datetime.datetime.now()
+    rsrcs = []
+    for (slot, name) in free:
+        if states[name] == testpool.core.api.Pool.STATE_NONE:
+            logging.debug("%s expanding pool resource with %s ", pool.name,
+                          name)
+            key = testpool.core.api.Pool.TIMING_REQUEST_CLONE
+            action = ACTION_CLONE
+        else:
+            ##
+            # Need to destroy the resource because we do not know its
+            # real state.
+            logging.warning("%s: lost track of resource %s reclaiming",
+                            pool.name, name)
+            key = testpool.core.api.Pool.TIMING_REQUEST_DESTROY
+            action = ACTION_DESTROY
+            ##
+        delta = datetime.timedelta(seconds=pool_api.timing_get(key))
+        rsrcs.append(models.Resource(
+            pool=pool, name=name, slot=slot, status=models.Resource.PENDING,
+            action=action, action_time=current + delta, status_time=current))
+
+    try:
+        with transaction.atomic():
+            models.Resource.objects.bulk_create(rsrcs)
+            models.Generation.bump()
+    except IntegrityError:
+        ##
+        # Another process added resources meanwhile, the next pass looks
+        # again.
+        logging.info("%s: adapt raced, retrying later", pool.name)
+        return 0
+        ##
+    return len(rsrcs)
+
+
 def clone(pool_api, rsrc):
     """ Clone a resource. """
 
@@ -151,13 +236,17 @@ def clone(pool_api, rsrc):
 
 
 def attr(pool_api, rsrc):
-    """ Retrieve resource attributes. """
+    """ Store the resource IP address and attributes.
+
+    @return The IP address or None if the resource does not have one yet.
+    """
 
     rsrc.ip_addr = pool_api.ip_get(rsrc.name)
-    for (key, value) in pool_api.resource_attr_get(rsrc.name).iteritems():
-        (kvp, _) = models.KVP.get_or_create(key, value)
-        models.ResourceKVP.objects.create(resource=rsrc, kvp=kvp)
-        rsrc.transition(models.Resource.READY, ACTION_STATUS, 10*60)
+    if not rsrc.ip_addr:
+        return None
+    rsrc.save(update_fields=["ip_addr"])
+    rsrc.kvps_set(pool_api.resource_attr_get(rsrc.name))
+    return rsrc.ip_addr
 
 
 def destroy(pool_api, pool):
@@ -178,6 +267,271 @@ def destroy(pool_api, pool):
             pass
 
 
+def attrs_parse(values):
+    """ Return [(key, value)] given constraints of the form key:value. """
+
+    attrs = []
+    for item in values:
+        (key, sep, value) = item.partition(":")
+        if not sep or not key:
+            raise ValueError("attr %s must be key:value" % item)
+        attrs.append((key, value))
+    return attrs
+
+
+def fallbacks_get(pool1):
+    """ Return the fallback pools of pool1 in order.
+
+    Pools that do not exist are skipped. Fallbacks of the fallback pools
+    are not followed.
+    """
+
+    names = []
+    for name in pool1.kvp_value_get(FALLBACK_KEY, "").split(","):
+        name = name.strip()
+        if name and name != pool1.name and name not in names:
+            names.append(name)
+    if not names:
+        return []
+
+    pools = dict((item.name, item)
+                 for item in models.Pool.objects.filter(name__in=names))
+    return [pools[name] for name in names if name in pools]
+
+
+def fallbacks_set(pool1, names):
+    """ Make acquire fall back to the pools names in order. """
+
+    pool1.kvp_value_set(FALLBACK_KEY, ",".join(names))
+
+
+def candidates(pool1, attrs=None, spread=False, fallbacks=None):
+    """ Return READY resources of pool1 that have every attribute in attrs.
+
+    @param attrs List of (key, value) the resource must have.
+    @param spread Include every pool sharing the template of pool1.
+    @param fallbacks Include these pools, see fallbacks_get. Resources of
+                     pool1 come first, then those of each fallback in
+                     order. Ignored with spread.
+    The least recently readied resource comes first.
+    """
+
+    order = ["status_time"]
+    if spread:
+        rsrcs = models.Resource.objects.filter(
+            pool__template_name=pool1.template_name)
+    elif fallbacks:
+        pools = [pool1] + list(fallbacks)
+        rsrcs = models.Resource.objects.filter(pool__in=pools)
+        ##
+        # One query ranks the whole chain.
+        rsrcs = rsrcs.annotate(rank=Case(
+            *[When(pool_id=item.id, then=Value(index))
+              for (index, item) in enumerate(pools)],
+            output_field=IntegerField()))
+        order = ["rank"] + order
+        ##
+    else:
+        rsrcs = pool1.resource_set.all()
+    rsrcs = rsrcs.filter(status=models.Resource.READY)
+
+    if attrs:
+        kvps = models.KVP_CACHE.kvps_get(attrs, create=False)
+        if len(kvps) < len(set(attrs)):
+            return rsrcs.none()
+        ##
+        # One join on ResourceKVP per attribute each searching the
+        # (kvp, resource) index.
+        for kvp in kvps.values():
+            rsrcs = rsrcs.filter(kvps=kvp)
+        ##
+    ##
+    # The pool is read along with the resource, acquire needs its KVPs.
+    return rsrcs.select_related("pool").order_by(*order)
+    ##
+
+
+def spill_count(pool1, rsrc):
+    """ Count rsrc against pool1 when a fallback pool provided it. """
+
+    if rsrc.pool_id != pool1.id:
+        logging.info("%s: acquire served by fallback %s", pool1.name,
+                     rsrc.pool.name)
+        models.PoolSpill.add(pool1.name, rsrc.pool.name)
+
+
+def prewarm_kept(pool1):
+    """ Return the READY resources of pool1 kept for bookings to start. """
+
+    ##
+    # Pool.resource_booked counts PREWARM bookings, most pools have none.
+    if not pool1.resource_booked:
+        return 0
+    ##
+    return models.Booking.objects.filter(
+        pool_id=pool1.id, status=models.Booking.PREWARM).aggregate(
+            total=Sum("count"))["total"] or 0
+
+
+def _reserve(rsrc, expiration_seconds, holder, tenant):
+    """ Reserve rsrc and lease it to holder of tenant.
+
+    When the pool shares its resources between tenants, the tenant is
+    admitted in the same transaction. The pool is locked the same way
+    while bookings about to start keep some of its READY resources.
+    @return False when every READY resource of the pool is kept.
+    """
+
+    shares = testpool.core.share.shares_get(rsrc.pool)
+    kept = prewarm_kept(rsrc.pool)
+    if not shares and not kept:
+        rsrc.transition(models.Resource.RESERVED, ACTION_DESTROY,
+                        expiration_seconds)
+        models.Lease.grant(rsrc, holder, expiration_seconds, tenant)
+        return True
+
+    with transaction.atomic():
+        if shares:
+            testpool.core.share.admit(rsrc.pool, shares, tenant)
+        else:
+            testpool.core.share.lock(rsrc.pool)
+        if kept and rsrc.pool.resource_set.filter(
+                status=models.Resource.READY).count() <= kept:
+            logging.info("%s: %d READY resources kept for bookings",
+                         rsrc.pool.name, kept)
+            return False
+        rsrc.transition(models.Resource.RESERVED, ACTION_DESTROY,
+                        expiration_seconds)
+        models.Lease.grant(rsrc, holder, expiration_seconds, tenant)
+    return True
+
+
+def acquire(rsrcs, expiration_seconds, holder="",
+            attempts=ACQUIRE_ATTEMPTS, tenant="", pool1=None):
+    """ Reserve the first of rsrcs not reserved by someone else first.
+
+    The reservation is leased to holder of tenant.
+    @param pool1 The pool acquired from, KVPs it already read are reused
+                 for its resources.
+    Pools whose READY resources are kept for bookings or which tenant may
+    not acquire from are passed over.
+    @return The Resource or None when rsrcs is empty.
+    @raise Resource.Conflict when every attempt lost to another process.
+    @raise OverShare when tenant may not acquire from any of the pools.
+    @raise Busy when other requests held the pool too long.
+    """
+    # pylint: disable=R0913
+    # Each option is a parameter of the acquire request.
+
+    tried = []
+    refused = ""
+    while len(tried) < attempts:
+        rsrc = rsrcs.exclude(id__in=tried).first()
+        if rsrc is None and refused:
+            raise testpool.core.share.OverShare(refused)
+        if rsrc is None:
+            return None
+        if pool1 is not None and rsrc.pool_id == pool1.id:
+            rsrc.pool = pool1
+        try:
+            if _reserve(rsrc, expiration_seconds, holder, tenant):
+                return rsrc
+            rsrcs = rsrcs.exclude(pool_id=rsrc.pool_id)
+        except testpool.core.share.OverShare as arg:
+            refused = str(arg)
+            rsrcs = rsrcs.exclude(pool_id=rsrc.pool_id)
+        except models.Resource.Conflict:
+            tried.append(rsrc.id)
+    raise models.Resource.Conflict("%d resources taken meanwhile" % attempts)
+
+
+def reuse_grace(pool1):
+    """ Return the seconds released resources of pool1 are kept. """
+
+    value = pool1.kvp_value_get(REUSE_KEY, "0")
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        logging.error("%s: %s %s must be a number", pool1.name, REUSE_KEY,
+                      value)
+        return 0
+
+
+def reuse_set(pool1, grace_seconds):
+    """ Keep released resources of pool1 for grace_seconds, 0 disables. """
+
+    pool1.kvp_value_set(REUSE_KEY, str(grace_seconds))
+
+
+def release(rsrc):
+    """ Release rsrc.
+
+    When its pool keeps released resources the lease is parked for the
+    holder and the resource stays RESERVED until the grace period ends.
+    Otherwise, or when the lease already expired, the resource is
+    destroyed and rebuilt.
+    @return False if rsrc is no longer reserved.
+    """
+
+    grace = reuse_grace(rsrc.pool)
+    if grace and rsrc.status == models.Resource.RESERVED and \
+       models.Lease.park(rsrc.id, grace):
+        ##
+        # The daemon reclaims it once the grace period ends unless the
+        # holder acquires it again first.
+        rsrc.transition_from((models.Resource.RESERVED,),
+                             models.Resource.RESERVED, ACTION_DESTROY, grace)
+        return True
+        ##
+    return rsrc.transition_from((models.Resource.RESERVED,),
+                                models.Resource.PENDING, ACTION_DESTROY, 1)
+
+
+def reuse(pool1, holder, attrs, expiration_seconds, tenant=""):
+    """ Lease a resource holder of tenant released within the grace period.
+
+    Parked resources do not count against the share of tenant so it is
+    admitted again as acquire does.
+    @param attrs List of (key, value) the resource must have.
+    @return The Resource or None when holder has none to reuse or tenant
+            may not acquire from the pool now.
+    """
+
+    current = datetime.datetime.now()
+    rsrcs = pool1.resource_set.filter(
+        status=models.Resource.RESERVED, lease__holder=holder,
+        lease__tenant=tenant, lease__released=True,
+        lease__expiry__gt=current)
+    if attrs:
+        kvps = models.KVP_CACHE.kvps_get(attrs, create=False)
+        if len(kvps) < len(set(attrs)):
+            return None
+        for kvp in kvps.values():
+            rsrcs = rsrcs.filter(kvps=kvp)
+
+    ##
+    # Unparking the lease decides the race with the daemon reclaiming the
+    # resource.
+    shares = testpool.core.share.shares_get(pool1)
+    for rsrc in rsrcs.order_by("-action_time")[:ACQUIRE_ATTEMPTS]:
+        rsrc.pool = pool1
+        try:
+            with transaction.atomic():
+                if shares:
+                    testpool.core.share.admit(pool1, shares, tenant)
+                if not models.Lease.unpark(rsrc.id, expiration_seconds):
+                    continue
+                if rsrc.transition_from((models.Resource.RESERVED,),
+                                        models.Resource.RESERVED,
+                                        ACTION_DESTROY, expiration_seconds):
+                    return rsrc
+        except testpool.core.share.OverShare as arg:
+            logging.info("%s: %s", pool1.name, arg)
+            return None
+    ##
+    return None
+
+
 def pop(pool_name, expiration_seconds):
     """ Pop one resource from the Pool. """
 
@@ -187,15 +541,9 @@ def pop(pool_name, expiration_seconds):
     rsrcs = models.Resource.objects.filter(pool=pool1,
                                            status=models.Resource.PENDING)
 
-    if rsrcs.count() == 0:
+    rsrc = acquire(rsrcs, expiration_seconds)
+    if rsrc is None:
         raise NoResources("%s: all resources taken" % pool_name)
-
-    rsrc = rsrcs[0]
-    rsrc.transition(models.Resource.RESERVED, ACTION_DESTROY,
-                    expiration_seconds)
-    rsrc.status = models.Resource.RESERVED
-    rsrc.save()
-
     return rsrc
 
 
@@ -206,11 +554,13 @@ def push(rsrc_id):
     try:
         rsrc = models.Resource.objects.get(id=rsrc_id,
                                            status=models.Resource.RESERVED)
-        rsrc.release()
-        return 0
     except models.Resource.DoesNotExist:
         raise ResourceReleased(rsrc_id)
 
+    if not rsrc.release():
+        raise ResourceReleased(rsrc_id)
+    return 0
+
 
 def resource_clone(pool, rsrc):
     """ Reclaim a resource and rebuild it. """
@@ -229,6 +579,20 @@ def resource_destroy(pool, rsrc):
     name = rsrc.name
     logging.debug("%s removing resource %s", rsrc.pool.name, name)
 
+    ##
+    # A renewed lease moves the reservation expiry out. Otherwise claim the
+    # expired reservation first so that a release which wins the race
+    # keeps the resource.
+    if rsrc.status == models.Resource.RESERVED:
+        lease = models.Lease.objects.filter(
+            resource=rsrc, expiry__gt=datetime.datetime.now()).first()
+        if lease:
+            delta = lease.expiry - datetime.datetime.now()
+            rsrc.transition(rsrc.status, rsrc.action, delta.total_seconds())
+            return
+        rsrc.transition(models.Resource.PENDING, ACTION_DESTROY, 0)
+    ##
+
     state = pool.state_get(name)
     if state == testpool.core.api.Pool.STATE_NONE:
         ##
@@ -244,17 +608,89 @@ def resource_destroy(pool, rsrc):
         ##
 
 
-def pool_add(connection, product, pool, resource_max, template):
-    """ Add a pool. """
+def lease_sweep():
+    """ Reclaim resources whose lease expired.
+
+    A lease renewed meanwhile is kept. Return the number reclaimed.
+    """
+
+    current = datetime.datetime.now()
+    count = 0
+    expired = models.Lease.objects.filter(expiry__lte=current)
+    for lease in expired.select_related("resource__pool"):
+        ##
+        # Deleting the expired lease decides the race with a renew.
+        if not models.Lease.objects.filter(resource_id=lease.resource_id,
+                                           expiry__lte=current).delete()[0]:
+            continue
+        ##
+        rsrc = lease.resource
+        logging.info("%s: lease of %s expired", rsrc.pool.name, rsrc.name)
+        try:
+            if rsrc.transition_from((models.Resource.RESERVED,),
+                                    models.Resource.PENDING, ACTION_DESTROY,
+                                    0):
+                count += 1
+        except models.Resource.Conflict:
+            logging.info("%s: %s changed, reclaimed later", rsrc.pool.name,
+                         rsrc.name)
+    return count
+
+
+def spare_frozen(pool1):
+    """ Return True if READY resources of pool1 are frozen. """
+
+    return pool1.kvp_value_get(SPARE_KEY, SPARE_RUNNING) == SPARE_FROZEN
+
+
+def spare_thaw(pool1, rsrc):
+    """ Resume a frozen resource that has been acquired. """
+
+    if not spare_frozen(pool1):
+        return
+    exts = testpool.core.ext.api_ext_list()
+    pool = exts[pool1.host.product].pool_get(pool1)
+    pool.spare_thaw(rsrc.name)
+
+
+def registry_offline(pool1):
+    """ Return True if pool1 never pulls its template from the registry. """
+
+    return pool1.kvp_value_get(REGISTRY_KEY,
+                               REGISTRY_ONLINE) == REGISTRY_OFFLINE
+
+
+def pool_add(connection, product, pool, resource_max, template, spare=None,
+             registry=None):
+    """ Add a pool.
+
+    @param spare Either SPARE_RUNNING or SPARE_FROZEN, None keeps the
+                 current setting.
+    @param registry Either REGISTRY_ONLINE or REGISTRY_OFFLINE, None keeps
+                    the current setting.
+    """
+    # pylint: disable=R0913
+    # Each option is a parameter of tpl pool add, the pool KVPs must be set
+    # before adapt reads them.
 
     logging.debug("pool_add %s %s", pool, template)
+    if spare is not None and spare not in SPARE_MODES:
+        raise ValueError("spare %s unknown" % spare)
+    if registry is not None and registry not in REGISTRY_MODES:
+        raise ValueError("registry %s unknown" % registry)
+
     (host1, _) = models.Host.objects.get_or_create(connection=connection,
                                                    product=product)
     defaults = {"resource_max": resource_max, "template_name": template}
     (pool1, _) = models.Pool.objects.update_or_create(name=pool, host=host1,
                                                       defaults=defaults)
+    if spare is not None:
+        pool1.kvp_value_set(SPARE_KEY, spare)
+    if registry is not None:
+        pool1.kvp_value_set(REGISTRY_KEY, registry)
     ##
-    # Check to see if the number of Resources should change.
+    # Check to see if the number of Resources should change. The daemon
+    # prefetches the template, this process may exit before it is pulled.
     exts = testpool.core.ext.api_ext_list()
     pool = exts[product].pool_get(pool1)
     adapt(pool, pool1)
@@ -272,15 +708,19 @@ def pool_remove(name, immediate):
     pool = models.Pool.objects.get(name=name)
     logging.debug("found pool %s", pool)
     pool.resource_max = 0
+    pool.resource_booked = 0
     pool.save()
+    pool.booking_set.filter(status__in=models.Booking.ACTIVE).update(
+        status=models.Booking.CANCELLED)
 
     next_delta = 0
     for rsrc in pool.resource_set.all():
         if immediate:
             rsrc.delete()
         else:
-            rsrc.transition(models.Resource.RESERVED, ACTION_DESTROY,
-                            next_delta)
+            rsrc.transition_from(models.Resource.STATUSES,
+                                 models.Resource.RESERVED, ACTION_DESTROY,
+                                 next_delta)
             next_delta += 60
 
     if immediate:
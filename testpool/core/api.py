@@ -40,11 +40,15 @@ class Pool(object):
     STATE_DESTROYED = 4
     """ resource has been destroyed. """
 
+    STATE_FROZEN = 5
+    """ Resource is running but frozen, it holds no CPU. """
+
     STATE_STRING = {
         STATE_RUNNING: "running",
         STATE_NONE: "none",
         STATE_BAD_STATE: "badstate",
-        STATE_DESTROYED: "destroyed"
+        STATE_DESTROYED: "destroyed",
+        STATE_FROZEN: "frozen"
     }
 
     def __init__(self, context):
@@ -63,6 +67,13 @@ class Pool(object):
         """ Return the pool type. """
         raise NotImplementedError(NOT_IMPL % "type_get")
 
+    def prefetch(self, template_name):
+        """ Prepare template_name ahead of cloning.
+
+        Optional, by default nothing is done.
+        """
+        pass
+
     def clone(self, orig_name, new_name):
         """ Clone orig_name to new_name. """
         raise NotImplementedError(NOT_IMPL % "clone")
@@ -75,6 +86,27 @@ class Pool(object):
         """ Return the current name. """
         raise NotImplementedError(NOT_IMPL % "state_get")
 
+    def states_get(self, names):
+        """ Return the state of each of names keyed by name.
+
+        Optional, by default state_get is called for each name.
+        """
+        return dict((name, self.state_get(name)) for name in names)
+
+    def spare_freeze(self, name):
+        """ Called when resource name is READY and waits to be acquired.
+
+        Optional, by default the resource keeps running.
+        """
+        pass
+
+    def spare_thaw(self, name):
+        """ Called when resource name is acquired.
+
+        Undo spare_freeze. Optional, by default nothing is done.
+        """
+        pass
+
     def is_clone(self, pool1, name):
         """ Return True if resource is a clone for the pool1. """
 
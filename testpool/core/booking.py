@@ -0,0 +1,329 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Advance reservations of pool resources.
+
+A booking sets count resources of a pool aside for a holder over the
+window [start, end). Bookings of a pool may overlap as long as no more
+than its booking limit are booked at any instant. The limit is the pool
+KVP booking.max and defaults to resource_max.
+
+Booked resources are added on top of resource_max. Calendar.tick moves
+each booking through:
+
+  BOOKED   - waiting for its window.
+  PREWARM  - start is within the clone lead of the pool.
+             Pool.resource_booked counts the booking so algo.adapt clones
+             its resources ahead of start. Acquires leave count READY
+             resources of the pool for it.
+  GRANTED  - start has passed and count READY resources were leased to the
+             holder until end, all of them in one transaction.
+  ENDED    - end has passed. The leases expire and adapt shrinks the pool.
+
+The clone lead is the p99 clone time of the pool over the past
+LEAD_HISTORY plus LEAD_MARGIN, or LEAD_DEFAULT while the pool has no
+history.
+"""
+import datetime
+import logging
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Sum
+from testpooldb import models
+from testpool.core import algo
+from testpool.core import coding
+from testpool.core import exceptions
+from testpool.core import history
+from testpool.core import share
+
+BOOKING_MAX_KEY = "booking.max"
+
+##
+# Seconds of clone lead, see the module description.
+LEAD_DEFAULT = 600
+LEAD_MARGIN = 60
+LEAD_HISTORY = datetime.timedelta(days=1)
+LEAD_REFRESH = datetime.timedelta(minutes=5)
+##
+
+##
+# Bookings starting later than this are not checked for prewarm. It covers
+# the longest clone time rollups can report.
+HORIZON = datetime.timedelta(seconds=models.PoolRollup.BUCKETS[-1] +
+                             LEAD_MARGIN)
+##
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BookingConflict(Exception):
+    """ The pool is fully booked for part of the window. """
+
+
+def limit_get(pool1):
+    """ Return the most resources of pool1 booked at once. """
+
+    value = pool1.kvp_value_get(BOOKING_MAX_KEY, None)
+    if value is None:
+        return pool1.resource_max
+    try:
+        return int(value)
+    except ValueError:
+        LOGGER.error("%s: %s %s must be a number", pool1.name,
+                     BOOKING_MAX_KEY, value)
+        return pool1.resource_max
+
+
+def peak(bookings, start, end):
+    """ Return the most resources booked at any instant of [start, end).
+
+    @param bookings List of (start, end, count).
+    """
+
+    ##
+    # A booking ending when another starts does not overlap it so ends
+    # sort before starts at the same instant.
+    changes = []
+    for (begin, finish, count) in bookings:
+        changes.append((max(begin, start), count))
+        changes.append((min(finish, end), -count))
+    changes.sort(key=lambda item: (item[0], item[1]))
+    ##
+
+    running = 0
+    highest = 0
+    for (_, count) in changes:
+        running += count
+        highest = max(highest, running)
+    return highest
+
+
+def book(pool1, count, start, end, holder="", tenant=""):
+    """ Book count resources of pool1 for holder of tenant over [start, end).
+
+    @return The Booking.
+    @raise BookingConflict when the pool is fully booked meanwhile.
+    @raise Busy when other requests held the pool too long.
+    """
+    # pylint: disable=R0913
+    # Each option is a parameter of the booking request.
+
+    if count <= 0:
+        raise ValueError("count %d must be positive" % count)
+    if start >= end:
+        raise ValueError("start %s must be before end %s" % (start, end))
+    if end <= datetime.datetime.now():
+        raise ValueError("end %s has passed" % end)
+
+    limit = limit_get(pool1)
+    with transaction.atomic():
+        ##
+        # Bookings of the pool are decided one at a time, see share.lock.
+        share.lock(pool1)
+        ##
+        overlaps = pool1.booking_set.filter(
+            status__in=models.Booking.ACTIVE, start__lt=end, end__gt=start)
+        booked = peak(overlaps.values_list("start", "end", "count"), start,
+                      end)
+        if booked + count > limit:
+            raise BookingConflict("%s: %d of %d resources booked between "
+                                  "%s and %s" % (pool1.name, booked, limit,
+                                                 start, end))
+        return models.Booking.objects.create(
+            pool=pool1, holder=holder, tenant=tenant, count=count,
+            start=start, end=end)
+
+
+def bookings_list(pool1, start, end):
+    """ Return bookings of pool1 overlapping [start, end) by start. """
+
+    bookings = pool1.booking_set.filter(start__lt=end, end__gt=start)
+    return bookings.order_by("start", "id")
+
+
+def resize(pool_ids):
+    """ Count PREWARM and GRANTED bookings into Pool.resource_booked. """
+
+    if not pool_ids:
+        return
+    bookings = models.Booking.objects.filter(
+        pool_id__in=pool_ids,
+        status__in=[models.Booking.PREWARM, models.Booking.GRANTED])
+    booked = dict(bookings.values_list("pool_id").annotate(
+        total=Sum("count")))
+    for pool_id in pool_ids:
+        models.Pool.objects.filter(id=pool_id).update(
+            resource_booked=booked.get(pool_id, 0))
+
+
+def cancel(booking1):
+    """ Cancel booking1, releasing any resources it was granted.
+
+    @return False if the booking had already ended.
+    """
+
+    with transaction.atomic():
+        if not models.Booking.objects.filter(
+                id=booking1.id, status__in=models.Booking.ACTIVE).update(
+                    status=models.Booking.CANCELLED):
+            return False
+        rsrcs = models.Resource.objects.filter(
+            lease__booking=booking1).select_related("pool")
+        for rsrc in rsrcs:
+            rsrc.release()
+        resize([booking1.pool_id])
+    booking1.status = models.Booking.CANCELLED
+    return True
+
+
+def handover(booking1, current):
+    """ Lease booking1.count READY resources to the holder until the end.
+
+    Either every resource is leased or none is.
+    @return True if the resources were leased.
+    """
+
+    pool1 = booking1.pool
+    end = booking1.end
+    with transaction.atomic():
+        rsrcs = list(algo.candidates(pool1).select_for_update()[
+            :booking1.count])
+        if len(rsrcs) < booking1.count:
+            LOGGER.info("%s: booking %d waits, %d of %d resources READY",
+                        pool1.name, booking1.id, len(rsrcs), booking1.count)
+            return False
+
+        ##
+        # One UPDATE reserves them all, an acquire taking one meanwhile
+        # leaves nothing changed.
+        ids = [rsrc.id for rsrc in rsrcs]
+        count = models.Resource.objects.filter(
+            id__in=ids, status=models.Resource.READY).update(
+                status=models.Resource.RESERVED,
+                action=algo.ACTION_DESTROY, action_time=end,
+                status_time=current, version=F("version") + 1)
+        if count != len(ids):
+            transaction.set_rollback(True)
+            LOGGER.info("%s: booking %d resources taken meanwhile",
+                        pool1.name, booking1.id)
+            return False
+        ##
+
+        ##
+        # A booking cancelled meanwhile keeps its status and gets nothing.
+        if not models.Booking.objects.filter(
+                id=booking1.id, status=models.Booking.PREWARM).update(
+                    status=models.Booking.GRANTED):
+            transaction.set_rollback(True)
+            LOGGER.info("%s: booking %d cancelled meanwhile", pool1.name,
+                        booking1.id)
+            return False
+        ##
+
+        models.Lease.objects.filter(resource_id__in=ids).delete()
+        models.Lease.objects.bulk_create(
+            models.Lease(resource=rsrc, holder=booking1.holder,
+                         tenant=booking1.tenant, expiry=end,
+                         booking=booking1) for rsrc in rsrcs)
+        models.Generation.bump()
+
+    for rsrc in rsrcs:
+        models.EVENTS.append(models.ResourceEvent(
+            time=current, pool_name=pool1.name, resource_name=rsrc.name,
+            status_from=models.Resource.READY,
+            status=models.Resource.RESERVED, action=algo.ACTION_DESTROY,
+            duration=(current - rsrc.status_time).total_seconds()
+            if rsrc.status_time else 0))
+        ##
+        # One resource failing to resume leaves the others to resume.
+        try:
+            algo.spare_thaw(pool1, rsrc)
+        except Exception as arg:  # pylint: disable=broad-except
+            LOGGER.exception(arg)
+            LOGGER.error("%s: booking %d resource %s failed to resume",
+                         pool1.name, booking1.id, rsrc.name)
+        ##
+    booking1.status = models.Booking.GRANTED
+    LOGGER.info("%s: booking %d granted %d resources to %s until %s",
+                pool1.name, booking1.id, len(rsrcs), booking1.holder, end)
+    return True
+
+
+def lead_get(pool1, current):
+    """ Return seconds before start to begin cloning for pool1. """
+
+    clone = history.stats(pool1.name, current - LEAD_HISTORY,
+                          current)["clone"]
+    if clone["p99"] is None:
+        return LEAD_DEFAULT + LEAD_MARGIN
+    return clone["p99"] + LEAD_MARGIN
+
+
+class Calendar(object):
+    """ Move bookings through their states on each daemon pass.
+
+    The clone lead of each pool is kept for LEAD_REFRESH.
+    """
+
+    def __init__(self):
+        self.leads = {}
+
+    def lead_get(self, pool1, current):
+        """ Return the clone lead of pool1 in seconds. """
+
+        (expires, lead) = self.leads.get(pool1.id, (None, None))
+        if expires is None or expires <= current:
+            lead = lead_get(pool1, current)
+            self.leads[pool1.id] = (current + LEAD_REFRESH, lead)
+        return lead
+
+    def tick(self, current=None):
+        """ End, prewarm and grant bookings that are due.
+
+        @return Ids of the pools whose Pool.resource_booked changed.
+        """
+
+        if current is None:
+            current = datetime.datetime.now()
+
+        resized = set()
+
+        ##
+        # Leases of GRANTED bookings expire by themselves at the end.
+        ended = list(models.Booking.objects.filter(
+            status__in=models.Booking.ACTIVE, end__lte=current).values_list(
+                "id", "pool_id", "status"))
+        for (booking_id, pool_id, status) in ended:
+            if status != models.Booking.GRANTED:
+                LOGGER.warning("booking %d ended before it was granted",
+                               booking_id)
+            if status != models.Booking.BOOKED:
+                resized.add(pool_id)
+        if ended:
+            models.Booking.objects.filter(
+                id__in=[item[0] for item in ended],
+                status__in=models.Booking.ACTIVE).update(
+                    status=models.Booking.ENDED)
+        ##
+
+        due = models.Booking.objects.filter(
+            status=models.Booking.BOOKED, start__lte=current + HORIZON)
+        for booking1 in due.select_related("pool"):
+            lead = datetime.timedelta(
+                seconds=self.lead_get(booking1.pool, current))
+            if booking1.start - lead > current:
+                continue
+            if models.Booking.objects.filter(
+                    id=booking1.id, status=models.Booking.BOOKED).update(
+                        status=models.Booking.PREWARM):
+                LOGGER.info("%s: booking %d prewarm %d resources",
+                            booking1.pool.name, booking1.id, booking1.count)
+                resized.add(booking1.pool_id)
+
+        resize(resized)
+
+        starting = models.Booking.objects.filter(
+            status=models.Booking.PREWARM, start__lte=current)
+        for booking1 in starting.select_related("pool").order_by("start"):
+            exceptions.try_catch(coding.Curry(handover, booking1, current))
+
+        return resized
@@ -3,6 +3,7 @@ Content to validate configuration file.
 """
 import os
 import logging
+import unittest
 import yaml
 from easydict import EasyDict as edict
 from testpool.core import logger
@@ -19,6 +20,23 @@ def is_valid_path(key, value):
     return len(value) == 0
 
 
+def is_valid_count(key, value):
+    """ Throw exception if value is not a positive integer. """
+
+    if not isinstance(value, int) or value < 0:
+        raise ValueError("%s: must be a positive integer" % key)
+
+
+def is_valid_bind(key, value):
+    """ Throw exception if value is not host:port. """
+
+    if not isinstance(value, str):
+        raise ValueError("%s: must be a string" % key)
+    (_, sep, port) = value.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("%s: must be host:port" % key)
+
+
 ##
 # Dictionary of valid content with functions that validate value.
 VALID = {
@@ -26,6 +44,18 @@ VALID = {
         "pool": {
             "log": is_valid_path
         }
+    },
+    "tpldb": {
+        "serve": {
+            "bind": is_valid_bind,
+            "workers": is_valid_count,
+            "threads": is_valid_count,
+            "max_requests": is_valid_count,
+            "max_requests_jitter": is_valid_count,
+            "keepalive": is_valid_count,
+            "timeout": is_valid_count,
+            "graceful_timeout": is_valid_count,
+        }
     }
 }
 ##
@@ -63,3 +93,26 @@ def check(cfg_file):
         rtc = edict(cfg)
         logging.info("log file %s is valid", cfg_file)
         return rtc
+
+
+class Testsuite(unittest.TestCase):
+    """ Validate configuration. """
+
+    def test_serve(self):
+        """ test_serve. tpldb.serve section. """
+
+        cfg = {"tpldb": {"serve": {"bind": "127.0.0.1:8000", "workers": 4}}}
+        level(cfg, VALID, None)
+
+        for serve in [{"bind": "localhost"}, {"bind": 8000},
+                      {"workers": "many"}, {"threads": -1},
+                      {"backlog": 10}]:
+            with self.assertRaises(ValueError):
+                level({"tpldb": {"serve": serve}}, VALID, None)
+
+    def test_current(self):
+        """ test_current. Installed configuration is valid. """
+
+        path = os.path.join(os.path.dirname(__file__), "..", "..", "etc",
+                            "testpool", "testpool.yml")
+        self.assertTrue(check(path))
@@ -3,9 +3,19 @@ Common content for database setup.
 """
 import sys
 import os
+import time
+import logging
 import django
+from django import db
 import testpool.settings
 
+##
+# Seconds between pings of idle connections.
+HEALTH_INTERVAL = 30
+##
+
+LOGGER = logging.getLogger(__name__)
+
 
 def init():
     """ Initialize database.
@@ -24,3 +34,44 @@ def init():
     import djconfig.settings
     from django.conf import settings
     django.setup()
+
+
+# pylint: disable=R0903
+class Health(object):
+    """ Keep long lived database connections usable.
+
+    Django recycles connections around web requests only. Long running
+    processes call tick once per pass so that connections older than
+    CONN_MAX_AGE or broken by an error are closed, connections are pinged
+    every interval seconds and dropped when the server went away, and
+    queries recorded under DEBUG are discarded. A closed connection is
+    reopened on its next use.
+    """
+
+    def __init__(self, interval=HEALTH_INTERVAL):
+        self.interval = interval
+        self.last = time.time()
+
+    def tick(self, current=None):
+        """ Check connections held by this thread. """
+
+        if current is None:
+            current = time.time()
+
+        db.reset_queries()
+
+        ping = current - self.last >= self.interval
+        if ping:
+            self.last = current
+
+        for conn in db.connections.all():
+            ##
+            # Closing inside a transaction would lose it.
+            if conn.in_atomic_block:
+                continue
+            ##
+            conn.close_if_unusable_or_obsolete()
+            if ping and conn.connection is not None and not conn.is_usable():
+                LOGGER.warning("database %s unusable, reconnecting",
+                               conn.alias)
+                conn.close()
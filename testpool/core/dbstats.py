@@ -0,0 +1,224 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Database query instrumentation.
+
+install wraps the cursors of every database connection so that each
+statement is counted along with its time. Statements count toward every
+measurement open in the thread, so a daemon pass includes the actions it
+ran. Closed measurements are logged and added to per name totals.
+
+QueryCountMiddleware measures each request by view name and returns the
+counts in the X-Query-Count and X-Query-Time headers, which tests use to
+hold endpoints to a query budget.
+"""
+import time
+import logging
+import threading
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.deprecation import MiddlewareMixin
+
+LOGGER = logging.getLogger(__name__)
+
+_LOCAL = threading.local()
+_TOTALS = {}
+_TOTALS_LOCK = threading.Lock()
+
+
+def _active():
+    """ Return usages being measured by this thread. """
+
+    try:
+        return _LOCAL.active
+    except AttributeError:
+        _LOCAL.active = []
+        return _LOCAL.active
+
+
+def _record(seconds):
+    """ Count one statement that took seconds. """
+
+    for usage in _active():
+        usage.queries += 1
+        usage.seconds += seconds
+
+
+class CountingCursor(object):
+    """ Count statements run through cursor. """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        return self.cursor.__exit__(exc_type, exc_value, trace)
+
+    def execute(self, sql, params=None):
+        """ Run and count sql. """
+
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            _record(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        """ Run and count sql as one statement. """
+
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            _record(time.time() - start)
+
+
+def _wrap(connection, **_):
+    """ Make connection return counting cursors. """
+
+    if getattr(connection, "dbstats", False):
+        return
+
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: CountingCursor(
+        make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: CountingCursor(
+        make_debug_cursor(cursor))
+    connection.dbstats = True
+
+
+def install():
+    """ Count statements of current and future connections. """
+
+    connection_created.connect(_wrap, dispatch_uid="testpool.dbstats")
+    for connection in connections.all():
+        _wrap(connection)
+
+
+# pylint: disable=R0903
+class Usage(object):
+    """ Statements and their time in seconds. """
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+class Total(object):
+    """ Usage accumulated for one name. """
+
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.max_queries = 0
+
+    def add(self, usage):
+        """ Add one measurement. """
+
+        self.calls += 1
+        self.queries += usage.queries
+        self.seconds += usage.seconds
+        self.max_queries = max(self.max_queries, usage.queries)
+
+    def as_dict(self):
+        """ Return content as a dictionary. """
+
+        return {
+            "calls": self.calls,
+            "queries": self.queries,
+            "seconds": self.seconds,
+            "max_queries": self.max_queries,
+        }
+
+
+class Measure(object):
+    """ Count statements between start and stop.
+
+    Also a context manager.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.usage = Usage()
+
+    def start(self):
+        """ Start counting. """
+
+        _active().append(self.usage)
+        return self.usage
+
+    def stop(self):
+        """ Stop counting, log and add to the totals. """
+
+        active = _active()
+        if self.usage not in active:
+            return self.usage
+        active.remove(self.usage)
+
+        with _TOTALS_LOCK:
+            _TOTALS.setdefault(self.name, Total()).add(self.usage)
+        LOGGER.debug("%s %d queries %.3f seconds", self.name,
+                     self.usage.queries, self.usage.seconds)
+        return self.usage
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+def measure(name):
+    """ Return a measurement for name. """
+    return Measure(name)
+
+
+def totals():
+    """ Return totals keyed by name. """
+
+    with _TOTALS_LOCK:
+        return dict((name, total.as_dict())
+                    for (name, total) in _TOTALS.items())
+
+
+def reset():
+    """ Discard totals. """
+
+    with _TOTALS_LOCK:
+        _TOTALS.clear()
+
+
+class QueryCountMiddleware(MiddlewareMixin):
+    """ Measure statements of each request by view name. """
+
+    def __init__(self, get_response=None):
+        super(QueryCountMiddleware, self).__init__(get_response)
+        install()
+
+    # pylint: disable=R0201
+    def process_view(self, request, view_func, *_):
+        """ Start measuring the view. """
+
+        name = "%s.%s" % (view_func.__module__, view_func.__name__)
+        request.dbstats = measure(name)
+        request.dbstats.start()
+
+    # pylint: disable=R0201
+    def process_response(self, request, response):
+        """ Report statements of the view. """
+
+        measurement = getattr(request, "dbstats", None)
+        if measurement is not None:
+            usage = measurement.stop()
+            response["X-Query-Count"] = str(usage.queries)
+            response["X-Query-Time"] = "%.3f" % usage.seconds
+        return response
@@ -0,0 +1,281 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Resource transition history.
+
+Resource.transition appends a ResourceEvent for every change of status or
+action. rollup summarises new events into one PoolRollup per pool per
+minute, minutes older than MINUTE_RETENTION are merged into hours and
+hours older than HOUR_RETENTION are removed. Raw events are kept for
+EVENT_RETENTION once summarised.
+
+stats answers clone time, hold time and utilisation questions from the
+rollups alone. Clone time is the time from entering PENDING to READY, hold
+time is the time spent RESERVED.
+"""
+import datetime
+import logging
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Max
+from testpooldb import models
+
+ROLLUP_INTERVAL = 60
+ROLLUP_BATCH = 10000
+EVENT_RETENTION = datetime.timedelta(days=1)
+MINUTE_RETENTION = datetime.timedelta(days=2)
+HOUR_RETENTION = datetime.timedelta(days=90)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _period_start(when, period):
+    """ Return start of the period containing when. """
+
+    seconds = when.minute * 60 + when.second
+    seconds -= seconds % min(period, models.PoolRollup.HOUR)
+    return when.replace(minute=seconds // 60, second=0, microsecond=0)
+
+
+def _hist_add(value, seconds):
+    """ Return histogram value with seconds counted. """
+
+    counts = models.PoolRollup.hist_parse(value)
+    counts[models.PoolRollup.hist_bucket(seconds)] += 1
+    return models.PoolRollup.hist_format(counts)
+
+
+def _hist_merge(value1, value2):
+    """ Return the sum of two histograms. """
+
+    counts = [item1 + item2 for (item1, item2) in
+              zip(models.PoolRollup.hist_parse(value1),
+                  models.PoolRollup.hist_parse(value2))]
+    return models.PoolRollup.hist_format(counts)
+
+
+def percentile(value, fraction):
+    """ Return the fraction percentile of a histogram in seconds.
+
+    The upper bound of the bucket is returned, values beyond the last
+    bound report the last bound. None is returned for an empty histogram.
+    """
+
+    counts = models.PoolRollup.hist_parse(value)
+    total = sum(counts)
+    if not total:
+        return None
+
+    bounds = models.PoolRollup.BUCKETS
+    running = 0
+    for (index, count) in enumerate(counts):
+        running += count
+        if running >= fraction * total:
+            return bounds[min(index, len(bounds) - 1)]
+    return bounds[-1]
+
+
+def _rollups_get(pool_names, period, starts):
+    """ Return existing rollups keyed by (pool_name, start). """
+
+    rollups = models.PoolRollup.objects.filter(
+        pool_name__in=pool_names, period=period, start__in=starts)
+    return dict(((item.pool_name, item.start), item) for item in rollups)
+
+
+def _rollup_get(rollups, pool_name, period, start):
+    """ Return rollup for pool_name and start, creating it if needed. """
+
+    key = (pool_name, start)
+    if key not in rollups:
+        rollups[key] = models.PoolRollup(pool_name=pool_name, period=period,
+                                         start=start)
+    return rollups[key]
+
+
+def _save(rollups):
+    """ Save every rollup. """
+
+    for item in rollups.values():
+        item.save()
+
+
+def _summarise(current):
+    """ Add new events and a utilisation sample to the minute rollups.
+
+    Events are read after the highest event already summarised. Return
+    the number of events summarised.
+    """
+
+    last = models.PoolRollup.objects.aggregate(
+        last=Max("last_event"))["last"] or 0
+    events = list(models.ResourceEvent.objects.filter(
+        id__gt=last).order_by("id")[:ROLLUP_BATCH])
+
+    ##
+    # Reserved counts per pool, pools without reserved resources report 0.
+    reserved = dict(models.Resource.objects.filter(
+        status=models.Resource.RESERVED).values_list("pool__name").annotate(
+            count=Count("id")))
+    pools = dict(models.Pool.objects.values_list("name", "resource_max"))
+    ##
+
+    period = models.PoolRollup.MINUTE
+    now_start = _period_start(current, period)
+    starts = set(_period_start(item.time, period) for item in events)
+    starts.add(now_start)
+    pool_names = set(item.pool_name for item in events) | set(pools)
+    rollups = _rollups_get(pool_names, period, starts)
+
+    for event in events:
+        summary = _rollup_get(rollups, event.pool_name, period,
+                              _period_start(event.time, period))
+        summary.transitions += 1
+        summary.last_event = max(summary.last_event, event.id)
+
+        if event.status == models.Resource.RESERVED and \
+           event.status_from != models.Resource.RESERVED:
+            summary.acquired += 1
+        elif event.status_from == models.Resource.RESERVED and \
+                event.status != models.Resource.RESERVED:
+            summary.released += 1
+            summary.hold_hist = _hist_add(summary.hold_hist, event.duration)
+
+        if event.status_from == models.Resource.PENDING and \
+           event.status == models.Resource.READY:
+            summary.clone_hist = _hist_add(summary.clone_hist,
+                                           event.duration)
+
+    for (pool_name, resource_max) in pools.items():
+        summary = _rollup_get(rollups, pool_name, period, now_start)
+        summary.reserved += reserved.get(pool_name, 0)
+        summary.samples += 1
+        summary.resource_max = max(summary.resource_max, resource_max)
+
+    with transaction.atomic():
+        _save(rollups)
+    return len(events)
+
+
+def _downsample(current):
+    """ Merge minute rollups older than MINUTE_RETENTION into hours. """
+
+    minutes = models.PoolRollup.objects.filter(
+        period=models.PoolRollup.MINUTE,
+        start__lt=current - MINUTE_RETENTION)
+    minutes = list(minutes)
+    if not minutes:
+        return
+
+    period = models.PoolRollup.HOUR
+    starts = set(_period_start(item.start, period) for item in minutes)
+    pool_names = set(item.pool_name for item in minutes)
+    rollups = _rollups_get(pool_names, period, starts)
+
+    for minute in minutes:
+        hour = _rollup_get(rollups, minute.pool_name, period,
+                           _period_start(minute.start, period))
+        hour.transitions += minute.transitions
+        hour.acquired += minute.acquired
+        hour.released += minute.released
+        hour.clone_hist = _hist_merge(hour.clone_hist, minute.clone_hist)
+        hour.hold_hist = _hist_merge(hour.hold_hist, minute.hold_hist)
+        hour.reserved += minute.reserved
+        hour.samples += minute.samples
+        hour.resource_max = max(hour.resource_max, minute.resource_max)
+        hour.last_event = max(hour.last_event, minute.last_event)
+
+    with transaction.atomic():
+        _save(rollups)
+        models.PoolRollup.objects.filter(
+            id__in=[item.id for item in minutes]).delete()
+
+
+def rollup(current=None):
+    """ Summarise new events, downsample and apply retention.
+
+    Return the number of events summarised.
+    """
+
+    if current is None:
+        current = datetime.datetime.now()
+
+    models.EVENTS.flush()
+    count = _summarise(current)
+    _downsample(current)
+
+    ##
+    # Only events that have been summarised are removed.
+    last = models.PoolRollup.objects.aggregate(
+        last=Max("last_event"))["last"] or 0
+    models.ResourceEvent.objects.filter(
+        id__lte=last, time__lt=current - EVENT_RETENTION).delete()
+    models.PoolRollup.objects.filter(
+        period=models.PoolRollup.HOUR,
+        start__lt=current - HOUR_RETENTION).delete()
+    ##
+
+    LOGGER.debug("rollup summarised %d events", count)
+    return count
+
+
+# pylint: disable=R0903
+class Rollup(object):
+    """ Run rollup at most every interval seconds. """
+
+    def __init__(self, interval=ROLLUP_INTERVAL):
+        self.interval = datetime.timedelta(seconds=interval)
+        self.last = None
+
+    def tick(self, current=None):
+        """ Flush pending events and rollup when interval has passed. """
+
+        if current is None:
+            current = datetime.datetime.now()
+
+        models.EVENTS.flush()
+        if self.last is None or current - self.last >= self.interval:
+            self.last = current
+            rollup(current)
+
+
+def stats(pool_name, start, end):
+    """ Return clone, hold and utilisation statistics for a pool.
+
+    Statistics cover rollups that start in [start, end). Times are in
+    seconds. utilisation holds one (start, period, fraction) per rollup
+    with samples.
+    """
+
+    rollups = models.PoolRollup.objects.filter(
+        pool_name=pool_name, start__gte=start, start__lt=end)
+    rollups = rollups.order_by("start")
+
+    clone_hist = ""
+    hold_hist = ""
+    acquired = 0
+    released = 0
+    utilisation = []
+    for item in rollups:
+        clone_hist = _hist_merge(clone_hist, item.clone_hist)
+        hold_hist = _hist_merge(hold_hist, item.hold_hist)
+        acquired += item.acquired
+        released += item.released
+        if item.samples and item.resource_max:
+            fraction = float(item.reserved) / item.samples / item.resource_max
+            utilisation.append((item.start, item.period, fraction))
+
+    def _summary(value):
+        """ Return count and percentiles of a histogram. """
+        return {
+            "count": sum(models.PoolRollup.hist_parse(value)),
+            "p50": percentile(value, 0.5),
+            "p99": percentile(value, 0.99),
+        }
+
+    return {
+        "clone": _summary(clone_hist),
+        "hold": _summary(hold_hist),
+        "acquired": acquired,
+        "released": released,
+        "utilisation": utilisation,
+    }
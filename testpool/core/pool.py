@@ -6,8 +6,12 @@ This pool pretends to manage a pool of Resources which are merely pretend
 ResourceS which do not exist.
 """
 import logging
+import datetime
+from django.utils.dateparse import parse_datetime
 import testpool.core.ext
 import testpool.core.algo
+import testpool.core.booking
+import testpool.core.share
 from testpooldb import models
 
 LOGGER = logging.getLogger(__name__)
@@ -49,7 +53,120 @@ def _do_pool_add(args):
         raise ValueError("product %s not supported" % args.product)
 
     testpool.core.algo.pool_add(args.connection, args.product, args.pool,
-                                args.max, args.template)
+                                args.max, args.template, args.spare,
+                                args.registry)
+    return 0
+
+
+def _do_pool_share(args):
+    """ Set the minimum and maximum Resources a tenant of a pool holds.
+
+    A tenant below its minimum is always given a READY Resource, others
+    cannot take the Resources it is owed. A tenant at its maximum must
+    release one first. The tenant * applies to tenants without their own
+    share.
+    """
+
+    LOGGER.info("share pool %s tenant %s", args.pool, args.tenant)
+    try:
+        pool1 = models.Pool.objects.get(name=args.pool)
+    except models.Pool.DoesNotExist:
+        LOGGER.warning("pool %s not found", args.pool)
+        return 1
+
+    testpool.core.share.share_set(pool1, args.tenant, args.min, args.max)
+    return 0
+
+
+def _do_pool_fallback(args):
+    """ Set the pools tried in order when a pool has no READY Resource.
+
+    Acquire takes a READY Resource from the first fallback pool that has
+    one. Without fallback pools acquire only uses the pool itself.
+    """
+
+    LOGGER.info("fallback pool %s to %s", args.pool, args.fallbacks)
+    try:
+        pool1 = models.Pool.objects.get(name=args.pool)
+    except models.Pool.DoesNotExist:
+        LOGGER.warning("pool %s not found", args.pool)
+        return 1
+
+    testpool.core.algo.fallbacks_set(pool1, args.fallbacks)
+    return 0
+
+
+def _do_pool_reuse(args):
+    """ Keep released Resources for their holder for a grace period.
+
+    A holder acquiring from the pool again within the grace period gets
+    its released Resource back without a rebuild. Otherwise the Resource
+    is rebuilt once the grace period ends. 0 rebuilds at once.
+    """
+
+    LOGGER.info("reuse pool %s grace %d", args.pool, args.grace)
+    try:
+        pool1 = models.Pool.objects.get(name=args.pool)
+    except models.Pool.DoesNotExist:
+        LOGGER.warning("pool %s not found", args.pool)
+        return 1
+
+    testpool.core.algo.reuse_set(pool1, args.grace)
+    return 0
+
+
+def _datetime(value):
+    """ Return the datetime of argument value. """
+
+    when = parse_datetime(value)
+    if when is None:
+        raise ValueError("%s must be YYYY-MM-DDTHH:MM[:SS]" % value)
+    return when
+
+
+def _do_pool_book(args):
+    """ Book Resources of a pool for a window in the future.
+
+    The pool grows ahead of start by the measured clone time so the
+    Resources are READY when the window opens. They are leased to holder
+    at start and reclaimed at the end of the window.
+    """
+
+    LOGGER.info("book pool %s", args.pool)
+    try:
+        pool1 = models.Pool.objects.get(name=args.pool)
+    except models.Pool.DoesNotExist:
+        LOGGER.warning("pool %s not found", args.pool)
+        return 1
+
+    end = args.start + datetime.timedelta(minutes=args.minutes)
+    try:
+        booking1 = testpool.core.booking.book(pool1, args.count, args.start,
+                                              end, args.holder, args.tenant)
+    except testpool.core.booking.BookingConflict as arg:
+        LOGGER.warning("%s", arg)
+        return 1
+    print "booking %d" % booking1.id
+    return 0
+
+
+def _do_pool_calendar(args):
+    """ List bookings of a pool over the next days. """
+
+    try:
+        pool1 = models.Pool.objects.get(name=args.pool)
+    except models.Pool.DoesNotExist:
+        LOGGER.warning("pool %s not found", args.pool)
+        return 1
+
+    fmt = "%-6s %-19s %-19s %-5s %-8s %s"
+    start = datetime.datetime.now()
+    end = start + datetime.timedelta(days=args.days)
+    print fmt % ("Id", "Start", "End", "Count", "Status", "Holder")
+    for booking1 in testpool.core.booking.bookings_list(pool1, start, end):
+        print fmt % (booking1.id, booking1.start.strftime("%Y-%m-%d %H:%M:%S"),
+                     booking1.end.strftime("%Y-%m-%d %H:%M:%S"),
+                     booking1.count, booking1.status_str(), booking1.holder)
     return 0
 
 
@@ -122,6 +239,81 @@ def add_subparser(subparser):
     parser.add_argument("template", type=str,
                         help="Number of Resource to manage.")
     parser.add_argument("max", type=int, help="Number of Resource to manage.")
+    parser.add_argument("--spare", choices=testpool.core.algo.SPARE_MODES,
+                        default=None,
+                        help="What READY Resources do until acquired. "
+                        "frozen Resources are paused and hold no CPU.")
+    parser.add_argument("--registry",
+                        choices=testpool.core.algo.REGISTRY_MODES,
+                        default=None,
+                        help="Whether the template is pulled from its "
+                        "registry. offline pools only use local images.")
+    ##
+
+    ##
+    # Share
+    parser = rootparser.add_parser("share",
+                                   description=_do_pool_share.__doc__,
+                                   help="Share a pool between tenants")
+    parser.set_defaults(func=_do_pool_share)
+    parser.add_argument("pool", type=str, help="Pool name.")
+    parser.add_argument("tenant", type=str,
+                        help="Team or pipeline acquiring Resources.")
+    parser.add_argument("--min", type=int, default=None,
+                        help="Resources kept for the tenant.")
+    parser.add_argument("--max", type=int, default=None,
+                        help="Resources the tenant may hold at once.")
+    ##
+
+    ##
+    # Fallback
+    parser = rootparser.add_parser("fallback",
+                                   description=_do_pool_fallback.__doc__,
+                                   help="Fall back to other pools")
+    parser.set_defaults(func=_do_pool_fallback)
+    parser.add_argument("pool", type=str, help="Pool name.")
+    parser.add_argument("fallbacks", type=str, nargs="*",
+                        help="Pools to try in order, none clears them.")
+    ##
+
+    ##
+    # Reuse
+    parser = rootparser.add_parser("reuse",
+                                   description=_do_pool_reuse.__doc__,
+                                   help="Reuse released Resources")
+    parser.set_defaults(func=_do_pool_reuse)
+    parser.add_argument("pool", type=str, help="Pool name.")
+    parser.add_argument("grace", type=int,
+                        help="Seconds a released Resource is kept.")
+    ##
+
+    ##
+    # Book
+    parser = rootparser.add_parser("book",
+                                   description=_do_pool_book.__doc__,
+                                   help="Book Resources for a future window")
+    parser.set_defaults(func=_do_pool_book)
+    parser.add_argument("pool", type=str, help="Pool name.")
+    parser.add_argument("count", type=int, help="Number of Resources.")
+    parser.add_argument("start", type=_datetime,
+                        help="Start of the window, YYYY-MM-DDTHH:MM.")
+    parser.add_argument("--minutes", type=int, default=60,
+                        help="Length of the window.")
+    parser.add_argument("--holder", type=str, default="",
+                        help="Who the Resources are leased to.")
+    parser.add_argument("--tenant", type=str, default="",
+                        help="Team or pipeline of the booking.")
+    ##
+
+    ##
+    # Calendar
+    parser = rootparser.add_parser("calendar",
+                                   description=_do_pool_calendar.__doc__,
+                                   help="List bookings of a pool")
+    parser.set_defaults(func=_do_pool_calendar)
+    parser.add_argument("pool", type=str, help="Pool name.")
+    parser.add_argument("--days", type=int, default=7,
+                        help="Days of bookings to list.")
     ##
 
     ##
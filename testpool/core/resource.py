@@ -6,11 +6,18 @@ This pool pretends to manage a pool of Resources which are merely pretend
 ResourceS which do not exist.
 """
 import logging
+from django.db import transaction
 from django.db.models import Q
 from testpool.core import algo
 from testpool.core import ext
 from testpooldb import models
 
+##
+# Resources reserved without an expiration are held until released, their
+# action is scheduled so far ahead that it never fires.
+RESERVE_HOLD = 100*365*24*60*60
+##
+
 
 def _pool_get(connection, product, pool):
     """ Return the pool given the parameters. """
@@ -36,27 +43,48 @@ def _do_resource_release(args):
     logging.info("release %s %s", args.pool, args.name)
     rsrc = models.Resource.objects.get(name=args.name,
                                        pool__name=args.pool)
-    rsrc.transition(models.Resource.PENDING, algo.ACTION_DESTROY, 0)
-    rsrc.save()
+    if not rsrc.transition_from(models.Resource.STATUSES,
+                                models.Resource.PENDING, algo.ACTION_DESTROY,
+                                0):
+        logging.error("%s %s removed", args.pool, args.name)
+        return 1
     return 0
 
 
 def _do_resource_reserve(args):
-    """ Reserve Resource. """
+    """ Reserve Resource.
+
+    The Resource is held until released. With --expiration it is leased to
+    --holder instead, the lease can be renewed and the Resource is
+    reclaimed once the lease expires.
+    """
 
     logging.info("reserve %s %s", args.pool, args.name)
-    rsrc = models.Resource.objects.get(name=args.name,
-                                       pool__name=args.pool)
-    rsrc.status = models.Resource.RESERVED
-    rsrc.save()
+    rsrc = models.Resource.objects.select_related("pool").get(
+        name=args.name, pool__name=args.pool)
+
+    with transaction.atomic():
+        if args.expiration is None:
+            reserved = rsrc.transition_from(
+                models.Resource.STATUSES, models.Resource.RESERVED,
+                algo.ACTION_NONE, RESERVE_HOLD)
+        else:
+            reserved = rsrc.transition_from(
+                models.Resource.STATUSES, models.Resource.RESERVED,
+                algo.ACTION_DESTROY, args.expiration)
+            if reserved:
+                models.Lease.grant(rsrc, args.holder, args.expiration)
+    if not reserved:
+        logging.error("%s %s removed", args.pool, args.name)
+        return 1
     return 0
 
 
 def _do_resource_detail(args):
     """ Resource Detail content. """
 
-    rsrc = models.Resource.objects.get(pool__name=args.pool,
-                                       name=args.name)
+    rsrc = models.Resource.objects.select_related("pool__host").get(
+        pool__name=args.pool, name=args.name)
 
     exts = ext.api_ext_list()
     pool = exts[rsrc.pool.host.product].pool_get(rsrc.pool)
@@ -72,12 +100,16 @@ def _do_resource_list(args):
     fmt = "%-25s %-8s %-16s %s"
 
     logging.info("%s: list resources", args.pool)
-    rsrcs = models.Resource.objects.filter(pool__name=args.pool)
+    rsrcs = models.Resource.objects.filter(pool__name=args.pool).only(
+        "name", "status", "ip_addr", "action_time").order_by("id")
 
+    ##
+    # Rows are not all held in memory.
     print fmt % ("Name", "Status", "IP", "Reserved Time")
-    for rsrc in rsrcs:
+    for rsrc in rsrcs.iterator():
         print fmt % (rsrc.name, models.Resource.status_to_str(rsrc.status),
                      rsrc.ip_addr, rsrc.action_time)
+    ##
 
 
 def _do_resource_contain(args):
@@ -86,17 +118,17 @@ def _do_resource_contain(args):
     fmt = "%-7s %-16s %-13s %-8s %-16s %s"
 
     logging.info("list resources by %s", args.patterns)
-    rsrcs = models.Resource.objects.all()
+    rsrcs = models.Resource.objects.select_related("pool__host")
     for pattern in args.patterns:
         rsrcs = rsrcs.filter(
             Q(name__contains=pattern) |
             Q(pool__host__connection__contains=pattern) |
             Q(pool__host__product__contains=pattern) |
-            Q(pool__name__contains=pattern)).order_by("name")
+            Q(pool__name__contains=pattern))
 
     print fmt % ("Pool", "Connection", "Name", "Status", "IP",
                  "Reserved Time")
-    for rsrc in rsrcs:
+    for rsrc in rsrcs.order_by("name").iterator():
         print fmt % (rsrc.pool.name, rsrc.pool.host.connection,
                      rsrc.name, models.Resource.status_to_str(rsrc.status),
                      rsrc.ip_addr, rsrc.action_time)
@@ -132,10 +164,16 @@ def add_subparser(subparser):
     parser.set_defaults(func=_do_resource_release)
 
     parser = rootparser.add_parser("reserve",
-                                   description=_do_resource_incr.__doc__,
+                                   description=_do_resource_reserve.__doc__,
                                    help="Reserve Resource.")
     parser.add_argument("pool", type=str, help="Pool name.")
     parser.add_argument("name", type=str, help="The Resource name.")
+    parser.add_argument("--expiration", type=int, default=None,
+                        help="Seconds before the Resource is reclaimed "
+                        "unless renewed. By default it is held until "
+                        "released.")
+    parser.add_argument("--holder", type=str, default="",
+                        help="Who the Resource is leased to.")
     parser.set_defaults(func=_do_resource_reserve)
 
     ##
@@ -18,6 +18,8 @@ import unittest
 import time
 import logging
 import structlog
+from django.db.models import F
+from django.test.utils import override_settings
 import testpool.settings
 from testpool.core import ext
 from testpool.core import algo
@@ -27,9 +29,14 @@ from testpool.core import commands
 from testpool.core import exceptions
 from testpool.core import coding
 from testpool.core import cfgcheck
+from testpool.core import history
+from testpool.core import booking
+from testpool.core import database
+from testpool.core import dbstats
 from testpooldb import models
 
 FOREVER = None
+METRICS_INTERVAL = 60
 CFG = None
 LOGGER = logger.create()
 POOL_LOGGER = None
@@ -123,7 +130,12 @@ def argparser():
 
 
 def adapt(exts):
-    """ Check to see if the pools should change. """
+    """ Check to see if the pools should change.
+
+    Templates are prefetched first so that clones do not wait on them.
+    A driver prefetches a template only when it was not prepared within
+    its refresh interval and no prefetch of it is in progress.
+    """
 
     LOGGER.info("adapt started")
 
@@ -135,6 +147,7 @@ def adapt(exts):
                              resource_max=pool1.resource_max)
         ext1 = exts[pool1.host.product]
         pool = ext1.pool_get(pool1)
+        pool.prefetch(pool1.template_name)
         algo.adapt(pool, pool1)
 
     LOGGER.info("adapt ended")
@@ -165,6 +178,8 @@ def action_destroy(exts, rsrc):
             algo.adapt(pool, pool1)
         ##
         LOGGER.info("%s: action_destroy %s done", pool1.name, rsrc_name)
+    except models.Resource.Conflict:
+        raise
     except Exception, arg:
         LOGGER.debug("action_destroy %s interrupted", rsrc_name)
         LOGGER.exception(arg)
@@ -188,6 +203,8 @@ def action_clone(exts, rsrc):
 
         algo.adapt(pool, rsrc.pool)
         LOGGER.info("%s: action_clone %s done", pool1.name, rsrc_name)
+    except models.Resource.Conflict:
+        raise
     except Exception:
         LOGGER.exception("action_clone %s interrupted", rsrc.name)
         delta = pool.timing_get(api.Pool.TIMING_REQUEST_DESTROY)
@@ -248,11 +265,10 @@ def setup(exts):
         # destroyed through the normal event engine.
         for count in range(pool1.resource_max):
             name = pool.new_name_get(pool1.template_name, count)
-            for rsrc in models.Resource.objects.filter(pool=pool1,
-                                                       name=name):
-                # Mark bad just to figure out which to delete immediately.
-                rsrc.status = models.Resource.BAD
-                rsrc.save()
+            # Mark bad just to figure out which to delete immediately.
+            models.Resource.objects.filter(pool=pool1, name=name).update(
+                status=models.Resource.BAD, version=F("version") + 1)
+        models.Generation.bump()
 
         ##
         # Quickly go through all of the resources to reclaim them by
@@ -263,8 +279,9 @@ def setup(exts):
             try:
                 for rsrc in models.Resource.objects.filter(pool=pool1,
                                                            name=name):
-                    rsrc.transition(models.Resource.PENDING,
-                                    algo.ACTION_DESTROY, delta)
+                    rsrc.transition_from(models.Resource.STATUSES,
+                                         models.Resource.PENDING,
+                                         algo.ACTION_DESTROY, delta)
                     LOGGER.info("setup mark resource %s to be destroyed",
                                 rsrc.name)
                 delta += pool.timing_get(api.Pool.TIMING_REQUEST_DESTROY)
@@ -296,11 +313,11 @@ def action_attr(exts, rsrc):
     #  If resource expires reclaim it.
     ext1 = exts[rsrc.pool.host.product]
     pool = ext1.pool_get(rsrc.pool)
-    rsrc.ip_addr = pool.ip_get(rsrc.name)
-    if rsrc.ip_addr:
+    if algo.attr(pool, rsrc):
         LOGGER.info("%s: resource %s ip %s", rsrc.pool.name, rsrc.name,
                     rsrc.ip_addr)
         delta = pool.timing_get(api.Pool.TIMING_REQUEST_NONE)
+        pool.spare_freeze(rsrc.name)
         rsrc.transition(models.Resource.READY, algo.ACTION_NONE, delta)
         algo.adapt(pool, rsrc.pool)
     else:
@@ -330,20 +347,19 @@ def mode_test_stop(args):
 def events_show(banner):
     """ Show all of the pending events. """
 
+    pools = dict(models.Pool.objects.values_list("id", "name"))
     for rsrc in models.Resource.objects.all().order_by("action_time"):
-        action_delay = rsrc.action_time - datetime.datetime.now()
-        action_delay = action_delay.seconds
-
-        try:
-            LOGGER.debug("%s: %s.%s %s action %s at %s", banner,
-                         rsrc.pool.name, rsrc.name,
-                         models.Resource.status_to_str(rsrc.status),
-                         rsrc.action,
-                         rsrc.action_time.strftime("%Y-%m-%d %H:%M:%S"))
-        except models.Pool.DoesNotExist:
+        if rsrc.pool_id not in pools:
             # If at any time resource becomes unattached to a pool
             # then delete the resource.
             rsrc.delete()
+            continue
+
+        LOGGER.debug("%s: %s.%s %s action %s at %s", banner,
+                     pools[rsrc.pool_id], rsrc.name,
+                     models.Resource.status_to_str(rsrc.status),
+                     rsrc.action,
+                     rsrc.action_time.strftime("%Y-%m-%d %H:%M:%S"))
 
 
 def action_resource(rsrc):
@@ -358,17 +374,122 @@ def action_resource(rsrc):
                 rsrc.action_time.strftime("%Y-%m-%d %H:%M:%S"))
 
     try:
-        if rsrc.action == algo.ACTION_DESTROY:
-            action_destroy(exts, rsrc)
-        elif rsrc.action == algo.ACTION_CLONE:
-            action_clone(exts, rsrc)
-        elif rsrc.action == algo.ACTION_ATTR:
-            action_attr(exts, rsrc)
-        elif rsrc.action == algo.ACTION_NONE:
-            pass
+        with dbstats.measure("action." + rsrc.action):
+            if rsrc.action == algo.ACTION_DESTROY:
+                action_destroy(exts, rsrc)
+            elif rsrc.action == algo.ACTION_CLONE:
+                action_clone(exts, rsrc)
+            elif rsrc.action == algo.ACTION_ATTR:
+                action_attr(exts, rsrc)
+            elif rsrc.action == algo.ACTION_NONE:
+                pass
     except models.Pool.DoesNotExist:
         LOGGER.debug("action %s deleted because pool missing.", rsrc.name)
         rsrc.delete()
+    except models.Resource.Conflict:
+        ##
+        # Acquired, released or renewed meanwhile. The next pass sees the
+        # new state.
+        LOGGER.info("%s: action %s skipped, resource changed", rsrc.name,
+                    rsrc.action)
+        ##
+
+
+def tick(args, rollup, health, calendar):
+    """ Run one pass of the scheduler.
+
+    Fire the resource actions that are due or sleep until the next one is.
+    @return The number of resources handled or None when test mode is done.
+    """
+
+    with dbstats.measure("tick"):
+        return _tick(args, rollup, health, calendar)
+
+
+def metrics_log():
+    """ Log database usage totals to the pool log. """
+
+    if POOL_LOGGER:
+        for (name, total) in sorted(dbstats.totals().items()):
+            POOL_LOGGER.info(metric=name, **total)
+
+
+def bookings(calendar):
+    """ Advance bookings and resize the pools whose bookings changed.
+
+    An error of one pool leaves the other pools to be resized.
+    """
+
+    pool_ids = calendar.tick()
+    if not pool_ids:
+        return
+    exts = ext.api_ext_list()
+    for pool1 in models.Pool.objects.filter(
+            id__in=pool_ids).select_related("host"):
+        exceptions.try_catch(coding.Curry(_booking_adapt, exts, pool1))
+
+
+def _booking_adapt(exts, pool1):
+    """ Resize pool1 to its bookings. """
+
+    algo.adapt(exts[pool1.host.product].pool_get(pool1), pool1)
+
+
+def _tick(args, rollup, health, calendar):
+    """ Run one pass of the scheduler. """
+
+    health.tick()
+    events_show("Resources")
+    rollup.tick()
+    algo.lease_sweep()
+    models.RequestKey.evict()
+    bookings(calendar)
+    if mode_test_stop(args):
+        return None
+
+    ##
+    # Retrieve resources. For action items that are ready run the
+    # required action.
+    current = datetime.datetime.now()
+    LOGGER.info("checking actions %s", current)
+    rsrcs = models.Resource.objects.filter(
+        status__in=models.Resource.NOT_READY)
+    rsrcs = rsrcs.order_by("action_time")
+
+    if not rsrcs:
+        LOGGER.info("testpool no actions sleeping %s (seconds)",
+                    args.max_sleep_time)
+        time.sleep(args.max_sleep_time)
+        return 0
+
+    ##
+    # Check the first action. If its not ready to fire then all
+    # actions are not ready to fire. Calculate the amount of time
+    # to sleep but take into consideration the minimum and maximum
+    # sleep times as well.
+    #
+    # The maximum amount of sleep time should be reasonable so that
+    # changes to the database will be detected in a reasonable amount
+    # of time.
+    rsrc = rsrcs.first()
+    if rsrc.action_time > current and args.max_sleep_time != 0:
+        action_delay = abs(rsrc.action_time - current).seconds
+
+        sleep_time = min(args.max_sleep_time, action_delay)
+        sleep_time = max(args.min_sleep_time, sleep_time)
+        LOGGER.info("testpool sleeping %s (seconds)", sleep_time)
+        time.sleep(sleep_time)
+        return 0
+
+    LOGGER.info("testpool actions fired")
+    fired = 0
+    for rsrc in rsrcs:
+        if rsrc.action_time < current or args.max_sleep_time == 0:
+            exceptions.try_catch(coding.Curry(action_resource, rsrc))
+            fired += 1
+        else:
+            break
+    return fired
 
 
 def main(args):
@@ -392,52 +513,30 @@ def main(args):
     exceptions.try_catch(coding.Curry(adapt, exts))
     ##
 
-    while count == FOREVER or count > 0:
-        events_show("Resources")
-        if mode_test_stop(args):
-            return 0
+    ##
+    # Transition events are written after each pass and summarised every
+    # history.ROLLUP_INTERVAL seconds. Bookings advance on each pass.
+    rollup = history.Rollup()
+    health = database.Health()
+    calendar = booking.Calendar()
+    ##
 
-        ##
-        # Retrieve resources. For action items that are ready run the
-        # required action.
-        current = datetime.datetime.now()
-        LOGGER.info("checking actions %s", current)
-        rsrcs = models.Resource.objects.exclude(status=models.Resource.READY)
-        rsrcs = rsrcs.order_by("action_time")
-
-        if not rsrcs:
-            LOGGER.info("testpool no actions sleeping %s (seconds)",
-                        args.max_sleep_time)
-            time.sleep(args.max_sleep_time)
-            continue
+    ##
+    # Database usage totals are logged every METRICS_INTERVAL seconds.
+    dbstats.install()
+    logged = time.time()
+    ##
 
-        ##
-        # Check the first action. If its not ready to fire then all
-        # actions are not ready to fire. Calculate the amount of time
-        # to sleep but take into consideration the minimum and maximum
-        # sleep times as well.
-        #
-        # The maximum amount of sleep time should be reasonable so that
-        # changes to the database will be detected in a reasonable amount
-        # of time.
-        rsrc = rsrcs.first()
-        if rsrc.action_time > current and args.max_sleep_time != 0:
-            action_delay = abs(rsrc.action_time - current).seconds
-
-            sleep_time = min(args.max_sleep_time, action_delay)
-            sleep_time = max(args.min_sleep_time, sleep_time)
-            LOGGER.info("testpool sleeping %s (seconds)", sleep_time)
-            time.sleep(sleep_time)
-            continue
+    while count == FOREVER or count > 0:
+        fired = tick(args, rollup, health, calendar)
+        if fired is None:
+            return 0
 
-        LOGGER.info("testpool actions fired")
-        for rsrc in rsrcs:
-            if rsrc.action_time < current or args.max_sleep_time == 0:
-                exceptions.try_catch(coding.Curry(action_resource, rsrc))
-            else:
-                break
+        if time.time() - logged >= METRICS_INTERVAL:
+            logged = time.time()
+            metrics_log()
 
-        if count != FOREVER:
+        if fired and count != FOREVER:
             count -= 1
 
     LOGGER.info("testpool server stopped")
@@ -491,6 +590,8 @@ class ModelTestCase(unittest.TestCase):
             pass
         if os.path.exists("/tmp/testpool/fake/localhost/test.server.pool"):
             os.remove("/tmp/testpool/fake/localhost/test.server.pool")
+        fake = ext.api_ext_list()["fake"]
+        fake.store.get().clear("localhost/" + self.pool_name)
 
     def test_shrink(self):
         """ test_shrink. """
@@ -594,9 +695,134 @@ class ModelTestCase(unittest.TestCase):
         self.assertEqual(rsrcs.count(), 2)
         ##
 
+    def test_budget(self):
+        """ test_budget. Queries of an idle pass do not grow with resources.
+        """
+
+        (host1, _) = models.Host.objects.get_or_create(connection="localhost",
+                                                       product="fake")
+        dbstats.install()
+
+        queries = []
+        for resource_max in [2, 8]:
+            defaults = {"resource_max": resource_max,
+                        "template_name": "test.template"}
+            models.Pool.objects.update_or_create(
+                name=self.pool_name, host=host1, defaults=defaults)
+            self.assertEqual(main(ModelTestCase.fake_args()), 0)
+
+            args = ModelTestCase.fake_args()
+            args.count = FOREVER
+            rollup = history.Rollup()
+            rollup.last = datetime.datetime.now()
+            with dbstats.measure("test_budget") as usage:
+                self.assertEqual(tick(args, rollup, database.Health(),
+                                      booking.Calendar()), 0)
+            queries.append(usage.queries)
+
+        self.assertEqual(queries[0], queries[1])
+
     def test_pool_log(self):
         """ test structure log format. """
 
         logger1 = pool_log_create("./pool.log")
         self.assertTrue(logger1)
         logger1.info(pool="example", resource_count=1, resource_max=2)
+
+
+def rss_get():
+    """ Return resident set size of this process in bytes. """
+
+    with open("/proc/self/statm") as stream:
+        pages = int(stream.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+@unittest.skipUnless("TESTPOOL_SOAK_TICKS" in os.environ,
+                     "set TESTPOOL_SOAK_TICKS or run make soak")
+class SoakTestCase(unittest.TestCase):
+    """ Check the daemon does not grow while it runs.
+
+    It takes minutes so the unit tests skip it.
+    """
+
+    WARMUP_TICKS = 500
+    RSS_GROWTH = 2 * 1024 * 1024
+
+    pool_name = "test.server.soak"
+
+    def setUp(self):
+        """ Create a small fake pool whose operations sometimes fail. """
+
+        (host1, _) = models.Host.objects.get_or_create(connection="localhost",
+                                                       product="fake")
+        defaults = {"resource_max": 3, "template_name": "soak.template"}
+        (self.pool1, _) = models.Pool.objects.update_or_create(
+            name=self.pool_name, host=host1, defaults=defaults)
+        self.pool1.kvp_value_set("fake.store", "memory")
+        self.pool1.kvp_value_set("fake.failure", "0.1")
+        exts = ext.api_ext_list()
+        algo.adapt(exts["fake"].pool_get(self.pool1), self.pool1)
+
+    def tearDown(self):
+        """ Remove the pool. """
+
+        try:
+            algo.pool_remove(self.pool_name, True)
+        except models.Pool.DoesNotExist:
+            pass
+        fake = ext.api_ext_list()["fake"]
+        fake.store.get("memory").clear("localhost/" + self.pool_name)
+
+    def churn(self):
+        """ Acquire and release a READY resource so that it is rebuilt.
+
+        @return True if a resource was acquired.
+        """
+
+        rsrc = algo.acquire(algo.candidates(self.pool1), 60)
+        if rsrc is None:
+            return False
+        algo.release(rsrc)
+        return True
+
+    def test_rss(self):
+        """ test_rss. RSS stays flat over many scheduler passes.
+
+        Every pass a READY resource is acquired and released, so the daemon
+        keeps destroying, cloning and reading attributes of resources
+        through the fake driver. One in ten driver calls fail.
+        TESTPOOL_SOAK_TICKS sets the number of passes, make soak runs
+        100000.
+        """
+
+        ticks = int(os.environ["TESTPOOL_SOAK_TICKS"])
+
+        args = FakeArgs()
+        args.count = FOREVER
+        rollup = history.Rollup()
+        health = database.Health(interval=1)
+        calendar = booking.Calendar()
+
+        ##
+        # Run with DEBUG on, the worst case for query bookkeeping. Log
+        # records are dropped, test runners keep every record they capture.
+        logging.disable(logging.CRITICAL)
+        try:
+            with override_settings(DEBUG=True):
+                for _ in range(self.WARMUP_TICKS):
+                    tick(args, rollup, health, calendar)
+                    self.churn()
+                rss = rss_get()
+
+                (fired, acquired) = (0, 0)
+                for _ in range(ticks):
+                    fired += tick(args, rollup, health, calendar)
+                    acquired += self.churn()
+        finally:
+            logging.disable(logging.NOTSET)
+        ##
+
+        self.assertGreater(fired, ticks)
+        self.assertGreater(acquired, ticks / 10)
+        self.assertLess(rss_get() - rss, self.RSS_GROWTH)
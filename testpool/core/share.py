@@ -0,0 +1,146 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Fair share of a pool between tenants.
+
+Acquire requests name a tenant, usually a team or pipeline. A pool may
+give tenants a minimum number of resources which others cannot take from
+them and a maximum they may burst to. Both are pool KVPs:
+
+  tenant.<name>.min - resources kept for the tenant while it holds fewer.
+  tenant.<name>.max - resources the tenant may hold at once.
+
+tenant.*.min and tenant.*.max apply to every tenant without its own
+entry, including requests that name no tenant. A pool without tenant KVPs
+is first come first served.
+
+admit runs in the transaction that reserves the resource. It first locks
+the pool by writing its row, which holds the row lock on server
+databases and the database write lock on sqlite where SELECT ... FOR
+UPDATE does nothing. Concurrent requests for the pool are decided one at
+a time, a request still waiting when the lock times out raises Busy.
+"""
+import logging
+from django.db import OperationalError
+from django.db.models import Count
+from django.db.models import F
+from testpooldb import models
+
+TENANT_PREFIX = "tenant."
+TENANT_ANY = "*"
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OverShare(Exception):
+    """ Tenant may not acquire another resource from the pool now. """
+
+
+class Busy(Exception):
+    """ Other requests held the pool for too long, try again. """
+
+
+# pylint: disable=R0903
+class Share(object):
+    """ Minimum and maximum resources of a tenant. """
+
+    def __init__(self, minimum=0, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+def share_key(tenant, limit):
+    """ Return the pool KVP key of limit min or max of tenant. """
+    return "%s%s.%s" % (TENANT_PREFIX, tenant, limit)
+
+
+def shares_get(pool1):
+    """ Return Share by tenant name configured for pool1.
+
+    Malformed values are logged and ignored.
+    """
+
+    shares = {}
+    for (key, value) in pool1.kvp_values().items():
+        if not key.startswith(TENANT_PREFIX):
+            continue
+        (tenant, _, limit) = key[len(TENANT_PREFIX):].rpartition(".")
+        if not tenant or limit not in ["min", "max"]:
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            LOGGER.error("%s: %s %s must be a number", pool1.name, key, value)
+            continue
+        share = shares.setdefault(tenant, Share())
+        if limit == "min":
+            share.minimum = value
+        else:
+            share.maximum = value
+    return shares
+
+
+def share_set(pool1, tenant, minimum=None, maximum=None):
+    """ Set the minimum and maximum of tenant, None leaves them as is. """
+
+    if minimum is not None:
+        pool1.kvp_value_set(share_key(tenant, "min"), str(minimum))
+    if maximum is not None:
+        pool1.kvp_value_set(share_key(tenant, "max"), str(maximum))
+
+
+def held_get(pool1):
+    """ Return the number of RESERVED resources of pool1 by tenant.
+
+    Released resources kept for their holder are not held.
+    """
+
+    return dict(models.Lease.objects.filter(
+        resource__pool=pool1, released=False,
+        resource__status=models.Resource.RESERVED).values_list(
+            "tenant").annotate(count=Count("resource")))
+
+
+def lock(pool1):
+    """ Hold pool1 until the transaction ends.
+
+    Call in a transaction before any other write, see the module
+    description.
+    @raise Busy when the pool could not be locked.
+    """
+
+    try:
+        models.Pool.objects.filter(id=pool1.id).update(
+            resource_max=F("resource_max"))
+    except OperationalError as arg:
+        raise Busy("pool %s busy %s" % (pool1.name, arg))
+
+
+def admit(pool1, shares, tenant):
+    """ Raise OverShare unless tenant may acquire from pool1.
+
+    Call in a transaction before any other write. A tenant below its
+    minimum is always admitted. Otherwise it is refused at its maximum or
+    when the READY resources left are owed to other tenants below their
+    minimum.
+    @raise Busy when the pool could not be locked.
+    """
+
+    lock(pool1)
+
+    held = held_get(pool1)
+    count = held.get(tenant, 0)
+    share = shares.get(tenant, shares.get(TENANT_ANY, Share()))
+
+    if share.maximum is not None and count >= share.maximum:
+        raise OverShare("tenant %s holds its maximum of %d" %
+                        (tenant, share.maximum))
+    if count < share.minimum:
+        return
+
+    owed = sum(max(other.minimum - held.get(name, 0), 0)
+               for (name, other) in shares.items()
+               if name not in [tenant, TENANT_ANY])
+    if owed and pool1.resource_set.filter(
+            status=models.Resource.READY).count() <= owed:
+        raise OverShare("%d resources kept for tenants below their minimum" %
+                        owed)
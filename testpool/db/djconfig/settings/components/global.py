@@ -9,18 +9,26 @@ import os
 # information. The existance of the mysql configuration file implies that
 # it will become default database.
 CONF = "/etc/testpool/testpool.yml"
-# WSGI_APPLICATION = 'cgi-bin.wsgi.application'
 
 if os.path.exists(CONF):
     DEFAULT_PORT = "8000"
-    #  DEBUG = False
-    DEBUG = True
+    ##
+    # DEBUG keeps every query in memory, tpl-daemon runs for months.
+    DEBUG = False
+    ##
     DATABASES["global"] = {
         'ENGINE': 'django.db.backends.sqlite3',
         ##
         # This must point to the sqllite database built from
         # python ./manage.py init
-        'NAME': os.path.join("/var", "tmp", 'testpooldb.sqlite3')
+        'NAME': os.path.join("/var", "tmp", 'testpooldb.sqlite3'),
+        ##
+        # Connections are kept open between requests and daemon passes.
+        # They are closed after an error the connection does not survive
+        # and tpl-daemon pings them every database.HEALTH_INTERVAL seconds,
+        # the next query reconnects.
+        'CONN_MAX_AGE': None,
+        ##
     }
     DATABASES["default"] = DATABASES["global"]
 
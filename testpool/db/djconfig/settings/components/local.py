@@ -12,6 +12,7 @@ DEFAULT = {
     # This must point to the sqllite database built from
     # python ./manage.py init
     'NAME': os.path.join("/tmp", 'testpooldb.sqlite3'),
+    'CONN_MAX_AGE': None,
 }
 
 if "test" not in sys.argv:
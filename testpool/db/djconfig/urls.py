@@ -16,14 +16,29 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin
 from django.views.generic import RedirectView
-from django.contrib.staticfiles.urls import staticfiles_urlpatterns
+from django.contrib.staticfiles.views import serve
+import testpool_pool.api
 import testpool_pool.urls
+import testpool_resource.api
 import testpool_resource.urls
 
 urlpatterns = [
+    ##
+    # Acquire, release and renew carry most requests so they are matched
+    # first.
+    url(r'^testpool/api/v1/pool/acquire/(?P<pool_name>[\.\w]+)$',
+        testpool_pool.api.pool_acquire),
+    url(r'^testpool/api/v1/pool/release/(?P<rsrc_id>\d+)$',
+        testpool_pool.api.pool_release),
+    url(r'^testpool/api/v1/resource/renew/(?P<rsrc_id>\d+)$',
+        testpool_resource.api.resource_renew),
+    ##
     url(r'^testpool/admin/', include(admin.site.urls)),
     url(r'^testpool/', include(testpool_pool.urls)),
     url(r'^testpool/', include(testpool_resource.urls)),
+    ##
+    # tpl-db serves the dashboard static files itself, production runs
+    # with DEBUG off.
+    url(r'^static/(?P<path>.*)$', serve, {"insecure": True}),
+    ##
 ]
-
-urlpatterns += staticfiles_urlpatterns()
@@ -0,0 +1,14 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+WSGI entry point of the testpool web interface.
+
+tpl-db serve runs it with preforked workers, any other WSGI server can
+load djconfig.wsgi:application.
+"""
+import os
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djconfig.settings")
+
+# pylint: disable=C0103
+application = get_wsgi_application()
@@ -3,23 +3,48 @@
  Holds views for tests results.
 """
 # from django.shortcuts import render
+import json
 import logging
+import datetime
 
 from rest_framework.renderers import JSONRenderer
 from django.http import HttpResponse
 from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.gzip import gzip_page
 from django.core.exceptions import PermissionDenied
+from django.utils.dateparse import parse_datetime
+from testpooldb.models import Booking
 from testpooldb.models import Pool
+from testpooldb.models import PoolSpill
 from testpooldb.models import Resource
-from testpool_pool.views import PoolStats
+from testpooldb.models import Traceback
+from testpool_pool.views import pool_stats_list
+from testpool_pool.cache import generation_cached
+from testpool_pool.idempotency import idempotent
 from testpool_pool.serializers import PoolSerializer
 from testpool_pool.serializers import PoolStatsSerializer
-from testpool_pool.serializers import ResourceSerializer
 import testpool.core.algo
+import testpool.core.booking
+import testpool.core.dbstats
+import testpool.core.history
+import testpool.core.share
+import testpool_pool.render
+import testpool_pool.stream
 
 LOGGER = logging.getLogger("django.testpool")
 
+##
+# Seconds between keepalives on an idle stream.
+STREAM_KEEPALIVE = 15
+##
+
+##
+# Days of bookings listed when no end is given.
+BOOKING_DAYS = 7
+##
+
 
 class JSONResponse(HttpResponse):
     """
@@ -32,6 +57,8 @@ class JSONResponse(HttpResponse):
 
 
 @csrf_exempt
+@gzip_page
+@generation_cached
 def pool_list(request):
     """
     List all code snippets, or create a new snippet.
@@ -40,7 +67,7 @@ def pool_list(request):
     LOGGER.info("testpool_pool.api.pool_list")
 
     if request.method == 'GET':
-        pools = [PoolStats(item) for item in Pool.objects.all()]
+        pools = pool_stats_list(Pool.objects.all())
         serializer = PoolStatsSerializer(pools, many=True)
         return JSONResponse(serializer.data)
     else:
@@ -50,6 +77,7 @@ def pool_list(request):
 
 
 @csrf_exempt
+@generation_cached
 def pool_detail(request, pool_name):
     """ Retrieve specific pool.  """
 
@@ -72,17 +100,196 @@ def pool_detail(request, pool_name):
 
 
 @csrf_exempt
+def pool_history(request, pool_name):
+    """ Return clone time, hold time and utilisation of a pool.
+
+    minutes selects how far back to report, the default is an hour.
+    """
+
+    LOGGER.info("testpool_pool.api.pool_history")
+
+    if request.method != "GET":
+        msg = "pool_history method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+    try:
+        minutes = int(request.GET.get("minutes", 60))
+    except ValueError:
+        msg = "minutes %s must be a number" % request.GET["minutes"]
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=400)
+
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(minutes=minutes)
+    stats = testpool.core.history.stats(pool_name, start, end)
+    stats["utilisation"] = [
+        {"start": item[0], "period": item[1], "utilisation": item[2]}
+        for item in stats["utilisation"]]
+    return JSONResponse(stats)
+
+
+@csrf_exempt
+def pool_group(request, pool_name):
+    """ Return counters of a pool and its fallback pools.
+
+    members holds the counters of each pool in the order acquire tries
+    them, the totals cover the whole group. spilled counts the acquires
+    of the pool each fallback served.
+    """
+
+    LOGGER.info("testpool_pool.api.pool_group")
+
+    if request.method != "GET":
+        msg = "pool_group method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+    try:
+        pool = Pool.objects.get(name=pool_name)
+    except Pool.DoesNotExist:
+        msg = "pool %s not found" % pool_name
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=403)
+
+    pools = [pool] + testpool.core.algo.fallbacks_get(pool)
+    stats = dict((item.id, item) for item in pool_stats_list(
+        Pool.objects.filter(id__in=[item.id for item in pools])))
+    members = PoolStatsSerializer([stats[item.id] for item in pools],
+                                  many=True).data
+
+    content = {"name": pool.name, "members": members}
+    for field in ["resource_max", "rsrc_ready", "rsrc_reserved",
+                  "rsrc_pending"]:
+        content[field] = sum(item[field] for item in members)
+    content["spilled"] = dict(PoolSpill.objects.filter(
+        pool_name=pool.name).values_list("fallback_name", "count"))
+    return JSONResponse(content)
+
+
+@csrf_exempt
+def pool_errors(request, pool_name):
+    """ Return the most recent errors of a pool, newest first. """
+
+    LOGGER.info("testpool_pool.api.pool_errors")
+
+    if request.method != "GET":
+        msg = "pool_errors method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+    errors = Traceback.objects.filter(pool__name=pool_name)
+    errors = errors.order_by("-last_seen").values(
+        "message", "frames", "count", "first_seen", "last_seen")
+    return JSONResponse(list(errors))
+
+
+@csrf_exempt
+def metrics(request):
+    """ Return query counts and database time of this process by view. """
+
+    if request.method != "GET":
+        msg = "metrics method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+    return JsonResponse(testpool.core.dbstats.totals())
+
+
+def _sse(message):
+    """ Return message as a server-sent event. """
+    return "event: %s\ndata: %s\n\n" % (message["type"],
+                                        json.dumps(message))
+
+
+def _ndjson(message):
+    """ Return message as a JSON line. """
+    return json.dumps(message) + "\n"
+
+
+@csrf_exempt
+def pool_stream(request):
+    """ Stream pool counters and resource transitions as they change.
+
+    Server-sent events by default, JSON lines when format is ndjson.
+    @param pool Only report this pool, may be repeated.
+    @param format sse or ndjson.
+    """
+
+    LOGGER.info("testpool_pool.api.pool_stream")
+
+    if request.method != "GET":
+        msg = "pool_stream method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+    if request.GET.get("format", "sse") == "ndjson":
+        (encode, keepalive, content_type) = (_ndjson, "\n",
+                                             "application/x-ndjson")
+    else:
+        (encode, keepalive, content_type) = (_sse, ": keepalive\n\n",
+                                             "text/event-stream")
+    pool_names = set(request.GET.getlist("pool"))
+
+    def _wanted(message):
+        """ Return True if message concerns a requested pool. """
+        if not pool_names:
+            return True
+        return message.get("pool", message.get("name")) in pool_names
+
+    subscription = testpool_pool.stream.PUBLISHER.subscribe()
+
+    def _stream():
+        """ Yield messages until the client goes away. """
+        try:
+            while not subscription.closed:
+                messages = subscription.get(STREAM_KEEPALIVE)
+                if messages is None:
+                    yield keepalive
+                    continue
+                for message in messages:
+                    if _wanted(message):
+                        yield encode(message)
+        finally:
+            testpool_pool.stream.PUBLISHER.unsubscribe(subscription)
+
+    resp = StreamingHttpResponse(_stream(), content_type=content_type)
+    resp["Cache-Control"] = "no-cache"
+    return resp
+
+
+@csrf_exempt
+@idempotent
 def pool_acquire(request, pool_name):
     """
     Ac_seconds quire a Resource that is ready.
 
     @param expiration The mount of time in seconds before entry expires.
+    @param holder Who the resource is leased to, defaults to the client
+                  address. Only an explicit holder reuses a resource it
+                  released, see algo.reuse.
+    @param attr key:value the resource must have, may be repeated.
+    @param spread When true any pool sharing this pool's template may
+                  provide the resource.
+    @param tenant Team or pipeline the resource is counted against when
+                  the pool is shared between tenants.
+    @param fallback When false the fallback pools of the pool are not
+                    tried, see algo.fallbacks_get.
     """
 
     LOGGER.info("pool_acquire %s", pool_name)
     if request.method == 'GET':
         expiration_seconds = request.GET.get("expiration", 10 * 60)
         expiration_seconds = int(expiration_seconds)
+        holder = request.GET.get("holder", request.META.get("REMOTE_ADDR", ""))
+        spread = request.GET.get("spread", "") in ["1", "true", "True"]
+        fallback = request.GET.get("fallback", "1") in ["1", "true", "True"]
+        tenant = request.GET.get("tenant", "")
+        try:
+            attrs = testpool.core.algo.attrs_parse(
+                request.GET.getlist("attr"))
+        except ValueError as arg:
+            logging.error(str(arg))
+            return JsonResponse({"msg": str(arg)}, status=400)
         try:
             pool = Pool.objects.get(name=pool_name)
         except Pool.DoesNotExist:
@@ -92,31 +299,65 @@ def pool_acquire(request, pool_name):
 
         LOGGER.info("pool_acquire found %s", pool_name)
 
+        ##
+        # A resource the holder released within the grace period of the
+        # pool is handed back as it is. Only a holder the client names
+        # itself reuses, clients behind one address are not the same
+        # holder.
+        if "holder" in request.GET and holder and \
+           testpool.core.algo.reuse_grace(pool):
+            rsrc = testpool.core.algo.reuse(pool, holder, attrs,
+                                            expiration_seconds, tenant)
+            if rsrc is not None:
+                LOGGER.info("pool %s resource reused %s", pool_name,
+                            rsrc.name)
+                return testpool_pool.render.resource_response(rsrc)
+        ##
+
+        ##
+        # Reserve the first matching READY resource no one else reserves
+        # first, trying the pool before its fallbacks.
+        fallbacks = []
+        if fallback and not spread:
+            fallbacks = testpool.core.algo.fallbacks_get(pool)
         try:
-            rsrcs = pool.resource_set.filter(status=Resource.READY)
-
-            if rsrcs.count() == 0:
-                msg = "pool_acquire %s all resources taken" % pool_name
-                LOGGER.info(msg)
-                return JsonResponse({"msg": msg}, status=403)
-            ##
-            # Pick the first resource.
-            rsrc = rsrcs[0]
-            ##
-        except Resource.DoesNotExist:
-            msg = "pool %s empty" % pool_name
-            LOGGER.error(msg)
+            rsrc = testpool.core.algo.acquire(
+                testpool.core.algo.candidates(pool, attrs, spread, fallbacks),
+                expiration_seconds, holder, tenant=tenant, pool1=pool)
+        except (Resource.Conflict, testpool.core.share.Busy):
+            msg = "pool_acquire %s busy try again" % pool_name
+            LOGGER.info(msg)
+            return JsonResponse({"msg": msg}, status=409)
+        except testpool.core.share.OverShare as arg:
+            msg = "pool_acquire %s %s" % (pool_name, arg)
+            LOGGER.info(msg)
             return JsonResponse({"msg": msg}, status=403)
 
+        if rsrc is None:
+            msg = "pool_acquire %s all resources taken" % pool_name
+            LOGGER.info(msg)
+            return JsonResponse({"msg": msg}, status=403)
+        if fallbacks:
+            testpool.core.algo.spill_count(pool, rsrc)
         ##
-        # assert resource defined.
-        rsrc.transition(Resource.RESERVED, Resource.ACTION_DESTROY,
-                        expiration_seconds)
 
         ##
-        LOGGER.info("pool %s resource acquired %s", pool_name, rsrc.name)
-        serializer = ResourceSerializer(rsrc)
-        return JSONResponse(serializer.data)
+        # Frozen spares are resumed before handing them out. If that fails
+        # the resource is reclaimed.
+        try:
+            testpool.core.algo.spare_thaw(rsrc.pool, rsrc)
+        except Exception as arg:  # pylint: disable=broad-except
+            LOGGER.exception(arg)
+            rsrc.transition_from((Resource.RESERVED,), Resource.PENDING,
+                                 Resource.ACTION_DESTROY, 1)
+            msg = "pool_acquire %s resource %s failed to resume" % \
+                  (rsrc.pool.name, rsrc.name)
+            return JsonResponse({"msg": msg}, status=500)
+        ##
+
+        LOGGER.info("pool %s resource acquired %s", rsrc.pool.name,
+                    rsrc.name)
+        return testpool_pool.render.resource_response(rsrc)
         ##
     else:
         msg = "pool_acquire method %s unsupported" % request.method
@@ -124,30 +365,180 @@ def pool_acquire(request, pool_name):
         return JsonResponse({"msg": msg}, status=405)
 
 
+def _datetime_get(params, name, default=None):
+    """ Return the datetime of parameter name.
+
+    @raise ValueError when it is missing without a default or malformed.
+    """
+
+    value = params.get(name, None)
+    if value is None:
+        if default is None:
+            raise ValueError("%s required" % name)
+        return default
+    when = parse_datetime(value)
+    if when is None:
+        raise ValueError("%s %s must be YYYY-MM-DDTHH:MM[:SS]" %
+                         (name, value))
+    return when
+
+
+def _booking_content(booking1, rsrcs=None):
+    """ Return booking1 as a dictionary.
+
+    @param rsrcs Resources granted to the booking to include.
+    """
+
+    content = {
+        "id": booking1.id,
+        "pool": booking1.pool.name,
+        "holder": booking1.holder,
+        "tenant": booking1.tenant,
+        "count": booking1.count,
+        "start": booking1.start,
+        "end": booking1.end,
+        "status": booking1.status_str(),
+    }
+    if rsrcs is not None:
+        content["resources"] = [
+            {"id": item.id, "name": item.name, "ip_addr": item.ip_addr}
+            for item in rsrcs]
+    return content
+
+
+@csrf_exempt
+def pool_book(request, pool_name):
+    """ Book resources of a pool for a future window or list bookings.
+
+    POST books count resources over [start, end), end may be given as
+    minutes after start instead.
+
+    @param count Number of resources.
+    @param start When the resources are handed over, YYYY-MM-DDTHH:MM.
+    @param end When the resources are reclaimed.
+    @param minutes Length of the window when end is not given.
+    @param holder Who the resources are leased to, defaults to the client
+                  address.
+    @param tenant Team or pipeline the booking belongs to.
+
+    GET lists bookings overlapping [start, end), by default the next
+    BOOKING_DAYS days.
+    """
+
+    LOGGER.info("testpool_pool.api.pool_book %s", pool_name)
+
+    if request.method not in ["GET", "POST"]:
+        msg = "pool_book method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+    try:
+        pool = Pool.objects.get(name=pool_name)
+    except Pool.DoesNotExist:
+        msg = "pool %s not found" % pool_name
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=403)
+
+    current = datetime.datetime.now()
+    try:
+        if request.method == "GET":
+            start = _datetime_get(request.GET, "start", current)
+            end = _datetime_get(
+                request.GET, "end",
+                start + datetime.timedelta(days=BOOKING_DAYS))
+            bookings = testpool.core.booking.bookings_list(pool, start, end)
+            return JSONResponse([_booking_content(item)
+                                 for item in bookings.select_related("pool")])
+
+        count = int(request.GET.get("count", 1))
+        start = _datetime_get(request.GET, "start")
+        if "end" in request.GET:
+            end = _datetime_get(request.GET, "end")
+        else:
+            end = start + datetime.timedelta(
+                minutes=int(request.GET.get("minutes", 60)))
+        holder = request.GET.get("holder", request.META.get("REMOTE_ADDR", ""))
+        tenant = request.GET.get("tenant", "")
+        booking1 = testpool.core.booking.book(pool, count, start, end, holder,
+                                              tenant)
+    except ValueError as arg:
+        logging.error(str(arg))
+        return JsonResponse({"msg": str(arg)}, status=400)
+    except (testpool.core.booking.BookingConflict,
+            testpool.core.share.Busy) as arg:
+        LOGGER.info(str(arg))
+        return JsonResponse({"msg": str(arg)}, status=409)
+
+    LOGGER.info("pool %s booked %d for %s from %s to %s", pool_name, count,
+                holder, start, end)
+    return JSONResponse(_booking_content(booking1))
+
+
+@csrf_exempt
+def booking_detail(request, booking_id):
+    """ Show a booking with its resources once granted, DELETE cancels it.
+
+    Cancelling a granted booking releases its resources.
+    """
+
+    LOGGER.info("testpool_pool.api.booking_detail %s", booking_id)
+
+    try:
+        booking1 = Booking.objects.select_related("pool").get(id=booking_id)
+    except Booking.DoesNotExist:
+        msg = "booking %s not found" % booking_id
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=403)
+
+    if request.method == "GET":
+        rsrcs = Resource.objects.filter(lease__booking=booking1)
+        return JSONResponse(_booking_content(booking1,
+                                             rsrcs.order_by("name")))
+    elif request.method == "DELETE":
+        if not testpool.core.booking.cancel(booking1):
+            raise PermissionDenied("booking %s already %s" %
+                                   (booking_id, booking1.status_str()))
+        return JSONResponse({"detail": "booking %s cancelled" % booking_id})
+    else:
+        msg = "booking_detail method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+
 @csrf_exempt
+@idempotent
 def pool_release(request, rsrc_id):
-    """ Release Resource. """
+    """ Release Resource.
+
+    Pools with a reuse grace period keep it for its holder, see
+    algo.release.
+    """
 
     LOGGER.info("testpool_pool.api.pool_release %s", rsrc_id)
 
     if request.method == 'GET':
         try:
-            rsrc = Resource.objects.get(id=rsrc_id)
+            rsrc = Resource.objects.select_related("pool").get(id=rsrc_id)
         except Resource.DoesNotExist:
             msg = "pool for %s not found" % rsrc_id
             logging.error(msg)
             return JsonResponse({"msg": msg}, status=403)
 
-        if rsrc.status != Resource.RESERVED:
-            raise PermissionDenied("Resource %s is not reserved" % rsrc_id)
-
         ##
-        # assert rsrc defined.
-        rsrc.transition(Resource.PENDING, Resource.ACTION_DESTROY, 1)
+        # Another release or the daemon reclaiming an expired reservation
+        # may win the race.
+        try:
+            released = testpool.core.algo.release(rsrc)
+        except Resource.Conflict:
+            msg = "pool_release %s busy try again" % rsrc_id
+            LOGGER.info(msg)
+            return JsonResponse({"msg": msg}, status=409)
+        if not released:
+            raise PermissionDenied("Resource %s is not reserved" % rsrc_id)
         ##
-        content = {"detail": "Resource %s released" % rsrc_id}
 
-        return JSONResponse(content)
+        return testpool_pool.render.detail_response(
+            "Resource %s released" % rsrc_id)
     else:
         msg = "pool_release method %s unsupported" % request.method
         logging.error(msg)
@@ -210,11 +601,14 @@ def pool_add(request, pool_name):
     template_name = request.GET["template_name"]
     connection = request.GET["connection"]
     product = request.GET["product"]
+    spare = request.GET.get("spare", None)
+    registry = request.GET.get("registry", None)
 
     try:
         resource_max = int(resource_max)
         pool1 = testpool.core.algo.pool_add(connection, product, pool_name,
-                                            resource_max, template_name)
+                                            resource_max, template_name,
+                                            spare, registry)
         serializer = PoolSerializer(pool1)
 
         return JSONResponse(serializer.data)
@@ -315,11 +709,14 @@ def pool_add(request, pool_name):
     template_name = request.GET["template_name"]
     connection = request.GET["connection"]
     product = request.GET["product"]
+    spare = request.GET.get("spare", None)
+    registry = request.GET.get("registry", None)
 
     try:
         resource_max = int(resource_max)
         pool1 = testpool.core.algo.pool_add(connection, product, pool_name,
-                                            resource_max, template_name)
+                                            resource_max, template_name,
+                                            spare, registry)
         serializer = PoolSerializer(pool1)
 
         return JSONResponse(serializer.data)
@@ -0,0 +1,99 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Serialized responses of the current pool generation.
+
+Pool list and detail only change when models.Generation is bumped. Their
+serialized content is kept here keyed by generation and discarded once a
+later generation is seen. The generation also serves as their ETag so
+clients that saw it get 304 Not Modified.
+"""
+import threading
+from functools import wraps
+from django.db import connection
+from django.http import HttpResponse
+from django.views.decorators.http import condition
+from testpooldb.models import Generation
+
+SIZE = 256
+
+
+class ResponseCache(object):
+    """ Response content of one generation keyed by request. """
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.generation = None
+        self.responses = {}
+
+    def get(self, generation, key):
+        """ Return content or None. """
+
+        with self.lock:
+            if generation != self.generation:
+                return None
+            return self.responses.get(key, None)
+
+    def set(self, generation, key, content):
+        """ Keep content read at generation.
+
+        Content read inside a transaction may not be committed and is not
+        kept.
+        """
+
+        if connection.in_atomic_block:
+            return
+
+        with self.lock:
+            if self.generation is None or generation > self.generation:
+                self.generation = generation
+                self.responses = {}
+            if generation == self.generation and \
+               len(self.responses) < self.size:
+                self.responses[key] = content
+
+    def clear(self):
+        """ Discard every response. """
+
+        with self.lock:
+            self.generation = None
+            self.responses = {}
+
+
+RESPONSES = ResponseCache()
+
+
+def _etag(request, *_, **__):
+    """ Return the generation as the ETag and remember it for the view. """
+
+    request.generation = Generation.get()
+    return str(request.generation)
+
+
+def generation_cached(view):
+    """ Answer GET with 304 or cached content until the generation changes.
+
+    view returns an HttpResponse whose content is kept when its status is
+    200.
+    """
+
+    @wraps(view)
+    def _view(request, *args, **kwargs):
+        """ Return cached content or call view. """
+
+        if request.method != "GET":
+            return view(request, *args, **kwargs)
+
+        key = request.get_full_path()
+        content = RESPONSES.get(request.generation, key)
+        if content is not None:
+            (content, content_type) = content
+            return HttpResponse(content, content_type=content_type)
+
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200:
+            RESPONSES.set(request.generation, key,
+                          (response.content, response["Content-Type"]))
+        return response
+
+    return condition(etag_func=_etag)(_view)
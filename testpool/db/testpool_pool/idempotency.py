@@ -0,0 +1,131 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Replay replies of requests retried with the same idempotency key.
+
+A client that loses the reply to acquire, release or renew cannot tell
+whether the request ran. Sending the same Idempotency-Key header again
+returns the reply of the first request instead of running it twice, so a
+retried acquire does not leave a second resource RESERVED until it
+expires.
+
+Keys are claimed by the client that sent them, the holder the request
+names or else the client address. Another client sending the same key is
+refused rather than given the reply of the first.
+
+Keys and replies are models.RequestKey rows, the daemon evicts them once
+expired.
+"""
+import datetime
+import logging
+from functools import wraps
+from django.db import IntegrityError
+from django.db import transaction
+from django.http import HttpResponse
+from django.http import JsonResponse
+from testpooldb.models import RequestKey
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED = "Idempotent-Replayed"
+
+LOGGER = logging.getLogger("django.testpool")
+
+
+def client_get(request):
+    """ Return who sent request, the holder it names or its address. """
+
+    return request.GET.get("holder", request.META.get("REMOTE_ADDR", ""))
+
+
+def _claim(key, path, client, current):
+    """ Claim key for a request of client to path.
+
+    @return None when claimed, otherwise the RequestKey holding it.
+    """
+
+    ##
+    # Retries are the rare case but replaying them costs a single query.
+    request_key = RequestKey.objects.filter(key=key).first()
+    if request_key is not None:
+        if request_key.expiry > current:
+            return request_key
+        RequestKey.objects.filter(key=key, expiry__lte=current).delete()
+    ##
+
+    expiry = current + datetime.timedelta(seconds=RequestKey.IN_PROGRESS_TTL)
+    try:
+        with transaction.atomic():
+            RequestKey.objects.create(key=key, path=path, client=client,
+                                      expiry=expiry)
+        return None
+    except IntegrityError:
+        ##
+        # Another retry claimed it first.
+        return RequestKey.objects.filter(key=key).first() or \
+            RequestKey(key=key, path=path, client=client, expiry=expiry)
+        ##
+
+
+def _replay(key, request_key, path, client):
+    """ Return the reply stored for key in request_key. """
+
+    if request_key.client != client:
+        msg = "key %s was used by another client" % key
+        return JsonResponse({"msg": msg}, status=422)
+    if request_key.status == RequestKey.IN_PROGRESS:
+        msg = "request %s in progress try again" % key
+        return JsonResponse({"msg": msg}, status=409)
+    if request_key.path != path:
+        msg = "key %s was used for %s" % (key, request_key.path)
+        return JsonResponse({"msg": msg}, status=422)
+
+    response = HttpResponse(request_key.content.encode("utf-8"),
+                            status=request_key.status,
+                            content_type=request_key.content_type)
+    response[REPLAYED] = "true"
+    return response
+
+
+def idempotent(view):
+    """ Replay the reply of view to requests repeating an idempotency key.
+
+    Requests without the Idempotency-Key header run as usual. Only
+    successful replies are kept.
+    """
+
+    @wraps(view)
+    def _view(request, *args, **kwargs):
+        """ Return the stored reply or call view. """
+
+        key = request.META.get(HEADER, "")
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > RequestKey.KEY_MAX:
+            return JsonResponse({"msg": "idempotency key too long"},
+                                status=400)
+
+        path = request.path
+        client = client_get(request)
+        current = datetime.datetime.now()
+        request_key = _claim(key, path, client, current)
+        if request_key is not None:
+            LOGGER.info("replay %s of %s", key, path)
+            return _replay(key, request_key, path, client)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            RequestKey.objects.filter(key=key).delete()
+            raise
+
+        if 200 <= response.status_code < 300 and not response.streaming:
+            expiry = datetime.datetime.now() + \
+                datetime.timedelta(seconds=RequestKey.TTL)
+            RequestKey.objects.filter(key=key).update(
+                status=response.status_code,
+                content=response.content.decode("utf-8"),
+                content_type=response["Content-Type"], expiry=expiry)
+        else:
+            RequestKey.objects.filter(key=key).delete()
+        return response
+
+    return _view
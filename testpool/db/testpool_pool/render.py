@@ -0,0 +1,110 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+JSON of the acquire, release and renew replies.
+
+These replies have a fixed shape so they are formatted directly instead of
+through a DRF serializer and JSONRenderer. The content is byte for byte
+what ResourceSerializer and JSONRenderer, or JsonResponse for renew,
+produce.
+"""
+from json.encoder import encode_basestring
+from django.http import HttpResponse
+from testpool_pool.serializers import KVP_ORDER
+
+##
+# Formats of the compact JSON written by JSONRenderer.
+_RESOURCE = u'{"id":%d,"name":%s,"status":%d,"ip_addr":%s,' \
+            u'"action_time":%s,"kvps":[%s]}'
+_KVP = u'[%s,%s]'
+_DETAIL = u'{"detail":%s}'
+##
+
+##
+# JsonResponse uses the default separators and dictionary order.
+_RENEW = '{"id": %d, "expiry": "%s"}'
+##
+
+CONTENT_TYPE = "application/json"
+
+
+def _string(value):
+    """ Return value as a JSON string or null. """
+
+    if value is None:
+        return u"null"
+    return encode_basestring(unicode(value))
+
+
+def _datetime(value):
+    """ Return value as DRF DateTimeField represents it. """
+
+    if not value:
+        return u"null"
+    value = value.isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return u'"%s"' % value
+
+
+def _encode(content):
+    """ Return content as JSONRenderer encodes it. """
+
+    content = content.replace(u"\u2028", u"\\u2028")
+    content = content.replace(u"\u2029", u"\\u2029")
+    return content.encode("utf-8")
+
+
+def _kvps_get(rsrc):
+    """ Return (key, value) of every resource attribute.
+
+    Attributes already prefetched are used as the serializer would,
+    otherwise they are read in one query in the serializer order.
+    """
+
+    prefetched = getattr(rsrc, "_prefetched_objects_cache", {})
+    if "kvps" in prefetched:
+        return [(item.key.value, item.value) for item in prefetched["kvps"]]
+    return rsrc.kvps.order_by(*KVP_ORDER).values_list("key__value", "value")
+
+
+def resource_render(rsrc):
+    """ Return JSON of ResourceSerializer(rsrc). """
+
+    kvps = u",".join(_KVP % (_string(key), _string(value))
+                     for (key, value) in _kvps_get(rsrc))
+    return _encode(_RESOURCE % (rsrc.id, _string(rsrc.name), rsrc.status,
+                                _string(rsrc.ip_addr),
+                                _datetime(rsrc.action_time), kvps))
+
+
+def detail_render(msg):
+    """ Return JSON of {"detail": msg}. """
+    return _encode(_DETAIL % _string(msg))
+
+
+def renew_render(rsrc_id, expiry):
+    """ Return JSON of JsonResponse({"id": rsrc_id, "expiry": expiry}).
+
+    The expiry is in milliseconds like DjangoJSONEncoder.
+    """
+
+    value = expiry.isoformat()
+    if expiry.microsecond:
+        value = value[:23] + value[26:]
+    return _RENEW % (int(rsrc_id), value)
+
+
+def resource_response(rsrc):
+    """ Return the acquire reply for rsrc. """
+    return HttpResponse(resource_render(rsrc), content_type=CONTENT_TYPE)
+
+
+def detail_response(msg):
+    """ Return a reply holding detail msg. """
+    return HttpResponse(detail_render(msg), content_type=CONTENT_TYPE)
+
+
+def renew_response(rsrc_id, expiry):
+    """ Return the renew reply. """
+    return HttpResponse(renew_render(rsrc_id, expiry),
+                        content_type=CONTENT_TYPE)
@@ -2,16 +2,65 @@
 """
 Pool serializers for model data.
 """
+from django.db.models import Prefetch
+from django.db.models import QuerySet
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
 from testpooldb.models import Pool
 from testpooldb.models import Resource
 from testpooldb.models import Key
+from testpooldb.models import KVP
+
+##
+# Resource attributes are listed by key then value.
+KVP_ORDER = ("key__value", "value")
+##
+
+
+def prefetch(instance, lookups):
+    """ Prefetch lookups for a model instance, list or QuerySet. """
+
+    if not lookups or instance is None:
+        return instance
+    if isinstance(instance, QuerySet):
+        return instance.prefetch_related(*lookups)
+    if isinstance(instance, (list, tuple)):
+        prefetch_related_objects(instance, *lookups)
+    else:
+        prefetch_related_objects([instance], *lookups)
+    return instance
+
+
+class PrefetchSerializer(serializers.ModelSerializer):
+    """ Prefetch PREFETCH relations of what is serialized.
+
+    Serializing one or many instances then takes a constant number of
+    queries.
+    """
+
+    PREFETCH = ()
+
+    def __init__(self, instance=None, *args, **kwargs):
+        instance = prefetch(instance, self.PREFETCH)
+        super(PrefetchSerializer, self).__init__(instance, *args, **kwargs)
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        """ Prefetch for many instances at once. """
+
+        if args:
+            args = (prefetch(args[0], cls.PREFETCH),) + args[1:]
+        elif "instance" in kwargs:
+            kwargs["instance"] = prefetch(kwargs["instance"], cls.PREFETCH)
+        return super(PrefetchSerializer, cls).many_init(*args, **kwargs)
 
 
 # pylint: disable=R0903
-class PoolSerializer(serializers.ModelSerializer):
+class PoolSerializer(PrefetchSerializer):
     """ Serialize PoolModel. """
 
+    PREFETCH = ("kvps",)
+
     class Meta(object):
         """ Define what is in a serialize response. """
 
@@ -38,9 +87,12 @@ class KVPListSerializer(serializers.ModelSerializer):
 
 
 # pylint: disable=R0903
-class ResourceSerializer(serializers.ModelSerializer):
+class ResourceSerializer(PrefetchSerializer):
     """ Serialize Resource. """
 
+    PREFETCH = (Prefetch("kvps", queryset=KVP.objects.select_related(
+        "key").order_by(*KVP_ORDER)),)
+
     kvps = KVPListSerializer(many=True, read_only=True)
 
     class Meta(object):
@@ -38,21 +38,42 @@ function render(categories, available, reserved, pending) {
     });
 }
 
-function ajax_success(json_data) {
+var pools = {};
+var render_pending = false;
+
+function pools_render() {
+    render_pending = false;
+    var json_data = Object.keys(pools).sort().map(name => pools[name]);
     var categories = json_data.map(item => item.name);
     var available = json_data.map(item => item.rsrc_ready);
     var pending = json_data.map(item => item.rsrc_pending);
     var reserved = json_data.map(item => item.rsrc_reserved);
-    var resource_max = json_data.map(item => item.resource_max);
     render(categories, available, reserved, pending);
 }
 
+function pools_changed() {
+    // Render at most once per burst of updates.
+    if (!render_pending) {
+        render_pending = true;
+        setTimeout(pools_render, 250);
+    }
+}
+
 function dashboard_view() {
-  $.ajax({
-      url: 'testpool/api/v1/pool/list',
-      type: "GET",
-      dataType: 'json',
-      success: ajax_success
+    // The server pushes every pool when connected and afterwards only
+    // the pools that changed. EventSource reconnects by itself.
+    var source = new EventSource('testpool/api/v1/pool/stream');
+
+    source.addEventListener("open", function() {
+        pools = {};
+    });
+    source.addEventListener("pool", function(event) {
+        var item = JSON.parse(event.data);
+        pools[item.name] = item;
+        pools_changed();
+    });
+    source.addEventListener("removed", function(event) {
+        delete pools[JSON.parse(event.data).name];
+        pools_changed();
     });
-    setTimeout(dashboard_view, 5000);
 }
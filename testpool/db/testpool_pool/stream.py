@@ -0,0 +1,175 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Stream pool counters and resource transitions.
+
+One Publisher polls the database every interval seconds while anyone is
+subscribed. Each poll reads the pool counters and the transitions recorded
+since the previous poll, whichever process made them, and fans the
+changes out to every subscription. The database cost does not depend on
+the number of subscribers.
+
+Messages are dictionaries with a type:
+  pool       - counters of a pool, sent for every pool on subscribe and
+               afterwards when they change.
+  removed    - name of a pool that was removed.
+  transition - a resource changed status or action.
+"""
+import time
+import Queue
+import logging
+import threading
+from django import db
+from django.db.models import Max
+from testpooldb import models
+from testpool_pool.views import pool_stats_list
+from testpool_pool.serializers import PoolStatsSerializer
+from testpool.core import database
+
+INTERVAL = 1.0
+BACKLOG = 1000
+
+LOGGER = logging.getLogger("django.testpool")
+
+
+class Subscription(object):
+    """ Messages waiting for one subscriber. """
+
+    def __init__(self, backlog):
+        self.queue = Queue.Queue(backlog)
+        self.closed = False
+
+    def get(self, timeout):
+        """ Return the next list of messages or None after timeout. """
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+def _pools_get():
+    """ Return counters of every pool keyed by name. """
+
+    pools = PoolStatsSerializer(pool_stats_list(models.Pool.objects.all()),
+                                many=True).data
+    return dict((item["name"], dict(item, type="pool")) for item in pools)
+
+
+def _transition(event):
+    """ Return message for a ResourceEvent. """
+
+    return {
+        "type": "transition",
+        "id": event.id,
+        "time": event.time.isoformat(),
+        "pool": event.pool_name,
+        "resource": event.resource_name,
+        "status_from": models.Resource.status_to_str(event.status_from),
+        "status": models.Resource.status_to_str(event.status),
+        "action": event.action,
+    }
+
+
+class Publisher(object):
+    """ Poll for changes and fan them out to subscriptions.
+
+    The polling thread runs while there are subscriptions. A subscription
+    that falls backlog messages behind is closed, its client reconnects
+    and starts again from the current counters.
+    """
+
+    def __init__(self, interval=INTERVAL, backlog=BACKLOG):
+        self.interval = interval
+        self.backlog = backlog
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.thread = None
+        self.pools = None
+        self.last_event = 0
+
+    def subscribe(self):
+        """ Return a subscription, its first messages list every pool. """
+
+        subscription = Subscription(self.backlog)
+        with self.lock:
+            if self.pools is None:
+                self.pools = _pools_get()
+                self.last_event = models.ResourceEvent.objects.aggregate(
+                    last=Max("id"))["last"] or 0
+            subscription.queue.put(sorted(self.pools.values(),
+                                          key=lambda item: item["name"]))
+            self.subscriptions.append(subscription)
+            if self.thread is None:
+                self.start()
+        return subscription
+
+    def start(self):
+        """ Start the polling thread. Call with lock held. """
+
+        self.thread = threading.Thread(target=self.run,
+                                       name="testpool.stream")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def unsubscribe(self, subscription):
+        """ Stop sending messages to subscription. """
+
+        with self.lock:
+            subscription.closed = True
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, messages):
+        """ Queue messages for every subscription. Call with lock held. """
+
+        for subscription in list(self.subscriptions):
+            try:
+                subscription.queue.put_nowait(messages)
+            except Queue.Full:
+                LOGGER.info("stream subscriber too slow, closing")
+                subscription.closed = True
+                self.subscriptions.remove(subscription)
+
+    def poll(self):
+        """ Publish changes since the previous poll. Call with lock held. """
+
+        events = list(models.ResourceEvent.objects.filter(
+            id__gt=self.last_event).order_by("id")[:self.backlog])
+        messages = [_transition(item) for item in events]
+        if events:
+            self.last_event = events[-1].id
+
+        pools = _pools_get()
+        for (name, counters) in sorted(pools.items()):
+            if self.pools.get(name) != counters:
+                messages.append(counters)
+        for name in sorted(set(self.pools) - set(pools)):
+            messages.append({"type": "removed", "name": name})
+        self.pools = pools
+
+        if messages:
+            self.publish(messages)
+
+    # pylint: disable=W0703
+    def run(self):
+        """ Poll while there are subscriptions. """
+
+        health = database.Health()
+        try:
+            while True:
+                time.sleep(self.interval)
+                health.tick()
+                with self.lock:
+                    if not self.subscriptions:
+                        self.thread = None
+                        self.pools = None
+                        return
+                    try:
+                        self.poll()
+                    except Exception, arg:
+                        LOGGER.exception(arg)
+        finally:
+            db.connection.close()
+
+
+PUBLISHER = Publisher()
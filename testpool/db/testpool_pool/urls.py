@@ -12,7 +12,18 @@ urlpatterns = [
         api.pool_acquire),
     url(r'api/v1/pool/detail/(?P<pool_name>[\.\w]+$)',
         api.pool_detail),
+    url(r'api/v1/pool/group/(?P<pool_name>[\.\w]+$)',
+        api.pool_group),
+    url(r'api/v1/pool/errors/(?P<pool_name>[\.\w]+$)',
+        api.pool_errors),
+    url(r'api/v1/pool/history/(?P<pool_name>[\.\w]+$)',
+        api.pool_history),
+    url(r'api/v1/pool/book/(?P<pool_name>[\.\w]+$)', api.pool_book),
+    url(r'api/v1/booking/detail/(?P<booking_id>[\d]+$)',
+        api.booking_detail),
     url(r'api/v1/pool/list', api.pool_list),
+    url(r'api/v1/pool/stream', api.pool_stream),
+    url(r'api/v1/metrics', api.metrics),
     url(r'api/v1/pool/remove/(?P<pool_name>[\.\w]+$)',
         api.pool_remove),
     url(r'api/v1/pool/add/(?P<pool_name>[\.\w]+$)',
@@ -19,6 +19,7 @@ View pool information.
 """
 import json
 import logging
+from django.db.models import Count
 from django.shortcuts import render_to_response
 from testpooldb import models
 
@@ -30,8 +31,11 @@ LOGGER = logging.getLogger("django.testpool")
 class PoolStats(object):
     """ Provides individual pool stats used in the pool view. """
 
-    def __init__(self, pool):
-        """Contruct a pool view. """
+    def __init__(self, pool, counts=None):
+        """Contruct a pool view.
+
+        @param counts Resource count by status, read when not given.
+        """
 
         ##
         # pylint: disable=C0103
@@ -41,28 +45,40 @@ class PoolStats(object):
         self.connection = pool.host.connection
         self.name = pool.name
         self.resource_max = pool.resource_max
-        self.rsrc_ready = 0
-        self.rsrc_reserved = 0
-        self.rsrc_pending = 0
-        self.rsrc_bad = 0
-
-        for item in models.Resource.objects.filter(pool=pool):
-            if item.status == models.Resource.RESERVED:
-                self.rsrc_reserved += 1
-            elif item.status == models.Resource.PENDING:
-                self.rsrc_pending += 1
-            elif item.status == models.Resource.READY:
-                self.rsrc_ready += 1
-            elif item.status == models.Resource.BAD:
-                self.rsrc_bad += 1
+
+        if counts is None:
+            counts = status_counts(
+                models.Resource.objects.filter(pool=pool)).get(pool.id, {})
+        self.rsrc_ready = counts.get(models.Resource.READY, 0)
+        self.rsrc_reserved = counts.get(models.Resource.RESERVED, 0)
+        self.rsrc_pending = counts.get(models.Resource.PENDING, 0)
+        self.rsrc_bad = counts.get(models.Resource.BAD, 0)
+
+
+def status_counts(rsrcs):
+    """ Return resource counts keyed by pool id then status. """
+
+    counts = {}
+    rsrcs = rsrcs.order_by().values_list("pool_id", "status")
+    for (pool_id, status, count) in rsrcs.annotate(count=Count("id")):
+        counts.setdefault(pool_id, {})[status] = count
+    return counts
+
+
+def pool_stats_list(pools):
+    """ Return PoolStats of pools with two queries. """
+
+    counts = status_counts(models.Resource.objects.filter(
+        pool__in=pools.values("id")))
+    pools = pools.select_related("host")
+    return [PoolStats(item, counts.get(item.id, {})) for item in pools]
 
 
 def pool_list(_):
     """ Summarize product information. """
     LOGGER.debug("pool")
 
-    pools = models.Pool.objects.all()
-    pools = [PoolStats(item) for item in pools]
+    pools = pool_stats_list(models.Pool.objects.all())
 
     html_data = {"pools": pools}
     return render_to_response("pool/list.html", html_data)
@@ -77,7 +93,8 @@ def detail(_, pool):
     rsrcs = [item for item in models.Host.objects.filter(pool=pool1)]
     html_data = {
         "rsrcs": rsrcs,
-        "pool": pool1
+        "pool": pool1,
+        "errors": pool1.traceback_set.order_by("-last_seen")
     }
 
     return render_to_response("pool/detail.html", html_data)
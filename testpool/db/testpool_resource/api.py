@@ -3,17 +3,42 @@
  Holds views for tests results.
 """
 # from django.shortcuts import render
+import json
 import logging
 
 from rest_framework.renderers import JSONRenderer
 from django.http import HttpResponse
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.core.exceptions import PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.decorators.csrf import csrf_exempt
 from django.http import Http404
+from testpooldb.models import KVP_CACHE
+from testpooldb.models import Lease
 from testpooldb.models import Resource
-from testpool_pool.serializers import ResourceSerializer
+from testpooldb.models import ResourceKVP
+from testpool_pool.idempotency import idempotent
+import testpool_pool.render
+import testpool.core.algo
 
 LOGGER = logging.getLogger("django.testpool")
 
+##
+# Resources per page of resource_list and per query when streaming.
+LIST_LIMIT = 100
+LIST_LIMIT_MAX = 1000
+STREAM_BATCH = 1000
+##
+
+##
+# Resource columns of resource_list, pool and host are joined.
+LIST_FIELDS = ("id", "name", "pool__name", "pool__host__connection",
+               "status", "ip_addr", "action", "action_time")
+LIST_NAMES = ("id", "name", "pool", "connection", "status", "ip_addr",
+              "action", "action_time")
+##
+
 
 class JSONResponse(HttpResponse):
     """
@@ -26,11 +51,14 @@ class JSONResponse(HttpResponse):
 
 
 @csrf_exempt
+@idempotent
 def resource_renew(request, rsrc_id):
     """
     Renew a Resource currently held for testing.
 
+    Only the lease is changed. The reply holds the id and new expiry.
     @param expiration The mount of time in seconds before Resource expires.
+    @param holder When given the lease must belong to holder.
     """
 
     LOGGER.info("profile_renew %s", rsrc_id)
@@ -38,20 +66,121 @@ def resource_renew(request, rsrc_id):
         expiration_seconds = int(request.GET.get("expiration", 10*60))
         LOGGER.info("expiration in seconds %s", expiration_seconds)
 
-        try:
-            rsrc = Resource.objects.get(id=rsrc_id)
-            LOGGER.info("Resource %s found", rsrc.name)
-        except Resource.DoesNotExist:
-            raise Http404("Resource %s not found" % rsrc_id)
+        expiry = Lease.renew(rsrc_id, expiration_seconds,
+                             request.GET.get("holder", None))
+        if expiry is None:
+            if not Resource.objects.filter(id=rsrc_id).exists():
+                raise Http404("Resource %s not found" % rsrc_id)
+            raise PermissionDenied("Resource %s is not reserved" % rsrc_id)
 
-        ##
-        # assert rsrc defined.
-        rsrc.transition(Resource.RESERVED, Resource.ACTION_DESTROY,
-                        expiration_seconds)
-
-        serializer = ResourceSerializer(rsrc)
-        return JSONResponse(serializer.data)
-        ##
+        return testpool_pool.render.renew_response(rsrc_id, expiry)
     else:
         logging.error("profile_acquire method %s unsupported", request.method)
         raise Http404("profile_release method only get supported")
+
+
+def _rsrcs_filter(params):
+    """ Return resources matching the resource_list filters.
+
+    @raise ValueError for a malformed filter.
+    """
+
+    rsrcs = Resource.objects.all()
+    if params.getlist("pool"):
+        rsrcs = rsrcs.filter(pool__name__in=params.getlist("pool"))
+    if params.getlist("status"):
+        rsrcs = rsrcs.filter(status__in=[
+            Resource.status_map(item) for item in params.getlist("status")])
+    if params.getlist("host"):
+        rsrcs = rsrcs.filter(pool__host__connection__in=params.getlist(
+            "host"))
+    if params.get("name"):
+        rsrcs = rsrcs.filter(name__startswith=params["name"])
+
+    attrs = testpool.core.algo.attrs_parse(params.getlist("attr"))
+    if attrs:
+        kvps = KVP_CACHE.kvps_get(attrs, create=False)
+        if len(kvps) < len(set(attrs)):
+            return rsrcs.none()
+        for kvp in kvps.values():
+            rsrcs = rsrcs.filter(kvps=kvp)
+    return rsrcs
+
+
+def _rows(rsrcs, after, limit):
+    """ Return up to limit resources with an id above after.
+
+    Resources are dictionaries in id order. Their attributes are read in
+    one query.
+    """
+
+    rsrcs = rsrcs.filter(id__gt=after).order_by("id")
+    rows = [dict(zip(LIST_NAMES, item)) for item in
+            rsrcs.values_list(*LIST_FIELDS)[:limit]]
+
+    kvps = ResourceKVP.objects.filter(
+        resource_id__in=[item["id"] for item in rows]).order_by(
+            "kvp__key__value", "kvp__value").values_list(
+                "resource_id", "kvp__key__value", "kvp__value")
+    by_rsrc = {}
+    for (rsrc_id, key, value) in kvps:
+        by_rsrc.setdefault(rsrc_id, []).append((key, value))
+
+    for row in rows:
+        row["status"] = Resource.status_to_str(row["status"])
+        row["kvps"] = by_rsrc.get(row["id"], [])
+    return rows
+
+
+@csrf_exempt
+def resource_list(request):
+    """ List resources a page at a time.
+
+    Resources are in id order. A page holds up to limit resources and the
+    cursor of the next page, which is null on the last page. When format
+    is ndjson every matching resource is streamed one per line instead.
+    @param pool Pool name, may be repeated.
+    @param status ready, reserved, pending or bad, may be repeated.
+    @param host Host connection, may be repeated.
+    @param name Prefix of the resource name.
+    @param attr key:value the resource must have, may be repeated.
+    @param cursor Cursor returned with the previous page.
+    @param limit Resources per page, at most 1000.
+    """
+
+    LOGGER.info("testpool_resource.api.resource_list")
+
+    if request.method != "GET":
+        msg = "resource_list method %s unsupported" % request.method
+        logging.error(msg)
+        return JsonResponse({"msg": msg}, status=405)
+
+    try:
+        rsrcs = _rsrcs_filter(request.GET)
+        after = int(request.GET.get("cursor", 0))
+        limit = min(max(int(request.GET.get("limit", LIST_LIMIT)), 1),
+                    LIST_LIMIT_MAX)
+    except ValueError as arg:
+        logging.error(str(arg))
+        return JsonResponse({"msg": str(arg)}, status=400)
+
+    if request.GET.get("format", "json") == "ndjson":
+        def _stream(after):
+            """ Yield every resource a batch at a time. """
+            while True:
+                rows = _rows(rsrcs, after, STREAM_BATCH)
+                for row in rows:
+                    yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+                if len(rows) < STREAM_BATCH:
+                    return
+                after = rows[-1]["id"]
+
+        return StreamingHttpResponse(_stream(after),
+                                     content_type="application/x-ndjson")
+
+    ##
+    # One resource past the page tells whether there is a next page.
+    rows = _rows(rsrcs, after, limit + 1)
+    cursor = str(rows[limit - 1]["id"]) if len(rows) > limit else None
+    return JsonResponse({"results": rows[:limit], "cursor": cursor})
+    ##
@@ -34,6 +34,25 @@ class PoolAdmin(admin.ModelAdmin):
     model = models.Pool
 
 
+class TracebackAdmin(admin.ModelAdmin):
+    """ Recent errors of each pool. """
+
+    model = models.Traceback
+    list_display = ("pool", "message", "count", "first_seen", "last_seen", )
+    list_filter = ("pool", )
+    ordering = ("-last_seen", )
+    readonly_fields = ("fingerprint", "first_seen", "last_seen", "count", )
+
+
+class BookingAdmin(admin.ModelAdmin):
+    """ Advance reservations of each pool. """
+
+    model = models.Booking
+    list_display = ("pool", "holder", "count", "start", "end", "status", )
+    list_filter = ("pool", "status", )
+    ordering = ("start", )
+
+
 class HostAdmin(admin.ModelAdmin):
     """ Administrate testplan content. """
 
@@ -45,3 +64,5 @@ admin.site.register(models.KVP, KVPAdmin)
 admin.site.register(models.Resource, ResourceAdmin)
 admin.site.register(models.Pool, PoolAdmin)
 admin.site.register(models.Host, HostAdmin)
+admin.site.register(models.Traceback, TracebackAdmin)
+admin.site.register(models.Booking, BookingAdmin)
@@ -0,0 +1,90 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Serve the testpool web interface with preforked workers.
+
+Settings come from the tpldb.serve section of testpool.yml, options on the
+command line take precedence. Each worker is replaced after max_requests
+requests, SIGHUP replaces every worker gracefully and loads new code.
+"""
+import multiprocessing
+from django.core.management.base import BaseCommand
+from gunicorn.app.base import BaseApplication
+import testpool.settings
+from testpool.core import cfgcheck
+
+##
+# Defaults of the tpldb.serve section of testpool.yml. Workers run
+# threads so that keep-alive connections and event streams do not hold a
+# whole process.
+SERVE = {
+    "bind": "0.0.0.0:8000",
+    "workers": multiprocessing.cpu_count() + 1,
+    "threads": 4,
+    "max_requests": 10000,
+    "max_requests_jitter": 1000,
+    "keepalive": 5,
+    "timeout": 30,
+    "graceful_timeout": 30,
+}
+##
+
+
+def settings_get(cfg_file):
+    """ Return SERVE updated by the tpldb.serve section of cfg_file. """
+
+    settings = dict(SERVE)
+    cfg = cfgcheck.check(cfg_file)
+    if cfg and cfg.get("tpldb") and cfg.tpldb.get("serve"):
+        settings.update(cfg.tpldb.serve)
+    return settings
+
+
+class Application(BaseApplication):
+    """ Run the WSGI application in preforked gunicorn workers. """
+
+    def __init__(self, settings):
+        self.settings = settings
+        super(Application, self).__init__()
+
+    def init(self, parser, opts, args):
+        """ Nothing to parse, settings are applied by load_config. """
+        # pylint: disable=unused-argument
+
+        return None
+
+    def load_config(self):
+        """ Apply settings. """
+
+        self.cfg.set("worker_class", "gthread")
+        self.cfg.set("proc_name", "tpl-db")
+        for (key, value) in self.settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        """ Return the WSGI application, loaded in every worker. """
+
+        # pylint: disable=C0413
+        from djconfig.wsgi import application
+        return application
+
+
+class Command(BaseCommand):
+    """ tpl-db serve. """
+
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cfg-file", default=testpool.settings.CFG_FILE,
+                            help="Configuration file, default %(default)s.")
+        parser.add_argument("--bind", help="host:port to listen on.")
+        parser.add_argument("--workers", type=int,
+                            help="Number of worker processes.")
+        parser.add_argument("--threads", type=int,
+                            help="Number of threads per worker.")
+
+    def handle(self, *args, **options):
+        settings = settings_get(options["cfg_file"])
+        for key in ["bind", "workers", "threads"]:
+            if options[key] is not None:
+                settings[key] = options[key]
+        Application(settings).run()
@@ -0,0 +1,129 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Measure acquire throughput of tpl-db serve by number of workers.
+
+A fake pool of READY resources is created, then for each worker count a
+server is started and clients acquire from the pool over keep-alive
+connections for a number of seconds. The pool is removed afterwards.
+"""
+import sys
+import time
+import socket
+import signal
+import subprocess
+import multiprocessing
+import requests
+from django.core.management.base import BaseCommand
+from testpooldb import models
+
+POOL_NAME = "servebench"
+
+
+def _acquire(args):
+    """ Acquire from url until deadline, return the number acquired. """
+
+    (url, deadline) = args
+    session = requests.Session()
+    count = 0
+    while time.time() < deadline:
+        resp = session.get(url, params={"expiration": 3600})
+        if resp.status_code == 200:
+            count += 1
+        elif resp.status_code == 403:
+            break
+    return count
+
+
+def _listening(port, timeout):
+    """ Wait until port accepts connections. """
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.2)
+    return False
+
+
+class Command(BaseCommand):
+    """ tpl-db servebench. """
+
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, nargs="+",
+                            default=[1, 2, 4],
+                            help="Worker counts to measure.")
+        parser.add_argument("--clients", type=int, default=8,
+                            help="Concurrent client processes.")
+        parser.add_argument("--seconds", type=int, default=5,
+                            help="Seconds to measure each worker count.")
+        parser.add_argument("--resources", type=int, default=20000,
+                            help="READY resources in the pool.")
+        parser.add_argument("--port", type=int, default=8765)
+
+    def pool_create(self, count):
+        """ Return a fake pool with count READY resources. """
+
+        (host1, _) = models.Host.objects.get_or_create(
+            connection="localhost", product="fake")
+        pool1 = models.Pool.objects.create(
+            name=POOL_NAME, host=host1, resource_max=count,
+            template_name=POOL_NAME)
+        models.Resource.objects.bulk_create(
+            models.Resource(pool=pool1, name="%s.%d" % (POOL_NAME, index),
+                            slot=index, status=models.Resource.READY,
+                            action="none")
+            for index in range(count))
+        return pool1
+
+    @staticmethod
+    def pool_reset(pool1):
+        """ Make every resource READY again. """
+
+        models.Lease.objects.filter(resource__pool=pool1).delete()
+        pool1.resource_set.update(status=models.Resource.READY)
+
+    def measure(self, pool1, workers, options):
+        """ Return acquires per second with workers. """
+
+        self.pool_reset(pool1)
+        server = subprocess.Popen(
+            [sys.executable, sys.argv[0], "serve",
+             "--bind", "127.0.0.1:%d" % options["port"],
+             "--workers", str(workers)])
+        try:
+            if not _listening(options["port"], 30):
+                raise RuntimeError("tpl-db serve did not start")
+
+            url = "http://127.0.0.1:%d/testpool/api/v1/pool/acquire/%s" % \
+                  (options["port"], POOL_NAME)
+            deadline = time.time() + options["seconds"]
+            clients = multiprocessing.Pool(options["clients"])
+            try:
+                start = time.time()
+                counts = clients.map(_acquire, [(url, deadline)] *
+                                     options["clients"])
+                seconds = time.time() - start
+            finally:
+                clients.close()
+                clients.join()
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        return sum(counts) / seconds
+
+    def handle(self, *args, **options):
+        models.Pool.objects.filter(name=POOL_NAME).delete()
+        pool1 = self.pool_create(options["resources"])
+        try:
+            results = [(workers, self.measure(pool1, workers, options))
+                       for workers in options["workers"]]
+        finally:
+            pool1.delete()
+
+        self.stdout.write("%-8s %s" % ("Workers", "Acquires/s"))
+        for (workers, rate) in results:
+            self.stdout.write("%-8d %.1f" % (workers, rate))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 14:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def remove_duplicates(apps, schema_editor):
+    """ Keep the oldest Resource for each (pool, name). """
+
+    Resource = apps.get_model("testpooldb", "Resource")
+    duplicates = Resource.objects.values("pool", "name").annotate(
+        count=models.Count("id"), keep=models.Min("id")).filter(count__gt=1)
+    for item in duplicates:
+        Resource.objects.filter(pool=item["pool"], name=item["name"]).exclude(
+            id=item["keep"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0005_auto_20180812_0020'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='resource',
+            unique_together=set([('pool', 'name')]),
+        ),
+        migrations.AddIndex(
+            model_name='resource',
+            index=models.Index(fields=[b'status', b'action_time'], name='testpooldb__status_d41b5e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resource',
+            index=models.Index(fields=[b'pool', b'status'], name='testpooldb__pool_id_3e925b_idx'),
+        ),
+    ]
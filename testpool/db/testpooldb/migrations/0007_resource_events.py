@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 14:52
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0006_resource_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PoolRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pool_name', models.CharField(max_length=128)),
+                ('period', models.IntegerField(default=60)),
+                ('start', models.DateTimeField()),
+                ('transitions', models.IntegerField(default=0)),
+                ('acquired', models.IntegerField(default=0)),
+                ('released', models.IntegerField(default=0)),
+                ('clone_hist', models.CharField(default=b'', max_length=128)),
+                ('hold_hist', models.CharField(default=b'', max_length=128)),
+                ('reserved', models.IntegerField(default=0)),
+                ('samples', models.IntegerField(default=0)),
+                ('resource_max', models.IntegerField(default=0)),
+                ('last_event', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ResourceEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(db_index=True)),
+                ('pool_name', models.CharField(max_length=128)),
+                ('resource_name', models.CharField(max_length=128)),
+                ('status_from', models.SmallIntegerField()),
+                ('status', models.SmallIntegerField()),
+                ('action', models.CharField(max_length=36)),
+                ('duration', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='resource',
+            name='status_time',
+            field=models.DateTimeField(blank=True, default=datetime.datetime.now, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='poolrollup',
+            unique_together=set([('pool_name', 'period', 'start')]),
+        ),
+    ]
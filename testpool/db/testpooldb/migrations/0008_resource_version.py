@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 15:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0007_resource_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
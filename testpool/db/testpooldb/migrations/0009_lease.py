@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 15:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def lease_reserved(apps, schema_editor):
+    """ Lease existing reservations until their current expiry. """
+
+    Resource = apps.get_model("testpooldb", "Resource")
+    Lease = apps.get_model("testpooldb", "Lease")
+    Lease.objects.bulk_create(
+        Lease(resource=item, expiry=item.action_time)
+        for item in Resource.objects.filter(status=1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0008_resource_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Lease',
+            fields=[
+                ('resource', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='testpooldb.Resource')),
+                ('holder', models.CharField(blank=True, default=b'', max_length=128)),
+                ('expiry', models.DateTimeField(db_index=True)),
+                ('renew_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(lease_reserved, migrations.RunPython.noop),
+    ]
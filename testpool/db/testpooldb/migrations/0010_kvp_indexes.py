@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 16:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0009_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='kvp',
+            index=models.Index(fields=[b'key', b'value'], name='testpooldb__key_id_7acc9e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='kvp',
+            index=models.Index(fields=[b'value'], name='testpooldb__value_1d84cc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='resourcekvp',
+            index=models.Index(fields=[b'kvp', b'resource'], name='testpooldb__kvp_id_c51951_idx'),
+        ),
+    ]
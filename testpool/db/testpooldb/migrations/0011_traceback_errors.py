@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 18:05
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0010_kvp_indexes'),
+    ]
+
+    ##
+    # Tracebacks held one row per frame, they are dropped rather than
+    # converted since they are replaced on the next error.
+    operations = [
+        migrations.DeleteModel(
+            name='Traceback',
+        ),
+        migrations.CreateModel(
+            name='Traceback',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('message', models.TextField()),
+                ('frames', models.TextField(default=b'')),
+                ('count', models.IntegerField(default=1)),
+                ('first_seen', models.DateTimeField(default=datetime.datetime.now)),
+                ('last_seen', models.DateTimeField(default=datetime.datetime.now)),
+                ('pool', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='testpooldb.Pool')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='traceback',
+            unique_together=set([('pool', 'fingerprint')]),
+        ),
+        migrations.AddIndex(
+            model_name='traceback',
+            index=models.Index(fields=[b'pool', b'last_seen'], name='testpooldb__pool_id_69483e_idx'),
+        ),
+    ]
+    ##
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 19:30
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+def slot_set(apps, schema_editor):
+    """ Set slot from the index every driver appends to names. """
+
+    Resource = apps.get_model("testpooldb", "Resource")
+    for (rsrc_id, name) in Resource.objects.values_list("id", "name"):
+        index = name.rsplit(".", 1)[-1]
+        if index.isdigit():
+            Resource.objects.filter(id=rsrc_id).update(slot=int(index))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0011_traceback_errors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='slot',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='resource',
+            name='action_time',
+            field=models.DateTimeField(default=datetime.datetime.now),
+        ),
+        migrations.RunPython(slot_set, migrations.RunPython.noop),
+    ]
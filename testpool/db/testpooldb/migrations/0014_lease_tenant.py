@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 20:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0013_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lease',
+            name='tenant',
+            field=models.CharField(blank=True, default=b'', max_length=128),
+        ),
+    ]
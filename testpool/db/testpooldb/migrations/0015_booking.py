@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 21:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0014_lease_tenant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Booking',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('holder', models.CharField(blank=True, default=b'', max_length=128)),
+                ('tenant', models.CharField(blank=True, default=b'', max_length=128)),
+                ('count', models.IntegerField()),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('status', models.SmallIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pool',
+            name='resource_booked',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='pool',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='testpooldb.Pool'),
+        ),
+        migrations.AddField(
+            model_name='lease',
+            name='booking',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='testpooldb.Booking'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=[b'pool', b'start'], name='testpooldb__pool_id_9e34ee_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=[b'pool', b'end'], name='testpooldb__pool_id_addd63_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=[b'status', b'start'], name='testpooldb__status_3090d6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=[b'status', b'end'], name='testpooldb__status_8f068a_idx'),
+        ),
+    ]
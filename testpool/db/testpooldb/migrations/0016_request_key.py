@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 21:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0015_booking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestKey',
+            fields=[
+                ('key', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('path', models.CharField(max_length=255)),
+                ('status', models.SmallIntegerField(default=0)),
+                ('content', models.TextField(default=b'')),
+                ('content_type', models.CharField(default=b'', max_length=64)),
+                ('expiry', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 22:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0016_request_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PoolSpill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pool_name', models.CharField(max_length=128)),
+                ('fallback_name', models.CharField(max_length=128)),
+                ('count', models.IntegerField(default=0)),
+                ('last', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='poolspill',
+            unique_together=set([('pool_name', 'fallback_name')]),
+        ),
+    ]
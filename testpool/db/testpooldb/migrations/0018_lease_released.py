@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 22:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0017_pool_spill'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lease',
+            name='released',
+            field=models.BooleanField(default=False),
+        ),
+    ]
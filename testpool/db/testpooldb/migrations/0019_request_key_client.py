@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.13 on 2026-10-19 23:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testpooldb', '0018_lease_released'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestkey',
+            name='client',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
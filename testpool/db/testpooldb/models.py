@@ -1,9 +1,18 @@
 # Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
 """ Test schema for tracking tests and their results. """
+import atexit
+import hashlib
 import traceback
 import logging
 import datetime
+import threading
 from django.db import models
+from django.db import DatabaseError
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import signals
+from django.core.signals import request_finished
+from django.db.models import F
 
 LOGGER = logging.getLogger("testpool.db")
 
@@ -46,6 +55,14 @@ class KVP(models.Model):
     key = models.ForeignKey(Key)
     value = models.CharField(max_length=128)
 
+    class Meta(object):
+        """ Indexes for exact and prefix matching. """
+
+        indexes = [
+            models.Index(fields=["key", "value"]),
+            models.Index(fields=["value"]),
+        ]
+
     def __str__(self):
         """ Return testsuite name. """
         return "%s=%s" % (self.key, self.value)
@@ -53,36 +70,187 @@ class KVP(models.Model):
     @staticmethod
     def get(key, value):
         """ Retrieve KVP. """
-        (key, _) = Key.objects.get_or_create(value=key)
-        return KVP.objects.get(key=key, value=value)
+
+        kvps = KVP_CACHE.kvps_get([(key, value)], create=False)
+        if (key, value) not in kvps:
+            raise KVP.DoesNotExist("%s=%s not found" % (key, value))
+        return kvps[(key, value)]
 
     @staticmethod
     def get_or_create(key, value):
         """ Create a single test key objects. """
 
-        (key, _) = Key.objects.get_or_create(value=key)
+        (kvps, created) = KVP_CACHE.kvps_get_or_create([(key, value)])
+        return (kvps[(key, value)], (key, value) in created)
 
-        try:
-            testkey = KVP.objects.get(key=key, value=value)
-            if testkey:
-                return (testkey, False)
-        except KVP.DoesNotExist:
-            pass
+    @staticmethod
+    def filter(match):
+        """ Return KVPs whose key or value matches.
+
+        match is compared exactly, a trailing * matches it as a prefix.
+        Both are range comparisons that search the key and value indexes.
+        """
+
+        if not match:
+            return KVP.objects.all()
+
+        if match.endswith("*"):
+            prefix = match[:-1]
+            end = prefix + u"\uffff"
+            keys = Key.objects.filter(value__gte=prefix, value__lt=end)
+            values = models.Q(value__gte=prefix, value__lt=end)
+        else:
+            keys = Key.objects.filter(value=match)
+            values = models.Q(value=match)
+
+        ##
+        # Keys are matched in a subquery so that both sides of the OR are
+        # on KVP and each can search its own index.
+        return KVP.objects.filter(models.Q(key__in=keys) | values)
+        ##
+
+
+class KVPCache(object):
+    """ Keys and KVPs interned by this process.
+
+    Keys and KVPs are not changed once created. Entries are only added once
+    the transaction that read them commits. Any change or delete in this
+    process clears the cache, entries are also dropped every age seconds
+    to pick up deletes made by other processes.
+    """
+
+    def __init__(self, age=5*60, size=10000):
+        self.age = datetime.timedelta(seconds=age)
+        self.size = size
+        self.keys = {}
+        self.kvps = {}
+        self.expiry = datetime.datetime.now() + self.age
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """ Drop every entry. """
+
+        with self.lock:
+            self.keys = {}
+            self.kvps = {}
+            self.expiry = datetime.datetime.now() + self.age
+
+    def _expire(self):
+        """ Drop every entry when they are too old or too many. """
+
+        if datetime.datetime.now() >= self.expiry or \
+           len(self.kvps) + len(self.keys) > self.size:
+            self.clear()
+
+    def _intern(self, name, found):
+        """ Add found to the name table once committed. """
+
+        def _update():
+            """ Add found. """
+            with self.lock:
+                getattr(self, name).update(found)
+
+        if found:
+            transaction.on_commit(_update)
+
+    def keys_get(self, values, create=True):
+        """ Return Keys by value in at most three queries.
+
+        @param create Create missing keys otherwise they are left out.
+        """
+
+        self._expire()
+        keys = dict((item, self.keys[item]) for item in values
+                    if item in self.keys)
+        missing = set(values) - set(keys)
+        if not missing:
+            return keys
+
+        found = dict((item.value, item) for item in
+                     Key.objects.filter(value__in=missing))
+        if create and len(found) < len(missing):
+            new = missing - set(found)
+            try:
+                with transaction.atomic():
+                    Key.objects.bulk_create(Key(value=item) for item in new)
+            except IntegrityError:
+                ##
+                # Another process created some of them.
+                for item in new:
+                    Key.objects.get_or_create(value=item)
+                ##
+            found = dict((item.value, item) for item in
+                         Key.objects.filter(value__in=missing))
+        self._intern("keys", found)
+        keys.update(found)
+        return keys
+
+    def kvps_get_or_create(self, pairs, create=True):
+        """ Return KVPs by (key, value) and the pairs created.
+
+        A constant number of queries are made however many pairs there
+        are. Values of strict keys are never created.
+        """
+
+        self._expire()
+        pairs = set(pairs)
+        kvps = dict((item, self.kvps[item]) for item in pairs
+                    if item in self.kvps)
+        missing = pairs - set(kvps)
+        if not missing:
+            return (kvps, set())
+
+        keys = self.keys_get(set(item[0] for item in missing), create)
+        found = self._kvps_find(keys, missing)
+        new = set((key, value) for (key, value) in missing - set(found)
+                  if key in keys and
+                  keys[key].config_type == Key.CONFIG_TYPE_ANY)
+        if create and new:
+            KVP.objects.bulk_create(KVP(key=keys[key], value=value)
+                                    for (key, value) in new)
+            found = self._kvps_find(keys, missing)
+        else:
+            new = set()
 
-        if key.config_type != Key.CONFIG_TYPE_ANY:
-            raise KVP.DoesNotExist("key %s is strict" % key)
-        return KVP.objects.get_or_create(key=key, value=value)
+        strict = missing - set(found)
+        if create and strict:
+            raise KVP.DoesNotExist("key %s is strict" % min(strict)[0])
+
+        self._intern("kvps", found)
+        kvps.update(found)
+        return (kvps, new)
+
+    def kvps_get(self, pairs, create=True):
+        """ Return KVPs by (key, value). """
+        return self.kvps_get_or_create(pairs, create)[0]
 
     @staticmethod
-    def filter(contains):
-        """ Filter against a single string. """
+    def _kvps_find(keys, pairs):
+        """ Return stored KVPs for pairs in one query. """
 
-        if not contains:
-            return KVP.objects.all()
+        keys = dict((item.id, item) for item in keys.values())
+        kvps = KVP.objects.filter(key__in=keys,
+                                  value__in=set(item[1] for item in pairs))
+        found = {}
+        for kvp in kvps:
+            kvp.key = keys[kvp.key_id]
+            found.setdefault((kvp.key.value, kvp.value), kvp)
+        return dict((item, found[item]) for item in pairs if item in found)
+
+
+KVP_CACHE = KVPCache()
+
+
+def _kvp_cache_clear(created=False, **_):
+    """ Clear KVP_CACHE when a Key or KVP changes. """
+
+    if not created:
+        KVP_CACHE.clear()
 
-        return KVP.objects.filter(
-            models.Q(key__value__contains=contains) |
-            models.Q(value__contains=contains))
+
+for _sender in [Key, KVP]:
+    signals.post_save.connect(_kvp_cache_clear, sender=_sender)
+    signals.post_delete.connect(_kvp_cache_clear, sender=_sender)
 
 
 class ResourceKVP(models.Model):
@@ -93,11 +261,51 @@ class ResourceKVP(models.Model):
     # pylint: enable=C0103
     kvp = models.ForeignKey(KVP)
 
+    class Meta(object):
+        """ Find resources with an attribute. """
+
+        indexes = [models.Index(fields=["kvp", "resource"])]
+
     def __str__(self):
         """ User representation. """
         return str(self.kvp)
 
 
+class Generation(models.Model):
+    """ Counter bumped whenever pools or resources change.
+
+    Readers compare it with the value they last saw to know whether
+    anything changed, whichever process made the change. A single row
+    with id ID holds the counter.
+    """
+
+    ID = 1
+
+    value = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def bump():
+        """ Increment the counter. """
+
+        if Generation.objects.filter(id=Generation.ID).update(
+                value=F("value") + 1):
+            return
+        try:
+            with transaction.atomic():
+                Generation.objects.create(id=Generation.ID, value=1)
+        except IntegrityError:
+            Generation.objects.filter(id=Generation.ID).update(
+                value=F("value") + 1)
+
+    @staticmethod
+    def get():
+        """ Return the counter. """
+
+        values = Generation.objects.filter(id=Generation.ID).values_list(
+            "value", flat=True)
+        return values.first() or 0
+
+
 class Resource(models.Model):
     """ A single test consisting of one or more results.
     READY - system is ready to be used.
@@ -113,6 +321,13 @@ class Resource(models.Model):
     RESERVED = 1
     BAD = 0
 
+    ##
+    # Resources the daemon has an action for. Listed rather than excluding
+    # READY so that the (status, action_time) index can be searched.
+    NOT_READY = (BAD, RESERVED, PENDING)
+    ##
+    STATUSES = NOT_READY + (READY,)
+
     pool = models.ForeignKey("Pool")
     name = models.CharField(max_length=128)
     status = models.IntegerField(default=PENDING)
@@ -124,23 +339,68 @@ class Resource(models.Model):
     ip_addr = models.CharField(max_length=16, blank=True, null=True)
     ##
     action = models.CharField(max_length=36, default="clone")
-    action_time = models.DateTimeField(auto_now_add=True)
+    action_time = models.DateTimeField(default=datetime.datetime.now)
+    ##
+    # Index within the pool the name was generated from.
+    slot = models.IntegerField(null=True, blank=True)
+    ##
+    # When the resource entered its current status.
+    status_time = models.DateTimeField(null=True, blank=True,
+                                       default=datetime.datetime.now)
+    ##
     kvps = models.ManyToManyField(KVP, through="ResourceKVP")
+    ##
+    # Incremented by every transition. The REST process and the daemon
+    # only change a row if version is unchanged since they read it.
+    version = models.IntegerField(default=0)
+    ##
+
+    class Conflict(Exception):
+        """ Resource changed since it was read. """
+
+    class Meta(object):
+        """ Indexes for the daemon schedule, acquire and name lookups. """
+
+        unique_together = (("pool", "name"),)
+        indexes = [
+            models.Index(fields=["status", "action_time"]),
+            models.Index(fields=["pool", "status"]),
+        ]
 
     def __str__(self):
         """ User representation. """
         return str(self.name)
 
     def release(self):
-        """ Acquire resource. """
+        """ Release resource so that it is destroyed.
+
+        @return False if the resource is no longer reserved.
+        """
 
-        self.status = Resource.PENDING
-        self.save()
+        return self.transition_from((Resource.RESERVED,), Resource.PENDING,
+                                    Resource.ACTION_DESTROY, 0)
 
     def status_as_str(self):
         """ Return status as string. """
         return Resource.status_to_str(self.status)
 
+    def kvps_set(self, attrs):
+        """ Replace the attributes of this resource with the dict attrs.
+
+        The number of queries does not depend on the number of attributes.
+        """
+
+        kvps = KVP_CACHE.kvps_get(attrs.items())
+        wanted = set(item.id for item in kvps.values())
+        current = set(self.resourcekvp_set.values_list("kvp_id", flat=True))
+
+        if current - wanted:
+            self.resourcekvp_set.exclude(kvp_id__in=wanted).delete()
+        if wanted - current:
+            ResourceKVP.objects.bulk_create(
+                ResourceKVP(resource=self, kvp_id=item)
+                for item in wanted - current)
+
     @staticmethod
     def status_to_str(status):
         """ Return string form of the status code. """
@@ -171,34 +431,511 @@ class Resource(models.Model):
             raise ValueError("status %s unknown" % status)
 
     def transition(self, status, action, action_time_delta):
-        """ Transition Resource through states. """
+        """ Transition Resource through states.
+
+        Only status, action and their times are written and only if the
+        row has not changed since it was read. Otherwise Resource.Conflict
+        is raised and nothing is changed.
+        """
 
         LOGGER.info("%s: transition %s to %s in %f (sec)", self.name,
                     Resource.status_to_str(status), action, action_time_delta)
+        current = datetime.datetime.now()
+        delta = datetime.timedelta(seconds=action_time_delta)
+        action_time = current + delta
+        status_time = self.status_time
+        if status != self.status or not status_time:
+            status_time = current
+
+        count = Resource.objects.filter(
+            id=self.id, version=self.version).update(
+                status=status, action=action, action_time=action_time,
+                status_time=status_time, version=F("version") + 1)
+        if not count:
+            LOGGER.info("%s: transition conflict", self.name)
+            raise Resource.Conflict("%s changed since read" % self.name)
+
+        ##
+        # Pool list and detail only show status counts, other changes keep
+        # their cached responses. Retries that only reschedule the action
+        # are not recorded.
+        if status != self.status:
+            Generation.bump()
+        if status != self.status or action != self.action:
+            since = self.status_time if self.status_time else current
+            EVENTS.append(ResourceEvent(
+                time=current, pool_name=self.pool.name,
+                resource_name=self.name, status_from=self.status,
+                status=status, action=action,
+                duration=(current - since).total_seconds()))
+        ##
+
+        ##
+        # A lease ends with the reservation.
+        if self.status == Resource.RESERVED and status != Resource.RESERVED:
+            Lease.objects.filter(resource_id=self.id).delete()
+        ##
+
         self.status = status
         self.action = action
-        delta = datetime.timedelta(seconds=action_time_delta)
-        self.action_time = datetime.datetime.now() + delta
-        self.save()
+        self.action_time = action_time
+        self.status_time = status_time
+        self.version += 1
+
+    def transition_from(self, statuses, status, action, action_time_delta,
+                        retries=3):
+        """ Transition Resource if its status is one of statuses.
+
+        On conflict the row is read again and the transition retried while
+        its status is still one of statuses.
+        @return False if the status is no longer one of statuses or the
+                Resource was deleted.
+        """
+
+        for _ in range(retries):
+            if self.status not in statuses:
+                return False
+            try:
+                self.transition(status, action, action_time_delta)
+                return True
+            except Resource.Conflict:
+                try:
+                    self.refresh_from_db()
+                except Resource.DoesNotExist:
+                    return False
+        raise Resource.Conflict("%s changed %d times" % (self.name, retries))
+
+
+class Lease(models.Model):
+    """ Reservation of a Resource by holder until expiry.
+
+    Renewing only changes this narrow row, the Resource keeps the expiry
+    of the original reservation which the daemon checks against the
+    lease before reclaiming it.
+    """
+
+    resource = models.OneToOneField(Resource, primary_key=True,
+                                    on_delete=models.CASCADE)
+    holder = models.CharField(max_length=128, blank=True, default="")
+    tenant = models.CharField(max_length=128, blank=True, default="")
+    expiry = models.DateTimeField(db_index=True)
+    renew_count = models.IntegerField(default=0)
+    booking = models.ForeignKey("Booking", null=True, blank=True,
+                                on_delete=models.SET_NULL)
+    ##
+    # Set while a released resource is kept for holder until expiry, see
+    # park.
+    released = models.BooleanField(default=False)
+    ##
+
+    def __str__(self):
+        """ User representation. """
+        return "%s %s %s" % (self.resource_id, self.holder, self.expiry)
+
+    @staticmethod
+    def grant(rsrc, holder, expiration_seconds, tenant="", booking=None):
+        """ Lease rsrc to holder of tenant for expiration_seconds.
+
+        @param booking The Booking handing rsrc over, if any.
+        """
+
+        expiry = datetime.datetime.now() + \
+            datetime.timedelta(seconds=expiration_seconds)
+        defaults = {"holder": holder, "tenant": tenant, "expiry": expiry,
+                    "renew_count": 0, "booking": booking, "released": False}
+        (lease, _) = Lease.objects.update_or_create(resource=rsrc,
+                                                    defaults=defaults)
+        return lease
+
+    @staticmethod
+    def renew(rsrc_id, expiration_seconds, holder=None):
+        """ Extend an unexpired lease with a single UPDATE.
+
+        @param holder When given the lease must belong to holder.
+        @return The new expiry or None if there is no such lease.
+        """
+
+        current = datetime.datetime.now()
+        expiry = current + datetime.timedelta(seconds=expiration_seconds)
+        leases = Lease.objects.filter(resource_id=rsrc_id, released=False,
+                                      expiry__gt=current)
+        if holder is not None:
+            leases = leases.filter(holder=holder)
+        count = leases.update(expiry=expiry,
+                              renew_count=F("renew_count") + 1)
+        return expiry if count else None
+
+    @staticmethod
+    def park(rsrc_id, grace_seconds):
+        """ Keep a released resource for its holder for grace_seconds.
+
+        @return True if the resource had an unexpired lease to park.
+        """
+
+        current = datetime.datetime.now()
+        expiry = current + datetime.timedelta(seconds=grace_seconds)
+        return bool(Lease.objects.filter(
+            resource_id=rsrc_id, released=False, expiry__gt=current).update(
+                released=True, expiry=expiry))
+
+    @staticmethod
+    def unpark(rsrc_id, expiration_seconds):
+        """ Lease a parked resource to its holder again.
+
+        @return False if the grace period ended meanwhile.
+        """
+
+        current = datetime.datetime.now()
+        expiry = current + datetime.timedelta(seconds=expiration_seconds)
+        return bool(Lease.objects.filter(
+            resource_id=rsrc_id, released=True, expiry__gt=current).update(
+                released=False, expiry=expiry, renew_count=0))
+
+
+class Booking(models.Model):
+    """ count resources of a pool set aside for holder over [start, end).
+
+    The daemon grows the pool ahead of start so the resources are READY in
+    time, leases them to holder at start until end and then lets the pool
+    shrink back.
+    """
+
+    BOOKED = 0
+    PREWARM = 1
+    GRANTED = 2
+    ENDED = 3
+    CANCELLED = 4
+
+    ##
+    # Bookings which still count against the pool.
+    ACTIVE = (BOOKED, PREWARM, GRANTED)
+    ##
+
+    STATUS_NAMES = {
+        BOOKED: "booked",
+        PREWARM: "prewarm",
+        GRANTED: "granted",
+        ENDED: "ended",
+        CANCELLED: "cancelled",
+    }
+
+    pool = models.ForeignKey("Pool", on_delete=models.CASCADE)
+    holder = models.CharField(max_length=128, blank=True, default="")
+    tenant = models.CharField(max_length=128, blank=True, default="")
+    count = models.IntegerField()
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    status = models.SmallIntegerField(default=BOOKED)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        """ Bookings are found by overlap with a window and by status. """
+
+        ##
+        # Overlap with [start, end) is start < end and end > start, each
+        # bound searches one index. The daemon finds due bookings by
+        # status and start or end.
+        indexes = [
+            models.Index(fields=["pool", "start"]),
+            models.Index(fields=["pool", "end"]),
+            models.Index(fields=["status", "start"]),
+            models.Index(fields=["status", "end"]),
+        ]
+        ##
+
+    def __str__(self):
+        """ User representation. """
+        return "%s %d %s %s" % (self.pool_id, self.count, self.start,
+                                self.end)
+
+    def status_str(self):
+        """ Return string form of the status. """
+        return Booking.STATUS_NAMES[self.status]
+
+
+class RequestKey(models.Model):
+    """ Outcome of a request sent with an idempotency key.
+
+    The key is claimed before the request runs with status IN_PROGRESS
+    and a short expiry. A successful reply is then stored for TTL seconds
+    so a retry with the same key gets the same reply. A failed request
+    removes its key so it can be retried. Only the client that claimed a
+    key gets its reply.
+    """
+
+    IN_PROGRESS = 0
+
+    ##
+    # Seconds a reply is kept and a claimed key waits for its reply.
+    TTL = 60 * 60
+    IN_PROGRESS_TTL = 60
+    ##
+
+    KEY_MAX = 128
+
+    key = models.CharField(max_length=KEY_MAX, primary_key=True)
+    path = models.CharField(max_length=255)
+    ##
+    # The holder named by the request or else the client address.
+    client = models.CharField(max_length=255, blank=True, default="")
+    ##
+    status = models.SmallIntegerField(default=IN_PROGRESS)
+    content = models.TextField(default="")
+    content_type = models.CharField(max_length=64, default="")
+    expiry = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        """ User representation. """
+        return "%s %s %d" % (self.key, self.path, self.status)
+
+    @staticmethod
+    def evict(current=None):
+        """ Remove expired keys, return the number removed. """
+
+        if current is None:
+            current = datetime.datetime.now()
+        return RequestKey.objects.filter(expiry__lte=current).delete()[0]
+
+
+class ResourceEvent(models.Model):
+    """ Append-only record of one Resource transition.
+
+    Pool and resource are stored by name so history outlives them.
+    duration is the time in seconds spent in status_from.
+    """
+
+    time = models.DateTimeField(db_index=True)
+    pool_name = models.CharField(max_length=128)
+    resource_name = models.CharField(max_length=128)
+    status_from = models.SmallIntegerField()
+    status = models.SmallIntegerField()
+    action = models.CharField(max_length=36)
+    duration = models.FloatField(default=0)
+
+    def __str__(self):
+        """ User representation. """
+
+        return "%s %s %s to %s" % (self.time, self.resource_name,
+                                   Resource.status_to_str(self.status_from),
+                                   Resource.status_to_str(self.status))
+
+
+class EventBuffer(object):
+    """ Batch ResourceEvents into a single insert.
+
+    Events are written once size are pending or the oldest is age seconds
+    old. The daemon flushes after each pass and web processes at the end
+    of each request, anything still pending is written at exit.
+    """
+
+    def __init__(self, size=100, age=5):
+        self.size = size
+        self.age = datetime.timedelta(seconds=age)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def append(self, event):
+        """ Add event, flushing when the batch is full or old. """
+
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) < self.size and \
+               event.time - self.events[0].time < self.age:
+                return
+        self.flush()
+
+    def flush(self):
+        """ Write pending events. """
+
+        with self.lock:
+            (events, self.events) = (self.events, [])
+        if events:
+            ResourceEvent.objects.bulk_create(events)
+
+    def discard(self):
+        """ Drop pending events. """
+
+        with self.lock:
+            self.events = []
+
+
+EVENTS = EventBuffer()
+
+
+def _events_flush():
+    """ Write pending events at exit. """
+
+    try:
+        EVENTS.flush()
+    except DatabaseError:
+        LOGGER.exception("events lost at exit")
+
+
+atexit.register(_events_flush)
+
+
+def _request_events_flush(**_):
+    """ Write events of the request so that watchers and rollups see them
+    at once.
+    """
+
+    try:
+        EVENTS.flush()
+    except DatabaseError:
+        LOGGER.exception("events of the request lost")
+
+
+request_finished.connect(_request_events_flush)
+
+
+class PoolSpill(models.Model):
+    """ Acquires of a pool served by one of its fallback pools.
+
+    Pools are stored by name like PoolRollup so counts outlive them.
+    """
+
+    pool_name = models.CharField(max_length=128)
+    fallback_name = models.CharField(max_length=128)
+    count = models.IntegerField(default=0)
+    last = models.DateTimeField()
+
+    class Meta(object):
+        """ One row per pool and fallback. """
+
+        unique_together = (("pool_name", "fallback_name"),)
+
+    def __str__(self):
+        """ User representation. """
+        return "%s %s %d" % (self.pool_name, self.fallback_name, self.count)
+
+    @staticmethod
+    def add(pool_name, fallback_name):
+        """ Count one acquire of pool_name served by fallback_name. """
+
+        current = datetime.datetime.now()
+        if PoolSpill.objects.filter(
+                pool_name=pool_name, fallback_name=fallback_name).update(
+                    count=F("count") + 1, last=current):
+            return
+        try:
+            with transaction.atomic():
+                PoolSpill.objects.create(pool_name=pool_name,
+                                         fallback_name=fallback_name,
+                                         count=1, last=current)
+        except IntegrityError:
+            PoolSpill.objects.filter(
+                pool_name=pool_name, fallback_name=fallback_name).update(
+                    count=F("count") + 1, last=current)
+
+
+class PoolRollup(models.Model):
+    """ Transitions of one pool summarised over one period.
+
+    Periods are a minute or, once downsampled, an hour. Clone and hold times
+    are histograms over BUCKETS so percentiles can be merged and computed
+    without the raw events. Utilisation is the mean sampled reserved count
+    divided by resource_max.
+    """
+
+    MINUTE = 60
+    HOUR = 60*60
+
+    ##
+    # Histogram upper bounds in seconds. The last bucket is unbounded.
+    BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600,
+               2*3600, 4*3600, 8*3600, 24*3600)
+    ##
+
+    pool_name = models.CharField(max_length=128)
+    period = models.IntegerField(default=MINUTE)
+    start = models.DateTimeField()
+    transitions = models.IntegerField(default=0)
+    acquired = models.IntegerField(default=0)
+    released = models.IntegerField(default=0)
+    clone_hist = models.CharField(max_length=128, default="")
+    hold_hist = models.CharField(max_length=128, default="")
+    ##
+    # Sum of reserved resource counts sampled during the period.
+    reserved = models.IntegerField(default=0)
+    samples = models.IntegerField(default=0)
+    resource_max = models.IntegerField(default=0)
+    ##
+    ##
+    # Highest ResourceEvent id summarised here.
+    last_event = models.IntegerField(default=0)
+    ##
+
+    class Meta(object):
+        """ One row per pool and period. """
+
+        unique_together = (("pool_name", "period", "start"),)
+
+    def __str__(self):
+        """ User representation. """
+        return "%s %s %d" % (self.pool_name, self.start, self.period)
+
+    @staticmethod
+    def hist_parse(value):
+        """ Return histogram counts from their stored form. """
+
+        if not value:
+            return [0] * (len(PoolRollup.BUCKETS) + 1)
+        return [int(item) for item in value.split(",")]
+
+    @staticmethod
+    def hist_format(counts):
+        """ Return stored form of histogram counts. """
+        return ",".join(str(item) for item in counts)
+
+    @staticmethod
+    def hist_bucket(seconds):
+        """ Return the histogram bucket for seconds. """
+
+        for (index, bound) in enumerate(PoolRollup.BUCKETS):
+            if seconds <= bound:
+                return index
+        return len(PoolRollup.BUCKETS)
 
 
 class Traceback(models.Model):
-    """ Holds exception.  """
+    """ One error seen while operating on a pool.
+
+    Repeats of an error share a row keyed by fingerprint, count says how
+    often it was seen. Each pool keeps at most HISTORY errors.
+    """
+
+    HISTORY = 20
 
     pool = models.ForeignKey("Pool", on_delete=models.CASCADE)
-    level = models.IntegerField(default=0, null=True)
-    file_name = models.CharField(max_length=128, null=True)
-    lineno = models.IntegerField(default=0, null=True)
-    func_name = models.CharField(max_length=32, null=True)
-    text = models.CharField(max_length=128)
+    fingerprint = models.CharField(max_length=40)
+    message = models.TextField()
+    frames = models.TextField(default="")
+    count = models.IntegerField(default=1)
+    first_seen = models.DateTimeField(default=datetime.datetime.now)
+    last_seen = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta(object):
+        """ One row per error of a pool, newest found by last_seen. """
+
+        unique_together = (("pool", "fingerprint"),)
+        indexes = [models.Index(fields=["pool", "last_seen"])]
+
+    @staticmethod
+    def fingerprint_get(msg, frames):
+        """ Return fingerprint of an error.
+
+        Line numbers are left out so an error keeps its fingerprint when
+        unrelated lines of the file change.
+        """
+
+        value = (msg, [(file_name, func_name, text)
+                       for (file_name, _, func_name, text) in frames])
+        return hashlib.sha1(repr(value)).hexdigest()
 
     def __str__(self):
         """ User representation. """
 
-        if self.file_name and self.lineno and self.func_name:
-            return "File %s, line %d, in %s\n    %s" % \
-                   (self.file_name, self.lineno, self.func_name, self.text)
-        return self.text
+        return "%s%s" % (self.frames, self.message)
 
 
 class PoolKVP(models.Model):
@@ -244,6 +981,10 @@ class Pool(models.Model):
     template_name = models.CharField(max_length=128)
     kvps = models.ManyToManyField(KVP, through="PoolKVP")
     resource_max = models.IntegerField(default=1)
+    ##
+    # Resources added for bookings about to start or running.
+    resource_booked = models.IntegerField(default=0)
+    ##
     expiration = models.IntegerField(default=10*60)
 
     status = models.IntegerField(default=READY)
@@ -261,22 +1002,44 @@ class Pool(models.Model):
 
         return self.resource_max - self.resource_available()
 
+    def resource_size(self):
+        """ Number of resources the pool should hold now. """
+
+        return self.resource_max + self.resource_booked
+
     def stacktrace_set(self, msg, stack_trace):
-        """ Store the exception received while operating on a pool. """
+        """ Store the exception received while operating on a pool.
+
+        A repeated error costs a single update. A new error is inserted
+        and the oldest errors beyond Traceback.HISTORY are removed.
+        """
 
-        self.save()
+        frames = traceback.extract_tb(stack_trace)
+        fingerprint = Traceback.fingerprint_get(msg, frames)
+        now = datetime.datetime.now()
 
-        for exception in self.traceback_set.all():
-            exception.delete()
+        errors = Traceback.objects.filter(pool=self, fingerprint=fingerprint)
+        if errors.update(count=F("count") + 1, last_seen=now):
+            return
 
-        self.traceback_set.create(level=0, file_name=None, lineno=None,
-                                  func_name=None, text=msg)
-        level = 1
-        for frame in traceback.extract_tb(stack_trace):
-            fname, lineno, fn, text = frame
-            self.traceback_set.create(level=level, file_name=fname,
-                                      lineno=lineno, func_name=fn, text=text)
-            level += 1
+        try:
+            with transaction.atomic():
+                Traceback.objects.create(
+                    pool=self, fingerprint=fingerprint, message=msg,
+                    frames="".join(traceback.format_list(frames)),
+                    first_seen=now, last_seen=now)
+        except IntegrityError:
+            ##
+            # Another process stored the same error first.
+            errors.update(count=F("count") + 1, last_seen=now)
+            return
+            ##
+
+        expired = list(self.traceback_set.order_by(
+            "-last_seen", "-id").values_list("id", flat=True)[
+                Traceback.HISTORY:])
+        if expired:
+            Traceback.objects.filter(id__in=expired).delete()
 
     def __contains__(self, srch):
         """ Return True if srch can be found in this object. """
@@ -320,13 +1083,47 @@ class Pool(models.Model):
     def kvp_get_or_create(self, kvp):
         """ Add kvp to pool. """
 
+        self.kvp_values_clear()
+        return self.poolkvp_set.get_or_create(kvp=kvp)
+
+    def kvp_value_set(self, key, value):
+        """ Set value of key replacing any previous value. """
+
+        self.kvp_values_clear()
+        (kvp, _) = KVP.get_or_create(key, value)
+        self.poolkvp_set.filter(kvp__key__value=key).exclude(kvp=kvp).delete()
         return self.poolkvp_set.get_or_create(kvp=kvp)
 
+    def kvp_values(self):
+        """ Return dict of every pool key and value.
+
+        They are read in one query the first time and kept by this
+        instance until changed through it.
+        """
+
+        values = getattr(self, "_kvp_values", None)
+        if values is None:
+            kvps = self.poolkvp_set.select_related("kvp__key")
+            values = dict((item.kvp.key.value, item.kvp.value)
+                          for item in kvps)
+            self._kvp_values = values  # pylint: disable=W0201
+        return values
+
+    def kvp_values_clear(self):
+        """ Read pool keys and values again on next use. """
+        self._kvp_values = None  # pylint: disable=W0201
+
     def kvp_value_get(self, key, default=None):
         """ Return value given key. """
 
-        try:
-            kvp = self.poolkvp_set.get(kvp__key__value=key)
-            return kvp.kvp.value
-        except PoolKVP.DoesNotExist:
-            return default
+        return self.kvp_values().get(key, default)
+
+
+def _generation_bump(**_):
+    """ Bump Generation when a pool or resource is saved or deleted. """
+    Generation.bump()
+
+
+for _sender in [Pool, PoolKVP, Resource]:
+    signals.post_save.connect(_generation_bump, sender=_sender)
+    signals.post_delete.connect(_generation_bump, sender=_sender)
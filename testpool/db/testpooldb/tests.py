@@ -2,15 +2,54 @@
 """
   Create your tests here.
 """
+import os
 import sys
+import json
+import argparse
+import time
+import datetime
+import threading
+import sqlite3
+import tempfile
 
+from django.db import connection
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.test.utils import CaptureQueriesContext
+from django.db import IntegrityError
+from django.db.models import F
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.http import JsonResponse
+from rest_framework.renderers import JSONRenderer
 from .models import Pool
 from .models import Key
 from .models import KVP
 from .models import Host
 from .models import Resource
 from .models import ResourceKVP
+from .models import Lease
+from .models import Traceback
+from .models import KVP_CACHE
+from .models import ResourceEvent
+from .models import PoolRollup
+from .models import EVENTS
+from .models import Generation
+from .models import Booking
+from .models import RequestKey
+from .models import PoolSpill
+from testpool.core import algo
+from testpool.core import history
+from testpool.core import share
+from testpool.core import booking
+from testpool.core import resource
+from testpool.libexec.fake import api as fake_api
+from testpool.libexec.fake import store
+from testpool_pool.serializers import ResourceSerializer
+from testpool_pool import stream
+from testpool_pool.cache import RESPONSES
+from testpool_pool import render
+from testpool_pool import idempotency
 
 
 class Testsuite(TestCase):
@@ -34,6 +73,10 @@ class Testsuite(TestCase):
         self.assertEqual(pool1.kvp_value_get("key1"), "value1")
         self.assertEqual(pool1.kvp_value_get("key2"), "value2")
 
+        pool1.kvp_value_set("key1", "value3")
+        self.assertEqual(pool1.kvp_value_get("key1"), "value3")
+        self.assertEqual(pool1.poolkvp_set.count(), 2)
+
     def test_resource(self):
         """ Generate several resource instances. """
 
@@ -65,9 +108,10 @@ class Testsuite(TestCase):
         rsrc = Resource.objects.create(pool=pool1,
                                        name="template.ubuntu1404.0",
                                        status=Resource.PENDING)
-        self.assertTrue(rsrc1)
+        self.assertTrue(rsrc)
         (kvp, _) = KVP.get_or_create("key1", "value1")
-        ResourceKVP.objects.create(vm=rsrc, kvp=kvp)
+        ResourceKVP.objects.create(resource=rsrc, kvp=kvp)
+        self.assertEqual(list(rsrc.kvps.all()), [kvp])
 
     def test_exception(self):
         """ Test storing an exception in a pool. """
@@ -79,11 +123,1975 @@ class Testsuite(TestCase):
                                     expiration=10*60*60)
         self.assertTrue(pool1)
 
+        def _fail(msg):
+            """ Store an error raised with msg. """
+            try:
+                raise ValueError(msg)
+            except ValueError, arg:
+                stack_trace = sys.exc_info()[2]
+                pool1.stacktrace_set(str(arg), stack_trace)
+
+        ##
+        # A repeated error is a single update of one row.
+        _fail("error0")
+        with self.assertNumQueries(1):
+            _fail("error0")
+        errors = pool1.traceback_set.all()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].count, 2)
+        self.assertIn("raise ValueError(msg)", str(errors[0]))
+        ##
+
+        ##
+        # Only the most recent errors are kept.
+        for item in range(Traceback.HISTORY + 5):
+            _fail("error%d" % (item + 1))
+        self.assertEqual(pool1.traceback_set.count(), Traceback.HISTORY)
+        self.assertFalse(pool1.traceback_set.filter(message="error0"))
+        ##
+
+        resp = self.client.get("/testpool/api/v1/pool/errors/pool1")
+        self.assertEqual(resp.status_code, 200)
+        errors = json.loads(resp.content)
+        self.assertEqual(len(errors), Traceback.HISTORY)
+        self.assertEqual(errors[0]["message"],
+                         "error%d" % (Traceback.HISTORY + 5))
+        self.assertEqual(errors[0]["count"], 1)
+
+
+class QueryPlanTestsuite(TestCase):
+    """ Hot queries search indexes instead of scanning Resource. """
+
+    ROWS = 100000
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Fill Resource table. """
+
+        host1 = Host.objects.create(connection="localhost")
+        pools = [Pool.objects.create(name="pool%d" % item, host=host1,
+                                     resource_max=cls.ROWS / 10,
+                                     template_name="template%d" % item)
+                 for item in range(10)]
+        statuses = [Resource.READY, Resource.PENDING, Resource.RESERVED]
+        Resource.objects.bulk_create(
+            Resource(pool=pools[item % 10], name="template.%d" % item,
+                     status=statuses[item % 3])
+            for item in range(cls.ROWS))
+
+        cursor = connection.cursor()
+        cursor.execute("ANALYZE")
+
+    def plan_get(self, queryset):
+        """ Return the query plan of queryset. """
+
+        (sql, params) = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assert_search(self, queryset):
+        """ Assert no full table scan of Resource. """
+
+        if connection.vendor != "sqlite":
+            self.skipTest("query plan checked only for sqlite")
+
+        plan = self.plan_get(queryset)
+        self.assertTrue(any("INDEX" in row for row in plan), plan)
+        for row in plan:
+            self.assertFalse(row.startswith("SCAN") and "INDEX" not in row,
+                             plan)
+
+    def test_schedule(self):
+        """ test_schedule. Daemon picks the next action. """
+
+        rsrcs = Resource.objects.filter(status__in=Resource.NOT_READY)
+        self.assert_search(rsrcs.order_by("action_time"))
+
+    def test_acquire(self):
+        """ test_acquire. Pick a READY resource from a pool. """
+
+        pool1 = Pool.objects.get(name="pool1")
+        self.assert_search(pool1.resource_set.filter(status=Resource.READY))
+
+    def test_name(self):
+        """ test_name. adapt and setup lookup by pool and name. """
+
+        pool1 = Pool.objects.get(name="pool1")
+        self.assert_search(Resource.objects.filter(pool=pool1,
+                                                   name="template.1"))
+
+    def test_attr(self):
+        """ test_attr. Acquire with attribute constraints. """
+
+        pool1 = Pool.objects.get(name="pool1")
+        (kvp, _) = KVP.get_or_create("os", "ubuntu")
+        ResourceKVP.objects.create(resource=pool1.resource_set.first(),
+                                   kvp=kvp)
+        self.assert_search(algo.candidates(pool1, [("os", "ubuntu")]))
+
+    def test_kvp_filter(self):
+        """ test_kvp_filter. Exact and prefix matching. """
+
+        self.assert_search(KVP.filter("ubuntu"))
+        self.assert_search(KVP.filter("ubu*"))
+
+    def test_unique(self):
+        """ test_unique. Name is unique within a pool. """
+
+        pool1 = Pool.objects.get(name="pool1")
+        with self.assertRaises(IntegrityError):
+            Resource.objects.create(pool=pool1, name="template.1")
+
+
+class HistoryTestsuite(TestCase):
+    """ Transitions are recorded and summarised. """
+
+    def setUp(self):
+        """ Create a pool with one resource. """
+
+        EVENTS.discard()
+        host1 = Host.objects.create(connection="localhost")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        self.rsrc = Resource.objects.create(pool=self.pool1,
+                                            name="template.0",
+                                            status=Resource.PENDING)
+
+    def age(self, seconds):
+        """ Pretend resource entered its status seconds ago. """
+
+        self.rsrc.status_time = datetime.datetime.now() - \
+            datetime.timedelta(seconds=seconds)
+
+    def test_events(self):
+        """ test_events. Rescheduling is not recorded. """
+
+        self.rsrc.transition(Resource.PENDING, "attr", 1)
+        self.rsrc.transition(Resource.PENDING, "attr", 1)
+        self.rsrc.transition(Resource.READY, "none", 1)
+        self.assertEqual(ResourceEvent.objects.count(), 0)
+        EVENTS.flush()
+
+        events = ResourceEvent.objects.order_by("id")
+        self.assertEqual([(item.status_from, item.status, item.action)
+                          for item in events],
+                         [(Resource.PENDING, Resource.PENDING, "attr"),
+                          (Resource.PENDING, Resource.READY, "none")])
+
+    def test_request_flush(self):
+        """ test_request_flush. Events are written when a request ends. """
+
+        self.rsrc.transition(Resource.READY, "none", 1)
+        self.assertEqual(ResourceEvent.objects.count(), 0)
+        resp = self.client.get("/testpool/api/v1/pool/history/pool1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(ResourceEvent.objects.count(), 1)
+
+    def test_rollup(self):
+        """ test_rollup. Clone and hold times from rollups. """
+
+        self.age(25)
+        self.rsrc.transition(Resource.READY, "none", 1)
+        self.rsrc.transition(Resource.RESERVED, "destroy", 1)
+        self.age(100)
+        self.rsrc.transition(Resource.PENDING, "destroy", 1)
+
+        current = datetime.datetime.now()
+        self.assertEqual(history.rollup(current), 3)
+        self.assertEqual(history.rollup(current), 0)
+
+        start = current - datetime.timedelta(hours=1)
+        end = current + datetime.timedelta(hours=1)
+        stats = history.stats("pool1", start, end)
+        self.assertEqual(stats["clone"], {"count": 1, "p50": 30, "p99": 30})
+        self.assertEqual(stats["hold"], {"count": 1, "p50": 120, "p99": 120})
+        self.assertEqual(stats["acquired"], 1)
+        self.assertEqual(stats["released"], 1)
+        self.assertEqual([item[2] for item in stats["utilisation"]], [0.0])
+
+        ##
+        # Reserved resources count towards utilisation, this is the third
+        # sample and the first with one of two resources reserved.
+        self.rsrc.transition(Resource.RESERVED, "destroy", 1)
+        history.rollup(current)
+        stats = history.stats("pool1", start, end)
+        self.assertEqual(len(stats["utilisation"]), 1)
+        self.assertAlmostEqual(stats["utilisation"][0][2], 1.0 / 6)
+        ##
+
+        ##
+        # Days later minutes are merged into hours and events removed.
+        later = current + history.MINUTE_RETENTION + \
+            datetime.timedelta(hours=1)
+        history.rollup(later)
+        self.assertEqual(ResourceEvent.objects.count(), 0)
+        self.assertFalse(PoolRollup.objects.filter(
+            period=PoolRollup.MINUTE, start__lt=end).exists())
+        stats = history.stats("pool1", start, end)
+        self.assertEqual(stats["clone"]["count"], 1)
+        self.assertEqual(stats["acquired"], 2)
+        ##
+
+    def test_rest(self):
+        """ test_rest. Report pool history. """
+
+        self.age(3)
+        self.rsrc.transition(Resource.READY, "none", 1)
+        history.rollup()
+
+        resp = self.client.get("/testpool/api/v1/pool/history/pool1")
+        self.assertEqual(resp.status_code, 200)
+        content = json.loads(resp.content)
+        self.assertEqual(content["clone"]["p50"], 5)
+        self.assertEqual(len(content["utilisation"]), 1)
+
+        resp = self.client.get("/testpool/api/v1/pool/history/pool1",
+                               {"minutes": "x"})
+        self.assertEqual(resp.status_code, 400)
+
+
+class StaleQuerySet(object):
+    """ Resources another process changes right after they are read. """
+
+    def __init__(self, rsrcs, name):
+        self.rsrcs = rsrcs
+        self.name = name
+
+    def exclude(self, **kwargs):
+        """ Return resources excluding kwargs. """
+        return StaleQuerySet(self.rsrcs.exclude(**kwargs), self.name)
+
+    def first(self):
+        """ Return the first resource, changing it if it is name. """
+
+        rsrc = self.rsrcs.first()
+        if rsrc and rsrc.name == self.name:
+            Resource.objects.filter(id=rsrc.id).update(
+                version=F("version") + 1)
+        return rsrc
+
+
+class ConcurrencyTestsuite(TestCase):
+    """ Transitions from stale copies of a Resource conflict. """
+
+    def setUp(self):
+        """ Create a pool with two READY resources. """
+
+        host1 = Host.objects.create(connection="localhost")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        for item in range(2):
+            Resource.objects.create(pool=self.pool1, name="template.%d" % item,
+                                    status=Resource.READY, action="none")
+
+    def test_conflict(self):
+        """ test_conflict. The second writer loses. """
+
+        rsrc1 = Resource.objects.get(name="template.0")
+        rsrc2 = Resource.objects.get(name="template.0")
+
+        rsrc1.transition(Resource.RESERVED, "destroy", 60)
+        with self.assertRaises(Resource.Conflict):
+            rsrc2.transition(Resource.PENDING, "destroy", 1)
+
+        rsrc = Resource.objects.get(name="template.0")
+        self.assertEqual(rsrc.status, Resource.RESERVED)
+        self.assertEqual(rsrc.version, 1)
+
+    def test_transition_from(self):
+        """ test_transition_from. Retry only while status is expected. """
+
+        rsrc1 = Resource.objects.get(name="template.0")
+        rsrc2 = Resource.objects.get(name="template.0")
+        rsrc1.transition(Resource.RESERVED, "destroy", 60)
+
+        ##
+        # Renewed by rsrc1, rsrc2 still releases the reservation.
+        rsrc3 = Resource.objects.get(name="template.0")
+        rsrc1.transition(Resource.RESERVED, "destroy", 60)
+        self.assertTrue(rsrc3.transition_from((Resource.RESERVED,),
+                                              Resource.PENDING, "destroy", 1))
+        ##
+
+        ##
+        # Already released.
+        self.assertFalse(rsrc2.transition_from((Resource.READY,),
+                                               Resource.RESERVED, "destroy",
+                                               60))
+        self.assertFalse(rsrc1.transition_from((Resource.RESERVED,),
+                                               Resource.PENDING, "destroy",
+                                               1))
+        ##
+
+    def test_acquire(self):
+        """ test_acquire. A resource taken meanwhile is skipped. """
+
+        rsrcs = self.pool1.resource_set.filter(status=Resource.READY)
+        rsrcs = rsrcs.order_by("name")
+
+        rsrc = algo.acquire(StaleQuerySet(rsrcs, "template.0"), 60)
+        self.assertEqual(rsrc.name, "template.1")
+        self.assertEqual(algo.acquire(rsrcs, 60).name, "template.0")
+        self.assertIsNone(algo.acquire(rsrcs, 60))
+
+    def test_rest(self):
+        """ test_rest. Release and renew only apply to reservations. """
+
+        rsrc = Resource.objects.get(name="template.0")
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc.id
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        resp = self.client.get("/testpool/api/v1/pool/acquire/pool1")
+        self.assertEqual(resp.status_code, 200)
+        rsrc_id = json.loads(resp.content)["id"]
+
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc_id
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        url = "/testpool/api/v1/pool/release/%d" % rsrc_id
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class LeaseTestsuite(TestCase):
+    """ Renewals only change the lease. """
+
+    def setUp(self):
+        """ Create a pool with one READY resource. """
+
+        host1 = Host.objects.create(connection="localhost")
+        pool1 = Pool.objects.create(name="pool1", host=host1, resource_max=1,
+                                    template_name="template")
+        Resource.objects.create(pool=pool1, name="template.0",
+                                status=Resource.READY, action="none")
+
+    def acquire(self):
+        """ Acquire the resource for holder1. """
+
+        resp = self.client.get("/testpool/api/v1/pool/acquire/pool1",
+                               {"holder": "holder1"})
+        self.assertEqual(resp.status_code, 200)
+        return Resource.objects.get(id=json.loads(resp.content)["id"])
+
+    def test_renew(self):
+        """ test_renew. """
+
+        rsrc = self.acquire()
+        lease = Lease.objects.get(resource=rsrc)
+        self.assertEqual(lease.holder, "holder1")
+
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc.id
+        resp = self.client.get(url, {"expiration": 100, "holder": "holder1"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sorted(json.loads(resp.content)), ["expiry", "id"])
+
+        resp = self.client.get(url, {"holder": "holder2"})
+        self.assertEqual(resp.status_code, 403)
+
+        self.assertEqual(Lease.objects.get(resource=rsrc).renew_count, 1)
+        self.assertEqual(Resource.objects.get(id=rsrc.id).version,
+                         rsrc.version)
+
+        url = "/testpool/api/v1/pool/release/%d" % rsrc.id
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse(Lease.objects.filter(resource=rsrc).exists())
+
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc.id
+        self.assertEqual(self.client.get(url).status_code, 403)
+        url = "/testpool/api/v1/resource/renew/%d" % (rsrc.id + 1)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_sweep(self):
+        """ test_sweep. Expired leases are reclaimed. """
+
+        rsrc = self.acquire()
+        self.assertEqual(algo.lease_sweep(), 0)
+
+        Lease.objects.filter(resource=rsrc).update(
+            expiry=datetime.datetime.now())
+        self.assertEqual(algo.lease_sweep(), 1)
+
+        rsrc = Resource.objects.get(id=rsrc.id)
+        self.assertEqual(rsrc.status, Resource.PENDING)
+        self.assertEqual(rsrc.action, Resource.ACTION_DESTROY)
+        self.assertFalse(Lease.objects.exists())
+
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc.id
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_reserve(self):
+        """ test_reserve. Manual reservations expire only when asked. """
+
+        parser = argparse.ArgumentParser()
+        resource.add_subparser(parser.add_subparsers())
+        args = parser.parse_args(["resource", "reserve", "pool1",
+                                  "template.0"])
+        self.assertEqual(args.func(args), 0)
+        rsrc = Resource.objects.get(name="template.0")
+        self.assertEqual(rsrc.status, Resource.RESERVED)
+        self.assertEqual(rsrc.action, algo.ACTION_NONE)
+        self.assertGreater(rsrc.action_time, datetime.datetime.now() +
+                           datetime.timedelta(days=365))
+        self.assertFalse(Lease.objects.exists())
+
+        args = parser.parse_args(["resource", "reserve", "pool1",
+                                  "template.0", "--expiration", "100",
+                                  "--holder", "holder1"])
+        self.assertEqual(args.func(args), 0)
+        rsrc = Resource.objects.get(name="template.0")
+        self.assertEqual(rsrc.action, Resource.ACTION_DESTROY)
+        self.assertEqual(Lease.objects.get(resource=rsrc).holder, "holder1")
+
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc.id
+        resp = self.client.get(url, {"expiration": 100, "holder": "holder1"})
+        self.assertEqual(resp.status_code, 200)
+
+
+class KVPCacheTestsuite(TransactionTestCase):
+    """ Attributes take a constant number of queries. """
+
+    def setUp(self):
+        """ Create a pool with resources. """
+
+        KVP_CACHE.clear()
+        host1 = Host.objects.create(connection="localhost")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=10,
+                                         template_name="template")
+        for item in range(10):
+            Resource.objects.create(pool=self.pool1, name="template.%d" % item)
+
+    def tearDown(self):
+        """ Entries refer to rows that are about to be removed. """
+        KVP_CACHE.clear()
+
+    def kvps_set(self, rsrc, count):
+        """ Give rsrc count attributes, return the number of queries. """
+
+        attrs = dict(("key%d" % item, "value%d" % item)
+                     for item in range(count))
+        with CaptureQueriesContext(connection) as context:
+            rsrc.kvps_set(attrs)
+        return len(context.captured_queries)
+
+    def test_kvps_set(self):
+        """ test_kvps_set. """
+
+        rsrcs = list(Resource.objects.order_by("name"))
+        self.assertEqual(self.kvps_set(rsrcs[0], 5),
+                         self.kvps_set(rsrcs[1], 50))
+        ##
+        # Interned, only the current attributes are read.
+        self.assertEqual(self.kvps_set(rsrcs[0], 5), 1)
+        self.assertEqual(self.kvps_set(rsrcs[1], 50), 1)
+        ##
+        self.assertEqual(self.kvps_set(rsrcs[1], 10), 3)
+        self.assertEqual(rsrcs[1].kvps.count(), 10)
+
+    def test_serializer(self):
+        """ test_serializer. Listing resources with many attributes. """
+
+        for (index, rsrc) in enumerate(Resource.objects.all()):
+            self.kvps_set(rsrc, index * 5)
+
+        with self.assertNumQueries(2):
+            data = ResourceSerializer(Resource.objects.all(), many=True).data
+        self.assertEqual(sum(len(item["kvps"]) for item in data), 225)
+
+        rsrc = Resource.objects.get(name="template.3")
+        with self.assertNumQueries(1):
+            data = ResourceSerializer(rsrc).data
+        self.assertEqual(data["kvps"][0], ("key0", "value0"))
+
+    def test_pool(self):
+        """ test_pool. Pool values are read once. """
+
+        self.pool1.kvp_value_set("key1", "value1")
+        self.pool1.kvp_value_set("key2", "value2")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.pool1.kvp_value_get("key1"), "value1")
+            self.assertEqual(self.pool1.kvp_value_get("key2"), "value2")
+            self.assertEqual(self.pool1.kvp_value_get("key3", "x"), "x")
+
+
+class AttrTestsuite(TestCase):
+    """ Acquire resources with attributes. """
+
+    def setUp(self):
+        """ Two pools share a template, a third does not. """
+
+        host1 = Host.objects.create(connection="localhost")
+        attrs = {
+            "pool1": [{"os": "ubuntu", "mem": "8G"}, {"os": "centos"}],
+            "pool2": [{"os": "ubuntu", "mem": "16G"}],
+            "pool3": [{"os": "ubuntu", "mem": "16G"}],
+        }
+        for (pool_name, items) in sorted(attrs.items()):
+            template = "other" if pool_name == "pool3" else "template"
+            pool1 = Pool.objects.create(name=pool_name, host=host1,
+                                        resource_max=len(items),
+                                        template_name=template)
+            for (index, item) in enumerate(items):
+                rsrc = Resource.objects.create(
+                    pool=pool1, name="%s.%d" % (pool_name, index),
+                    status=Resource.READY, action="none")
+                rsrc.kvps_set(item)
+
+    def acquire(self, pool_name, **params):
+        """ Return status and name of the resource acquired. """
+
+        resp = self.client.get("/testpool/api/v1/pool/acquire/" + pool_name,
+                               params)
+        if resp.status_code != 200:
+            return (resp.status_code, None)
+        return (resp.status_code, json.loads(resp.content)["name"])
+
+    def test_attr(self):
+        """ test_attr. """
+
+        self.assertEqual(self.acquire("pool1", attr=["os:ubuntu", "mem:8G"]),
+                         (200, "pool1.0"))
+        self.assertEqual(self.acquire("pool1", attr=["os:ubuntu"]),
+                         (403, None))
+        self.assertEqual(self.acquire("pool1", attr=["os:windows"]),
+                         (403, None))
+        self.assertEqual(self.acquire("pool1", attr=["os"]), (400, None))
+        self.assertEqual(self.acquire("pool1", attr="os:centos"),
+                         (200, "pool1.1"))
+
+    def test_spread(self):
+        """ test_spread. Pools sharing a template. """
+
+        self.assertEqual(self.acquire("pool1", attr="mem:16G"), (403, None))
+        self.assertEqual(self.acquire("pool1", attr="mem:16G", spread=1),
+                         (200, "pool2.0"))
+        self.assertEqual(self.acquire("pool1", attr="mem:16G", spread=1),
+                         (403, None))
+
+    def test_kvp_filter(self):
+        """ test_kvp_filter. """
+
+        self.assertEqual(sorted(item.value for item in KVP.filter("os")),
+                         ["centos", "ubuntu"])
+        self.assertEqual(sorted(item.value for item in KVP.filter("16*")),
+                         ["16G"])
+        self.assertEqual(KVP.filter("buntu").count(), 0)
+        self.assertEqual(KVP.filter("").count(), KVP.objects.count())
+
+
+class QueryBudgetMixin(object):
+    """ Hold REST endpoints to a query budget.
+
+    QueryCountMiddleware reports the queries of each request in the
+    X-Query-Count header.
+    """
+
+    def assertQueryBudget(self, budget, url, params=None, status=200,
+                          **extra):
+        """ Request url and check it issued at most budget queries.
+
+        @param extra Request headers as WSGI environ keys.
+        """
+
+        resp = self.client.get(url, params or {}, **extra)
+        self.assertEqual(resp.status_code, status, url)
+        count = int(resp["X-Query-Count"])
+        self.assertLessEqual(count, budget, "%s issued %d queries, "
+                             "budget %d" % (url, count, budget))
+        return resp
+
+
+class QueryBudgetTestsuite(QueryBudgetMixin, TestCase):
+    """ Query counts do not grow with the number of pools or resources. """
+
+    ##
+    # Endpoint and its budget.
+    BUDGETS = [
+        ("/testpool/api/v1/pool/list", 3),
+        ("/testpool/api/v1/pool/detail/pool0", 4),
+        ("/testpool/api/v1/pool/history/pool0", 1),
+        ("/testpool/api/v1/pool/errors/pool0", 1),
+    ]
+    ##
+
+    def populate(self, pools, rsrcs):
+        """ Create pools with rsrcs resources each. """
+
+        (host1, _) = Host.objects.get_or_create(connection="localhost")
+        for index in range(Pool.objects.count(), pools):
+            pool1 = Pool.objects.create(name="pool%d" % index, host=host1,
+                                        resource_max=rsrcs,
+                                        template_name="template")
+            pool1.kvp_value_set("key%d" % index, "value")
+        for pool1 in Pool.objects.all():
+            for index in range(pool1.resource_set.count(), rsrcs):
+                rsrc = Resource.objects.create(
+                    pool=pool1, name="%s.%d" % (pool1.name, index),
+                    status=Resource.READY, action="none")
+                rsrc.kvps_set({"os": "ubuntu", "index": str(index)})
+
+    def test_budget(self):
+        """ test_budget. """
+
+        for (pools, rsrcs) in [(1, 2), (5, 10)]:
+            self.populate(pools, rsrcs)
+            for (url, budget) in self.BUDGETS:
+                self.assertQueryBudget(budget, url)
+
+    def test_acquire(self):
+        """ test_acquire. Acquire, renew and release. """
+
+        for (pools, rsrcs) in [(1, 2), (5, 10)]:
+            self.populate(pools, rsrcs)
+            resp = self.assertQueryBudget(
+                14, "/testpool/api/v1/pool/acquire/pool0",
+                {"attr": "os:ubuntu"})
+            rsrc_id = json.loads(resp.content)["id"]
+            self.assertQueryBudget(
+                1, "/testpool/api/v1/resource/renew/%d" % rsrc_id)
+            self.assertQueryBudget(
+                5, "/testpool/api/v1/pool/release/%d" % rsrc_id)
+
+    def test_metrics(self):
+        """ test_metrics. Totals by view. """
+
+        self.populate(1, 1)
+        self.client.get("/testpool/api/v1/pool/list")
+        resp = self.client.get("/testpool/api/v1/metrics")
+        totals = json.loads(resp.content)
+        total = totals["testpool_pool.api.pool_list"]
+        self.assertGreaterEqual(total["calls"], 1)
+        self.assertGreaterEqual(total["max_queries"], 1)
+
+
+class AdaptTestsuite(TestCase):
+    """ Grow a large pool. """
+
+    def test_grow(self):
+        """ test_grow. Free slots cost a constant number of queries. """
+
+        rsrcs = store.MemoryStore()
+        pool_api = fake_api.Pool("adapt", rsrcs)
+
+        host1 = Host.objects.create(connection="localhost")
+        pool1 = Pool.objects.create(name="pool1", host=host1,
+                                    resource_max=1000,
+                                    template_name="template")
+
+        ##
+        # Every slot is taken except 5, one of them is left by a resource
+        # the driver still has.
+        free = [0, 10, 500, 998, 999]
+        Resource.objects.bulk_create(
+            Resource(pool=pool1, name="template.%d" % slot, slot=slot,
+                     status=Resource.READY, action="none")
+            for slot in range(1000) if slot not in free)
+        rsrcs.add("adapt", "template.500")
+        ##
+
+        with self.assertNumQueries(6):
+            self.assertEqual(algo.adapt(pool_api, pool1), 5)
+
+        added = pool1.resource_set.filter(slot__in=free).order_by("slot")
+        self.assertEqual([item.name for item in added],
+                         ["template.%d" % slot for slot in free])
+        self.assertEqual([item.action for item in added],
+                         ["clone", "clone", "destroy", "clone", "clone"])
+        self.assertEqual(algo.adapt(pool_api, pool1), 0)
+
+
+class ManualPublisher(stream.Publisher):
+    """ Publisher polled by the test instead of a thread. """
+
+    def start(self):
+        self.thread = True
+
+
+class StreamTestsuite(TestCase):
+    """ Stream pool changes. """
+
+    def setUp(self):
+        """ One pool with two resources. """
+
+        host1 = Host.objects.create(connection="localhost")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        self.rsrcs = [Resource.objects.create(pool=self.pool1,
+                                              name="pool1.%d" % item,
+                                              status=Resource.PENDING)
+                      for item in range(2)]
+        self.publisher = ManualPublisher(backlog=3)
+
+    def test_fanout(self):
+        """ test_fanout. One poll serves every subscription. """
+
+        subscriptions = [self.publisher.subscribe() for _ in range(20)]
+        for subscription in subscriptions:
+            messages = subscription.get(0)
+            self.assertEqual([item["name"] for item in messages], ["pool1"])
+            self.assertEqual(messages[0]["rsrc_pending"], 2)
+
+        self.rsrcs[0].transition(Resource.READY, "none", 0)
+        EVENTS.flush()
+        with self.assertNumQueries(3):
+            self.publisher.poll()
+
+        for subscription in subscriptions:
+            messages = subscription.get(0)
+            self.assertEqual([item["type"] for item in messages],
+                             ["transition", "pool"])
+            self.assertEqual(messages[0]["resource"], "pool1.0")
+            self.assertEqual(messages[0]["status"], "ready")
+            self.assertEqual(messages[1]["rsrc_ready"], 1)
+            self.assertEqual(messages[1]["rsrc_pending"], 1)
+
+        ##
+        # Nothing changed, nothing is sent.
+        self.publisher.poll()
+        self.assertIsNone(subscriptions[0].get(0))
+        ##
+
+        self.pool1.delete()
+        self.publisher.poll()
+        self.assertEqual(subscriptions[0].get(0),
+                         [{"type": "removed", "name": "pool1"}])
+
+    def test_slow(self):
+        """ test_slow. A subscription that falls behind is closed. """
+
+        subscription = self.publisher.subscribe()
+        for item in range(3):
+            self.rsrcs[0].transition(Resource.READY - item % 2, "none", 0)
+            EVENTS.flush()
+            self.publisher.poll()
+        self.assertTrue(subscription.closed)
+        self.assertEqual(self.publisher.subscriptions, [])
+
+    def test_rest(self):
+        """ test_rest. Stream JSON lines of one pool. """
+
+        (publisher, stream.PUBLISHER) = (stream.PUBLISHER, self.publisher)
         try:
-            1/0
-        except ZeroDivisionError, arg:
-            stack_trace = sys.exc_info()[2]
-            pool1.stacktrace_set(str(arg), stack_trace)
+            resp = self.client.get("/testpool/api/v1/pool/stream",
+                                   {"format": "ndjson", "pool": "pool1"})
+            self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+            content = resp.streaming_content
+            message = json.loads(next(content))
+            self.assertEqual(message["name"], "pool1")
+            resp.close()
+            self.assertEqual(self.publisher.subscriptions, [])
+        finally:
+            stream.PUBLISHER = publisher
+
+
+class CacheTestsuite(QueryBudgetMixin, TransactionTestCase):
+    """ Conditional GET and cached pool list and detail.
+
+    Responses read inside a transaction are not cached so these tests
+    commit.
+    """
+
+    def setUp(self):
+        """ One pool with two resources. """
+
+        RESPONSES.clear()
+        host1 = Host.objects.create(connection="localhost")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        self.rsrcs = [Resource.objects.create(pool=self.pool1,
+                                              name="pool1.%d" % index,
+                                              status=Resource.READY)
+                      for index in range(2)]
+
+    def tearDown(self):
+        RESPONSES.clear()
+
+    def test_etag(self):
+        """ test_etag. Unchanged pools answer 304. """
+
+        for url in ["/testpool/api/v1/pool/list",
+                    "/testpool/api/v1/pool/detail/pool1"]:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            etag = resp["ETag"]
+
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.content, "")
+
+    def test_transition(self):
+        """ test_transition. Transitions change the ETag and content. """
+
+        url = "/testpool/api/v1/pool/list"
+        resp = self.client.get(url)
+        etag = resp["ETag"]
+        self.assertEqual(json.loads(resp.content)[0]["rsrc_ready"], 2)
+
+        generation = Generation.get()
+        self.rsrcs[0].transition(Resource.RESERVED, "none", 0)
+        self.assertEqual(Generation.get(), generation + 1)
+
+        ##
+        # Rescheduling and changing the action keep cached responses.
+        self.rsrcs[0].transition(Resource.RESERVED, "none", 10)
+        self.rsrcs[0].transition(Resource.RESERVED, "destroy", 10)
+        self.assertEqual(Generation.get(), generation + 1)
+        ##
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp["ETag"], etag)
+        self.assertEqual(json.loads(resp.content)[0]["rsrc_ready"], 1)
+
+        ##
+        # Saving a pool also changes the generation.
+        self.pool1.resource_max = 3
+        self.pool1.save()
+        self.assertEqual(Generation.get(), generation + 2)
+        ##
+
+    def test_cached(self):
+        """ test_cached. Repeated requests only read the generation. """
+
+        url = "/testpool/api/v1/pool/list"
+        content = self.client.get(url).content
+        resp = self.assertQueryBudget(1, url)
+        self.assertEqual(resp.content, content)
+
+    def test_gzip(self):
+        """ test_gzip. Pool list is compressed when the client accepts it.
+        """
+
+        for index in range(50):
+            Pool.objects.create(name="pool.gzip%d" % index,
+                                host=self.pool1.host, resource_max=1,
+                                template_name="template")
+        url = "/testpool/api/v1/pool/list"
+        for _ in range(2):
+            resp = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp["Content-Encoding"], "gzip")
+
+
+class RenderTestsuite(TestCase):
+    """ Acquire, release and renew replies match the serializers. """
+
+    ##
+    # Renders of each path timed by test_benchmark.
+    COUNT = int(os.environ.get("TESTPOOL_BENCH_COUNT", "200"))
+    ##
+
+    def setUp(self):
+        """ Resources with awkward names and attributes. """
+
+        host1 = Host.objects.create(connection="localhost")
+        pool1 = Pool.objects.create(name="pool1", host=host1,
+                                    resource_max=3,
+                                    template_name="template")
+        self.rsrcs = [
+            Resource.objects.create(
+                pool=pool1, name=u"pool1.0", status=Resource.READY,
+                action_time=datetime.datetime(2018, 1, 2, 3, 4, 5)),
+            Resource.objects.create(
+                pool=pool1, name=u'pool1."1"\\\n\u00e9\u2028',
+                status=Resource.RESERVED, ip_addr="10.0.0.1",
+                action_time=datetime.datetime(2018, 1, 2, 3, 4, 5, 6789)),
+            Resource.objects.create(pool=pool1, name="pool1.2",
+                                    status=Resource.PENDING),
+        ]
+        self.rsrcs[1].kvps_set({"os": "ubuntu", u"n\u00e4me": u"\u2029\t",
+                                "a": "b"})
+        self.rsrcs[2].kvps_set(dict(("key%d" % index, "value")
+                                    for index in range(20)))
+
+    @staticmethod
+    def drf_render(rsrc):
+        """ Return the reply rendered through DRF. """
+        return JSONRenderer().render(ResourceSerializer(rsrc).data)
+
+    def test_identical(self):
+        """ test_identical. Content is byte for byte the same. """
+
+        for rsrc in Resource.objects.all():
+            self.assertEqual(render.resource_render(rsrc),
+                             self.drf_render(Resource.objects.get(id=rsrc.id)))
+        for rsrc in ResourceSerializer(Resource.objects.all(),
+                                       many=True).instance:
+            self.assertEqual(render.resource_render(rsrc),
+                             self.drf_render(rsrc))
+
+        msg = "Resource 1 released"
+        self.assertEqual(render.detail_render(msg),
+                         JSONRenderer().render({"detail": msg}))
+        for expiry in [datetime.datetime(2018, 1, 2, 3, 4, 5),
+                       datetime.datetime(2018, 1, 2, 3, 4, 5, 678901)]:
+            expected = JsonResponse({"id": 12, "expiry": expiry}).content
+            self.assertEqual(render.renew_render("12", expiry), expected)
+
+    def test_queries(self):
+        """ test_queries. Attributes are read in one query. """
+
+        rsrc = Resource.objects.get(id=self.rsrcs[2].id)
+        with self.assertNumQueries(1):
+            render.resource_render(rsrc)
+
+    def test_benchmark(self):
+        """ test_benchmark. Compare with DRF.
+
+        TESTPOOL_BENCH_COUNT sets the number of renders.
+        """
+
+        rsrc = ResourceSerializer(Resource.objects.get(
+            id=self.rsrcs[2].id)).instance
+
+        start = time.time()
+        for _ in range(self.COUNT):
+            self.drf_render(rsrc)
+        drf_seconds = time.time() - start
+
+        start = time.time()
+        for _ in range(self.COUNT):
+            render.resource_render(rsrc)
+        fast_seconds = time.time() - start
+
+        sys.stderr.write("\nrender %d resources DRF %.3fs fast %.3fs "
+                         "%.1fx\n" % (self.COUNT, drf_seconds, fast_seconds,
+                                      drf_seconds / max(fast_seconds, 1e-6)))
+        self.assertLess(fast_seconds, drf_seconds)
+
+
+class ResourceListTestsuite(QueryBudgetMixin, TestCase):
+    """ Page through and stream resources. """
+
+    URL = "/testpool/api/v1/resource/list"
+
+    def setUp(self):
+        """ Two pools on two hosts with 25 and 5 resources. """
+
+        for (pool_name, host_name, count) in [("pool1", "host1", 25),
+                                              ("pool2", "host2", 5)]:
+            host1 = Host.objects.create(connection=host_name)
+            pool1 = Pool.objects.create(name=pool_name, host=host1,
+                                        resource_max=count,
+                                        template_name="template")
+            for index in range(count):
+                rsrc = Resource.objects.create(
+                    pool=pool1, name="%s.%d" % (pool_name, index),
+                    status=Resource.READY if index % 2 else Resource.PENDING)
+                rsrc.kvps_set({"os": "ubuntu" if index % 5 else "centos"})
+
+    def names_get(self, params, budget=2):
+        """ Return names of every page and the number of pages. """
+
+        params = dict(params)
+        names = []
+        pages = 0
+        while True:
+            resp = self.assertQueryBudget(budget, self.URL, params)
+            page = json.loads(resp.content)
+            pages += 1
+            names += [item["name"] for item in page["results"]]
+            if page["cursor"] is None:
+                return (names, pages)
+            params["cursor"] = page["cursor"]
+
+    def test_pages(self):
+        """ test_pages. Every resource once, each page in two queries. """
+
+        (names, pages) = self.names_get({"limit": 10})
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(names), 30)
+        self.assertEqual(len(set(names)), 30)
+
+        resp = self.client.get(self.URL, {"limit": 1})
+        rsrc = json.loads(resp.content)["results"][0]
+        self.assertEqual(rsrc["name"], "pool1.0")
+        self.assertEqual(rsrc["pool"], "pool1")
+        self.assertEqual(rsrc["connection"], "host1")
+        self.assertEqual(rsrc["status"], "pending")
+        self.assertEqual(rsrc["kvps"], [["os", "centos"]])
+
+    def test_filter(self):
+        """ test_filter. Filters are combined. """
+
+        (names, _) = self.names_get({"pool": "pool2"})
+        self.assertEqual(len(names), 5)
+        (names, _) = self.names_get({"host": "host1", "status": "ready"})
+        self.assertEqual(len(names), 12)
+        (names, _) = self.names_get({"status": ["ready", "pending"],
+                                     "name": "pool1.1"})
+        self.assertEqual(len(names), 11)
+        ##
+        # KVP_CACHE only keeps what is committed so the attribute is read
+        # on every page.
+        (names, _) = self.names_get({"attr": "os:centos", "pool": "pool1"},
+                                    4)
+        self.assertEqual(names, ["pool1.%d" % index
+                                 for index in range(0, 25, 5)])
+        (names, _) = self.names_get({"attr": "os:windows"}, 4)
+        ##
+        self.assertEqual(names, [])
+
+        for params in [{"status": "unknown"}, {"attr": "os"},
+                       {"cursor": "x"}]:
+            resp = self.client.get(self.URL, params)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_ndjson(self):
+        """ test_ndjson. Every match is streamed. """
+
+        resp = self.client.get(self.URL, {"format": "ndjson",
+                                          "pool": "pool1"})
+        self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+        lines = "".join(resp.streaming_content).splitlines()
+        self.assertEqual([json.loads(item)["name"] for item in lines],
+                         ["pool1.%d" % index for index in range(25)])
+
+
+class ShareTestsuite(TestCase):
+    """ Share a pool between tenants. """
+
+    def setUp(self):
+        """ One pool with six READY resources. """
+
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=6,
+                                         template_name="template")
+        for index in range(6):
+            Resource.objects.create(pool=self.pool1,
+                                    name="pool1.%d" % index,
+                                    status=Resource.READY, action="none")
+
+    def acquire(self, tenant):
+        """ Return the resource acquired by tenant. """
+
+        pool1 = Pool.objects.get(id=self.pool1.id)
+        return algo.acquire(algo.candidates(pool1), 60, "holder",
+                            tenant=tenant)
+
+    def test_max(self):
+        """ test_max. A tenant at its maximum is refused. """
+
+        share.share_set(self.pool1, "a", maximum=2)
+        self.acquire("a")
+        self.acquire("a")
+        with self.assertRaises(share.OverShare):
+            self.acquire("a")
+        self.assertTrue(self.acquire("b"))
+        self.assertEqual(share.held_get(self.pool1), {"a": 2, "b": 1})
+
+        ##
+        # Releasing one lets the tenant acquire again.
+        rsrc = Resource.objects.filter(lease__tenant="a").first()
+        rsrc.transition(Resource.PENDING, Resource.ACTION_DESTROY, 1)
+        self.assertTrue(self.acquire("a"))
+        ##
+
+    def test_min(self):
+        """ test_min. Resources owed to a tenant are kept for it. """
+
+        share.share_set(self.pool1, "b", minimum=2)
+        for _ in range(4):
+            self.acquire("a")
+        with self.assertRaises(share.OverShare):
+            self.acquire("a")
+        self.assertTrue(self.acquire("b"))
+        self.assertTrue(self.acquire("b"))
+        self.assertEqual(Resource.objects.filter(
+            status=Resource.READY).count(), 0)
+
+    def test_any(self):
+        """ test_any. Tenants without a share, named or not. """
+
+        share.share_set(self.pool1, share.TENANT_ANY, maximum=1)
+        share.share_set(self.pool1, "a", maximum=3)
+        self.acquire("")
+        with self.assertRaises(share.OverShare):
+            self.acquire("")
+        self.acquire("b")
+        with self.assertRaises(share.OverShare):
+            self.acquire("b")
+        for _ in range(3):
+            self.acquire("a")
+        with self.assertRaises(share.OverShare):
+            self.acquire("a")
+
+    def test_malformed(self):
+        """ test_malformed. Values that are not numbers are ignored. """
+
+        self.pool1.kvp_value_set(share.share_key("a", "max"), "many")
+        self.pool1.kvp_value_set("tenant.a", "1")
+        self.assertEqual(share.shares_get(self.pool1), {})
+        for _ in range(6):
+            self.acquire("a")
+
+    def test_rest(self):
+        """ test_rest. Refused with 403. """
+
+        share.share_set(self.pool1, "a", maximum=1)
+        url = "/testpool/api/v1/pool/acquire/pool1"
+        resp = self.client.get(url, {"tenant": "a"})
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(url, {"tenant": "a"})
+        self.assertEqual(resp.status_code, 403)
+        self.assertIn("maximum", json.loads(resp.content)["msg"])
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+
+
+class FileDatabaseMixin(object):
+    """ Run threads against a file copy of the test database.
+
+    The in-memory test database cannot be opened twice, each thread
+    connects to the copy instead.
+    """
+
+    def database_copy(self):
+        """ Copy the test database as it is now to a file. """
+
+        (handle, self.path) = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(handle)
+        copy = sqlite3.connect(self.path)
+        copy.executescript(";\n".join(connection.connection.iterdump()))
+        copy.close()
+
+    def database_remove(self):
+        """ Remove the copy. """
+        os.remove(self.path)
+
+    def connect(self):
+        """ Connect the calling thread to the copy. """
+
+        wrapper = connections[DEFAULT_DB_ALIAS].__class__
+        settings = dict(connection.settings_dict, NAME=self.path)
+        connections[DEFAULT_DB_ALIAS] = wrapper(settings, DEFAULT_DB_ALIAS)
+
+    def threads_run(self, target, args_list):
+        """ Run target once per args each in its own thread.
+
+        Each thread is connected to the copy, all of them are waited for.
+        """
+
+        def _run(*args):
+            """ Run target connected to the copy. """
+            self.connect()
+            try:
+                target(*args)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=_run, args=args)
+                   for args in args_list]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def locked(self):
+        """ Return a connection holding the write lock of the copy. """
+
+        locker = sqlite3.connect(self.path)
+        locker.execute("BEGIN IMMEDIATE")
+        return locker
+
+    @staticmethod
+    def timeout_set(seconds):
+        """ Wait at most seconds for a lock in the calling thread. """
+        connection.settings_dict["OPTIONS"] = {"timeout": seconds}
+
+    def copy_check(self, check):
+        """ Call check connected to the copy. """
+
+        memory = connections[DEFAULT_DB_ALIAS]
+        self.connect()
+        try:
+            check()
+        finally:
+            connection.close()
+            connections[DEFAULT_DB_ALIAS] = memory
+
+
+class ShareConcurrencyTestsuite(FileDatabaseMixin, TransactionTestCase):
+    """ Concurrent acquires of a shared pool are decided one at a time. """
+
+    def setUp(self):
+        """ One pool with two READY resources, tenant a holds at most one.
+        """
+
+        KVP_CACHE.clear()
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        for index in range(2):
+            Resource.objects.create(pool=self.pool1,
+                                    name="pool1.%d" % index,
+                                    status=Resource.READY, action="none")
+        share.share_set(self.pool1, "a", maximum=1)
+        self.held_get = share.held_get
+        self.database_copy()
+
+    def tearDown(self):
+        """ Entries refer to rows that are about to be removed. """
+        KVP_CACHE.clear()
+        share.held_get = self.held_get
+        self.database_remove()
+
+    def test_admit(self):
+        """ test_admit. Both read the counts before either reserves. """
+
+        def _held_get(pool1):
+            """ Leave time for the other thread to read as well. """
+            held = self.held_get(pool1)
+            time.sleep(0.2)
+            return held
+        share.held_get = _held_get
+
+        outcomes = []
+
+        def _acquire(name):
+            """ Acquire resource name for tenant a. """
+            try:
+                pool1 = Pool.objects.get(id=self.pool1.id)
+                rsrcs = algo.candidates(pool1).filter(name=name)
+                outcomes.append(algo.acquire(rsrcs, 60, "holder",
+                                             tenant="a"))
+            except (share.Busy, share.OverShare) as arg:
+                outcomes.append(arg)
+
+        self.threads_run(_acquire, [("pool1.0",), ("pool1.1",)])
+
+        self.assertEqual(len(outcomes), 2)
+        self.assertEqual(len([item for item in outcomes
+                              if isinstance(item, Resource)]), 1)
+        self.assertEqual(len([item for item in outcomes
+                              if isinstance(item, share.OverShare)]), 1)
+
+        def _check():
+            """ One resource is reserved. """
+            self.assertEqual(share.held_get(self.pool1), {"a": 1})
+            self.assertEqual(Resource.objects.filter(
+                status=Resource.RESERVED).count(), 1)
+        self.copy_check(_check)
+
+    def test_busy(self):
+        """ test_busy. A pool locked past the timeout answers 409. """
+
+        responses = []
+
+        def _acquire():
+            """ Acquire for tenant a while the pool is locked. """
+            self.timeout_set(0.1)
+            responses.append(self.client.get(
+                "/testpool/api/v1/pool/acquire/pool1?tenant=a"))
+
+        locker = self.locked()
+        try:
+            self.threads_run(_acquire, [()])
+        finally:
+            locker.rollback()
+            locker.close()
+
+        self.assertEqual(responses[0].status_code, 409)
+
+
+class BookingConcurrencyTestsuite(FileDatabaseMixin, TransactionTestCase):
+    """ Concurrent bookings of a pool are decided one at a time. """
+
+    def setUp(self):
+        """ One pool of four resources. """
+
+        KVP_CACHE.clear()
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=4,
+                                         template_name="template")
+        current = datetime.datetime.now().replace(microsecond=0)
+        self.start = current + datetime.timedelta(hours=1)
+        self.end = current + datetime.timedelta(hours=2)
+        self.peak = booking.peak
+        self.database_copy()
+
+    def tearDown(self):
+        """ Entries refer to rows that are about to be removed. """
+        KVP_CACHE.clear()
+        booking.peak = self.peak
+        self.database_remove()
+
+    def test_book(self):
+        """ test_book. Both read the bookings before either books. """
+
+        def _peak(*args):
+            """ Leave time for the other thread to read as well. """
+            booked = self.peak(*args)
+            time.sleep(0.2)
+            return booked
+        booking.peak = _peak
+
+        outcomes = []
+
+        def _book():
+            """ Book three of the four resources. """
+            try:
+                pool1 = Pool.objects.get(id=self.pool1.id)
+                outcomes.append(booking.book(pool1, 3, self.start,
+                                             self.end))
+            except (share.Busy, booking.BookingConflict) as arg:
+                outcomes.append(arg)
+
+        self.threads_run(_book, [(), ()])
+
+        self.assertEqual(len([item for item in outcomes
+                              if isinstance(item, Booking)]), 1)
+        self.assertEqual(len([item for item in outcomes
+                              if isinstance(item, booking.BookingConflict)]),
+                         1)
+        self.copy_check(lambda: self.assertEqual(Booking.objects.count(), 1))
+
+    def test_busy(self):
+        """ test_busy. A pool locked past the timeout answers 409. """
+
+        responses = []
+
+        def _book():
+            """ Book while the pool is locked. """
+            self.timeout_set(0.1)
+            responses.append(self.client.post(
+                "/testpool/api/v1/pool/book/pool1?count=1&start=%s" %
+                self.start.isoformat()))
+
+        locker = self.locked()
+        try:
+            self.threads_run(_book, [()])
+        finally:
+            locker.rollback()
+            locker.close()
+
+        self.assertEqual(responses[0].status_code, 409)
+
+
+class BookingTestsuite(TestCase):
+    """ Advance reservations. """
+
+    def setUp(self):
+        """ One pool of four READY resources. """
+
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=4,
+                                         template_name="template")
+        for slot in range(4):
+            Resource.objects.create(pool=self.pool1, slot=slot,
+                                    name="template.%d" % slot,
+                                    status=Resource.READY, action="none")
+        self.current = datetime.datetime.now().replace(microsecond=0)
+
+    def window(self, start, end):
+        """ Return the window from start to end minutes from now. """
+
+        return (self.current + datetime.timedelta(minutes=start),
+                self.current + datetime.timedelta(minutes=end))
+
+    def test_peak(self):
+        """ test_peak. Most resources booked at one instant. """
+
+        (start, end) = self.window(0, 60)
+        (mid, _) = self.window(30, 60)
+        self.assertEqual(booking.peak([], start, end), 0)
+        self.assertEqual(booking.peak([(start, mid, 2), (mid, end, 3)],
+                                      start, end), 3)
+        self.assertEqual(booking.peak([(start, end, 2), (mid, end, 3)],
+                                      start, end), 5)
+        self.assertEqual(booking.peak([(start, end, 2), (mid, end, 3)],
+                                      start, mid), 2)
+
+    def test_conflict(self):
+        """ test_conflict. Overlapping bookings share resource_max. """
+
+        (start, end) = self.window(60, 120)
+        booking.book(self.pool1, 3, start, end)
+        booking.book(self.pool1, 1, *self.window(90, 150))
+        with self.assertRaises(booking.BookingConflict):
+            booking.book(self.pool1, 1, *self.window(100, 110))
+
+        ##
+        # Back to back windows do not overlap.
+        booking.book(self.pool1, 4, *self.window(0, 60))
+        booking.book(self.pool1, 3, *self.window(150, 180))
+        ##
+
+        self.pool1.kvp_value_set(booking.BOOKING_MAX_KEY, "5")
+        pool1 = Pool.objects.get(id=self.pool1.id)
+        booking.book(pool1, 1, *self.window(100, 110))
+
+        with self.assertRaises(ValueError):
+            booking.book(pool1, 1, end, start)
+        with self.assertRaises(ValueError):
+            booking.book(pool1, 1, *self.window(-20, -10))
+
+    def test_prewarm(self):
+        """ test_prewarm. The pool grows a clone lead ahead of start. """
+
+        pool_api = fake_api.Pool("pool1", store.MemoryStore())
+        calendar = booking.Calendar()
+
+        soon = booking.book(self.pool1, 2, *self.window(5, 65))
+        later = booking.book(self.pool1, 2, *self.window(180, 240))
+        self.assertEqual(calendar.tick(self.current), set([self.pool1.id]))
+        self.assertEqual(Booking.objects.get(id=soon.id).status,
+                         Booking.PREWARM)
+        self.assertEqual(Booking.objects.get(id=later.id).status,
+                         Booking.BOOKED)
+
+        pool1 = Pool.objects.get(id=self.pool1.id)
+        self.assertEqual(pool1.resource_booked, 2)
+        self.assertEqual(algo.adapt(pool_api, pool1), 2)
+        self.assertEqual(pool1.resource_set.count(), 6)
+
+        ##
+        # Once the booking ends the pool shrinks back.
+        (_, end) = self.window(5, 65)
+        self.assertEqual(calendar.tick(end), set([self.pool1.id]))
+        pool1 = Pool.objects.get(id=self.pool1.id)
+        self.assertEqual(pool1.resource_booked, 0)
+        algo.adapt(pool_api, pool1)
+        self.assertEqual(pool1.resource_set.filter(
+            action=Resource.ACTION_DESTROY).count(), 2)
+        ##
+
+    def test_lead(self):
+        """ test_lead. Clone history shortens the lead. """
+
+        counts = [0] * len(PoolRollup.BUCKETS)
+        counts[PoolRollup.hist_bucket(60)] = 10
+        PoolRollup.objects.create(
+            pool_name="pool1", start=self.current - datetime.timedelta(
+                minutes=10), clone_hist=PoolRollup.hist_format(counts))
+        self.assertEqual(booking.lead_get(self.pool1, self.current),
+                         60 + booking.LEAD_MARGIN)
+
+        booking1 = booking.book(self.pool1, 1, *self.window(5, 65))
+        calendar = booking.Calendar()
+        self.assertEqual(calendar.tick(self.current), set())
+        self.assertEqual(Booking.objects.get(id=booking1.id).status,
+                         Booking.BOOKED)
+        (start, _) = self.window(3, 5)
+        calendar.tick(start)
+        self.assertEqual(Booking.objects.get(id=booking1.id).status,
+                         Booking.PREWARM)
+
+    def test_handover(self):
+        """ test_handover. Resources are leased to the holder at start. """
+
+        (start, end) = self.window(5, 65)
+        booking1 = booking.book(self.pool1, 3, start, end, "nightly", "ci")
+        calendar = booking.Calendar()
+        calendar.tick(self.current)
+        self.assertFalse(Resource.objects.filter(
+            status=Resource.RESERVED).exists())
+
+        calendar.tick(start)
+        self.assertEqual(Booking.objects.get(id=booking1.id).status,
+                         Booking.GRANTED)
+        leases = Lease.objects.filter(booking=booking1)
+        self.assertEqual(leases.count(), 3)
+        for lease in leases:
+            self.assertEqual((lease.holder, lease.tenant, lease.expiry),
+                             ("nightly", "ci", end))
+            self.assertEqual(lease.resource.status, Resource.RESERVED)
+
+        rsrc = algo.acquire(algo.candidates(self.pool1), 60)
+        self.assertFalse(rsrc.lease.booking)
+
+    def test_kept(self):
+        """ test_kept. Acquires leave READY resources to prewarm bookings.
+        """
+
+        (start, end) = self.window(5, 65)
+        booking1 = booking.book(self.pool1, 3, start, end, "nightly")
+        calendar = booking.Calendar()
+        calendar.tick(self.current)
+
+        ##
+        # One READY resource is left over, the other three are kept.
+        self.assertTrue(algo.acquire(algo.candidates(self.pool1), 60))
+        self.assertIsNone(algo.acquire(algo.candidates(self.pool1), 60))
+        resp = self.client.get("/testpool/api/v1/pool/acquire/pool1")
+        self.assertEqual(resp.status_code, 403)
+        ##
+
+        calendar.tick(start)
+        self.assertEqual(Booking.objects.get(id=booking1.id).status,
+                         Booking.GRANTED)
+        self.assertEqual(Lease.objects.filter(booking=booking1).count(), 3)
+
+    def test_cancelled(self):
+        """ test_cancelled. A booking cancelled during handover gets nothing.
+        """
+
+        (start, end) = self.window(-1, 60)
+        booking1 = booking.book(self.pool1, 3, start, end)
+        booking.Calendar().tick(start - datetime.timedelta(minutes=5))
+        booking1 = Booking.objects.select_related("pool").get(id=booking1.id)
+
+        def _candidates(*args):
+            """ The booking is cancelled once its resources are chosen. """
+            rsrcs = candidates(*args)
+            Booking.objects.filter(id=booking1.id).update(
+                status=Booking.CANCELLED)
+            return rsrcs
+
+        candidates = algo.candidates
+        algo.candidates = _candidates
+        try:
+            self.assertFalse(booking.handover(booking1, self.current))
+        finally:
+            algo.candidates = candidates
+
+        ##
+        # The cancel here shares the transaction of handover and is rolled
+        # back with it, one committed by another process is not.
+        self.assertFalse(Lease.objects.exists())
+        self.assertFalse(Resource.objects.filter(
+            status=Resource.RESERVED).exists())
+        ##
+
+    def test_thaw(self):
+        """ test_thaw. A resource failing to resume leaves the others. """
+
+        thawed = []
+
+        def _spare_thaw(_, rsrc):
+            """ The first resource fails to resume. """
+            if not thawed:
+                thawed.append(None)
+                raise RuntimeError("%s failed to resume" % rsrc.name)
+            thawed.append(rsrc.name)
+
+        (start, end) = self.window(-1, 60)
+        booking1 = booking.book(self.pool1, 3, start, end)
+        spare_thaw = algo.spare_thaw
+        algo.spare_thaw = _spare_thaw
+        try:
+            booking.Calendar().tick(self.current)
+        finally:
+            algo.spare_thaw = spare_thaw
+
+        self.assertEqual(Booking.objects.get(id=booking1.id).status,
+                         Booking.GRANTED)
+        self.assertEqual(len(thawed), 3)
+
+    def test_short(self):
+        """ test_short. Nothing is leased until every resource is READY. """
+
+        (start, end) = self.window(-1, 60)
+        booking1 = booking.book(self.pool1, 3, start, end)
+        self.pool1.resource_set.filter(slot__lt=2).update(
+            status=Resource.PENDING)
+
+        calendar = booking.Calendar()
+        calendar.tick(self.current)
+        self.assertEqual(Booking.objects.get(id=booking1.id).status,
+                         Booking.PREWARM)
+        self.assertFalse(Lease.objects.exists())
+
+        self.pool1.resource_set.update(status=Resource.READY)
+        calendar.tick(self.current)
+        self.assertEqual(Lease.objects.filter(booking=booking1).count(), 3)
+
+    def test_rest(self):
+        """ test_rest. Book, list, show and cancel. """
+
+        (start, end) = self.window(5, 65)
+        url = "/testpool/api/v1/pool/book/pool1"
+        params = "count=3&start=%s&end=%s&holder=nightly" % (
+            start.isoformat(), end.isoformat())
+        resp = self.client.post(url + "?" + params)
+        self.assertEqual(resp.status_code, 200)
+        content = json.loads(resp.content)
+        self.assertEqual((content["count"], content["holder"],
+                          content["status"]), (3, "nightly", "booked"))
+        booking_id = content["id"]
+
+        resp = self.client.post(url + "?count=2&start=%s&minutes=30" %
+                                start.isoformat())
+        self.assertEqual(resp.status_code, 409)
+        resp = self.client.post(url + "?count=1&start=tonight")
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.get(url)
+        self.assertEqual([item["id"] for item in json.loads(resp.content)],
+                         [booking_id])
+        resp = self.client.get(url, {"start": end.isoformat()})
+        self.assertEqual(json.loads(resp.content), [])
+
+        booking.Calendar().tick(start)
+        detail = "/testpool/api/v1/booking/detail/%d" % booking_id
+        content = json.loads(self.client.get(detail).content)
+        self.assertEqual(content["status"], "granted")
+        self.assertEqual(len(content["resources"]), 3)
+
+        resp = self.client.delete(detail)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Resource.objects.filter(
+            status=Resource.RESERVED).count(), 0)
+        self.assertEqual(Pool.objects.get(id=self.pool1.id).resource_booked,
+                         0)
+        resp = self.client.delete(detail)
+        self.assertEqual(resp.status_code, 403)
+
+
+class IdempotencyTestsuite(QueryBudgetMixin, TestCase):
+    """ Retries with the same idempotency key. """
+
+    def setUp(self):
+        """ One pool with two READY resources. """
+
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        for index in range(2):
+            Resource.objects.create(pool=self.pool1, name="pool1.%d" % index,
+                                    status=Resource.READY, action="none")
+
+    def acquire(self, key, status=200):
+        """ Acquire from pool1 with key.
+
+        The key adds a read, the claim in a savepoint and storing the reply.
+        """
+
+        return self.assertQueryBudget(
+            17, "/testpool/api/v1/pool/acquire/pool1", status=status,
+            HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_acquire(self):
+        """ test_acquire. A retried acquire reserves one resource. """
+
+        resp1 = self.acquire("key1")
+        self.assertFalse(resp1.has_header(idempotency.REPLAYED))
+        resp2 = self.assertQueryBudget(
+            2, "/testpool/api/v1/pool/acquire/pool1",
+            HTTP_IDEMPOTENCY_KEY="key1")
+        self.assertEqual(resp2[idempotency.REPLAYED], "true")
+        self.assertEqual(resp2.content, resp1.content)
+        self.assertEqual(resp2["Content-Type"], resp1["Content-Type"])
+        self.assertEqual(Resource.objects.filter(
+            status=Resource.RESERVED).count(), 1)
+
+        self.acquire("key2")
+        self.assertEqual(Resource.objects.filter(
+            status=Resource.RESERVED).count(), 2)
+
+    def test_client(self):
+        """ test_client. Another client cannot replay the key. """
+
+        url = "/testpool/api/v1/pool/acquire/pool1"
+        resp1 = self.acquire("key1")
+        resp2 = self.client.get(url, HTTP_IDEMPOTENCY_KEY="key1",
+                                REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(resp2.status_code, 422)
+        self.assertNotIn(json.loads(resp1.content)["name"], resp2.content)
+        resp2 = self.client.get(url, {"holder": "ci"},
+                                HTTP_IDEMPOTENCY_KEY="key1")
+        self.assertEqual(resp2.status_code, 422)
+
+        ##
+        # The holder it named identifies the client.
+        resp1 = self.client.get(url, {"holder": "ci"},
+                                HTTP_IDEMPOTENCY_KEY="key2")
+        resp2 = self.client.get(url, {"holder": "ci"},
+                                HTTP_IDEMPOTENCY_KEY="key2",
+                                REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(resp2.content, resp1.content)
+        ##
+        self.assertEqual(Resource.objects.filter(
+            status=Resource.RESERVED).count(), 2)
+
+    def test_failure(self):
+        """ test_failure. Failed requests run again. """
+
+        self.pool1.resource_set.update(status=Resource.PENDING)
+        self.acquire("key1", 403)
+        self.assertFalse(RequestKey.objects.exists())
+        self.pool1.resource_set.update(status=Resource.READY)
+        self.acquire("key1")
+
+    def test_release(self):
+        """ test_release. Release and renew replay their replies. """
+
+        rsrc_id = json.loads(self.acquire("key1").content)["id"]
+        url = "/testpool/api/v1/resource/renew/%d" % rsrc_id
+        resp1 = self.client.get(url, HTTP_IDEMPOTENCY_KEY="key2")
+        resp2 = self.client.get(url, HTTP_IDEMPOTENCY_KEY="key2")
+        self.assertEqual(resp2.content, resp1.content)
+
+        url = "/testpool/api/v1/pool/release/%d" % rsrc_id
+        resp = self.client.get(url, HTTP_IDEMPOTENCY_KEY="key3")
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(url, HTTP_IDEMPOTENCY_KEY="key3")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp[idempotency.REPLAYED], "true")
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 403)
+
+        ##
+        # A key belongs to one request.
+        resp = self.client.get(url, HTTP_IDEMPOTENCY_KEY="key1")
+        self.assertEqual(resp.status_code, 422)
+        ##
+
+    def test_in_progress(self):
+        """ test_in_progress. A retry while the first runs is refused. """
+
+        current = datetime.datetime.now()
+        RequestKey.objects.create(
+            key="key1", path="/testpool/api/v1/pool/acquire/pool1",
+            client="127.0.0.1",
+            expiry=current + datetime.timedelta(seconds=60))
+        self.acquire("key1", 409)
+        self.acquire("k" * (RequestKey.KEY_MAX + 1), 400)
+
+    def test_evict(self):
+        """ test_evict. Expired keys are removed or claimed again. """
+
+        self.acquire("key1")
+        self.acquire("key2")
+        expiry = datetime.datetime.now() + datetime.timedelta(
+            seconds=RequestKey.TTL)
+        self.assertEqual(RequestKey.evict(expiry - datetime.timedelta(
+            seconds=60)), 0)
+        RequestKey.objects.filter(key="key1").update(
+            expiry=datetime.datetime.now())
+        Resource.objects.filter(status=Resource.RESERVED).update(
+            status=Resource.READY)
+        resp = self.acquire("key1")
+        self.assertFalse(resp.has_header(idempotency.REPLAYED))
+        self.assertEqual(RequestKey.evict(expiry + datetime.timedelta(
+            seconds=60)), 2)
+
+
+class FallbackTestsuite(QueryBudgetMixin, TestCase):
+    """ Acquire falls back to other pools. """
+
+    def setUp(self):
+        """ Pools a, b and c with one READY resource each. """
+
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pools = {}
+        for name in ["a", "b", "c"]:
+            pool1 = Pool.objects.create(name=name, host=host1, resource_max=1,
+                                        template_name=name)
+            Resource.objects.create(pool=pool1, name="%s.0" % name,
+                                    status=Resource.READY, action="none")
+            self.pools[name] = pool1
+
+    def acquire(self, status=200, **params):
+        """ Acquire from pool a, return the name of the resource.
+
+        A fallback serving it adds reading its KVPs and counting the spill.
+        """
+
+        resp = self.assertQueryBudget(18, "/testpool/api/v1/pool/acquire/a",
+                                      params, status=status)
+        return json.loads(resp.content).get("name", None)
+
+    def test_order(self):
+        """ test_order. The pool first, then each fallback in order. """
+
+        algo.fallbacks_set(self.pools["a"], ["c", "missing", "a", "b"])
+        pool1 = Pool.objects.get(name="a")
+        self.assertEqual([item.name for item in algo.fallbacks_get(pool1)],
+                         ["c", "b"])
+
+        self.assertEqual(self.acquire(), "a.0")
+        self.assertEqual(self.acquire(), "c.0")
+        self.assertEqual(self.acquire(), "b.0")
+        self.acquire(403)
+        self.assertEqual(dict(PoolSpill.objects.filter(
+            pool_name="a").values_list("fallback_name", "count")),
+                         {"b": 1, "c": 1})
+
+    def test_none(self):
+        """ test_none. Without fallbacks only the pool is used. """
+
+        self.assertEqual(self.acquire(), "a.0")
+        self.acquire(403)
+        algo.fallbacks_set(self.pools["a"], ["b"])
+        self.acquire(403, fallback=0)
+        self.assertEqual(self.acquire(), "b.0")
+
+    def test_attr(self):
+        """ test_attr. Attributes apply to fallback pools too. """
+
+        Resource.objects.get(name="c.0").kvps_set({"os": "ubuntu"})
+        algo.fallbacks_set(self.pools["a"], ["b", "c"])
+        pool1 = Pool.objects.get(name="a")
+        rsrcs = algo.candidates(pool1, [("os", "ubuntu")], False,
+                                algo.fallbacks_get(pool1))
+        self.assertEqual([item.name for item in rsrcs], ["c.0"])
+
+    def test_share(self):
+        """ test_share. A pool refusing the tenant passes to its fallback.
+        """
+
+        share.share_set(self.pools["a"], "ci", maximum=0)
+        share.share_set(self.pools["b"], "ci", maximum=0)
+        algo.fallbacks_set(self.pools["a"], ["b", "c"])
+
+        url = "/testpool/api/v1/pool/acquire/a"
+        resp = self.client.get(url, {"tenant": "ci"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)["name"], "c.0")
+
+        ##
+        # Every pool of the chain refused.
+        resp = self.client.get(url, {"tenant": "ci"})
+        self.assertEqual(resp.status_code, 403)
+        self.assertIn("maximum", json.loads(resp.content)["msg"])
+        ##
+
+    def test_group(self):
+        """ test_group. Counters of the pool and its fallbacks. """
+
+        algo.fallbacks_set(self.pools["a"], ["b"])
+        self.acquire()
+        self.acquire()
+        resp = self.assertQueryBudget(6, "/testpool/api/v1/pool/group/a")
+        content = json.loads(resp.content)
+        self.assertEqual([item["name"] for item in content["members"]],
+                         ["a", "b"])
+        self.assertEqual((content["resource_max"], content["rsrc_ready"],
+                          content["rsrc_reserved"]), (2, 0, 2))
+        self.assertEqual(content["spilled"], {"b": 1})
+
+
+class ReuseTestsuite(QueryBudgetMixin, TestCase):
+    """ Released resources kept for their holder. """
+
+    def setUp(self):
+        """ One pool with two READY resources kept for 300 seconds. """
+
+        host1 = Host.objects.create(connection="localhost", product="fake")
+        self.pool1 = Pool.objects.create(name="pool1", host=host1,
+                                         resource_max=2,
+                                         template_name="template")
+        for index in range(2):
+            Resource.objects.create(pool=self.pool1, name="pool1.%d" % index,
+                                    status=Resource.READY, action="none")
+        algo.reuse_set(self.pool1, 300)
+
+    def acquire(self, holder, status=200):
+        """ Return the id of the resource holder acquires. """
+
+        resp = self.assertQueryBudget(
+            14, "/testpool/api/v1/pool/acquire/pool1", {"holder": holder},
+            status=status)
+        return json.loads(resp.content).get("id", None)
+
+    def release(self, rsrc_id, budget=5):
+        """ Release rsrc_id. """
+
+        self.assertQueryBudget(budget, "/testpool/api/v1/pool/release/%d" %
+                               rsrc_id)
+
+    def test_reuse(self):
+        """ test_reuse. The holder gets its released resource back. """
+
+        rsrc_id = self.acquire("ci")
+        self.release(rsrc_id)
+        rsrc = Resource.objects.get(id=rsrc_id)
+        self.assertEqual((rsrc.status, rsrc.action),
+                         (Resource.RESERVED, Resource.ACTION_DESTROY))
+        self.assertTrue(Lease.objects.get(resource_id=rsrc_id).released)
+        self.assertEqual(self.client.get(
+            "/testpool/api/v1/resource/renew/%d" % rsrc_id).status_code, 403)
+
+        ##
+        # Others cannot take it.
+        other_id = self.acquire("other")
+        self.assertNotEqual(other_id, rsrc_id)
+        self.acquire("other", 403)
+        ##
+
+        self.assertEqual(self.acquire("ci"), rsrc_id)
+        lease = Lease.objects.get(resource_id=rsrc_id)
+        self.assertFalse(lease.released)
+        self.assertEqual(lease.holder, "ci")
+
+    def test_default_holder(self):
+        """ test_default_holder. Only a named holder reuses. """
+
+        url = "/testpool/api/v1/pool/acquire/pool1"
+        rsrc_id = json.loads(self.client.get(url).content)["id"]
+        self.release(rsrc_id)
+        self.assertNotEqual(json.loads(self.client.get(url).content)["id"],
+                            rsrc_id)
+        self.assertEqual(self.acquire("127.0.0.1"), rsrc_id)
+
+    def test_share(self):
+        """ test_share. Reuse counts against tenant.*.max. """
+
+        share.share_set(self.pool1, share.TENANT_ANY, maximum=1)
+        url = "/testpool/api/v1/pool/acquire/pool1"
+
+        def _acquire(holder, status=200):
+            """ Return the id of the resource holder of tenant ci gets. """
+            resp = self.client.get(url, {"holder": holder, "tenant": "ci"})
+            self.assertEqual(resp.status_code, status)
+            return json.loads(resp.content).get("id", None)
+
+        rsrc_id = _acquire("first")
+        self.release(rsrc_id, 6)
+        self.assertEqual(share.held_get(self.pool1), {})
+
+        ##
+        # The tenant is at its maximum again, first may not take its
+        # resource back until second releases.
+        other_id = _acquire("second")
+        _acquire("first", 403)
+        self.assertTrue(Lease.objects.get(resource_id=rsrc_id).released)
+        self.release(other_id, 6)
+        self.assertEqual(_acquire("first"), rsrc_id)
+        ##
+        self.assertEqual(share.held_get(self.pool1), {"ci": 1})
+
+    def test_expired(self):
+        """ test_expired. After the grace period it is rebuilt. """
+
+        rsrc_id = self.acquire("ci")
+        self.release(rsrc_id)
+        Lease.objects.filter(resource_id=rsrc_id).update(
+            expiry=datetime.datetime.now())
+        self.assertEqual(algo.lease_sweep(), 1)
+        rsrc = Resource.objects.get(id=rsrc_id)
+        self.assertEqual(rsrc.status, Resource.PENDING)
+        self.assertNotEqual(self.acquire("ci"), rsrc_id)
+
+    def test_disabled(self):
+        """ test_disabled. Without a grace period release rebuilds. """
+
+        algo.reuse_set(self.pool1, 0)
+        rsrc_id = self.acquire("ci")
+        self.release(rsrc_id)
+        self.assertEqual(Resource.objects.get(id=rsrc_id).status,
+                         Resource.PENDING)
+        self.assertFalse(Lease.objects.filter(resource_id=rsrc_id).exists())
+
+    def test_release_twice(self):
+        """ test_release_twice. Releasing a kept resource rebuilds it. """
 
-        levels = pool1.traceback_set.order_by("level")
-        self.assertTrue(len(levels), 1)
+        rsrc_id = self.acquire("ci")
+        self.release(rsrc_id)
+        ##
+        # The lease is already parked, trying to park it costs a query.
+        self.release(rsrc_id, 6)
+        ##
+        self.assertEqual(Resource.objects.get(id=rsrc_id).status,
+                         Resource.PENDING)
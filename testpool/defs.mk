@@ -1 +1 @@
-PYTHON_FILES:=libexec/fake core
+PYTHON_FILES:=libexec/fake libexec/process core
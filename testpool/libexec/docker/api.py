@@ -1,14 +1,182 @@
 """
 API for KVM hypervisors.
 """
+import time
+import threading
 import docker
+import requests
 import libvirt
 import testpool.core.api
+from testpool.core import algo
 from testpool.core import exceptions
 from testpool.core import logger
 
 LOGGER = logger.create()
 
+##
+# How often in seconds an image template is checked against the registry.
+# In between, clones reuse the image id resolved earlier.
+IMAGE_REFRESH = 5*60
+##
+
+##
+# Every container is labelled with its pool and resource name. Containers
+# are found by label which ignores containers started by other tools from
+# the same image.
+LABEL_POOL = "testpool.pool"
+LABEL_RESOURCE = "testpool.resource"
+##
+
+##
+# Maximum age in seconds of the container list before it is read again.
+SNAPSHOT_AGE = 1
+##
+
+
+class ImageCache(object):
+    """ Resolve image templates to local image ids.
+
+    Pulling an image before every clone costs a registry round trip even
+    when the image has not changed, and a long timeout when the registry is
+    not reachable. Templates are resolved once per refresh interval.
+    If the registry can not be reached the locally loaded image is used.
+    Pools whose registry KVP is offline never contact the registry, see
+    algo.registry_offline. At most one pull of a template runs at a time,
+    others resolving it meanwhile wait for that pull.
+    """
+
+    def __init__(self, refresh=IMAGE_REFRESH, offline=False):
+        """ Constructor.
+
+        @param refresh Seconds before a template is checked again.
+        @param offline Never contact the registry by default, use local
+                       images only.
+        """
+
+        self.refresh = refresh
+        self.offline = offline
+        self.images = {}
+        ##
+        # Event by template set once its pull in progress ends.
+        self.pulling = {}
+        ##
+        self.lock = threading.Lock()
+
+    def _claim(self, template_name, now):
+        """ Return (image_id, pulling) of template_name.
+
+        image_id is the id resolved within refresh or None. Otherwise
+        pulling is the Event of the pull in progress or None when the
+        caller now owns the pull and must call _pull.
+        """
+
+        with self.lock:
+            (image_id, resolved) = self.images.get(template_name,
+                                                   (None, None))
+            if image_id and now - resolved < self.refresh:
+                return (image_id, None)
+            pulling = self.pulling.get(template_name, None)
+            if pulling is None:
+                self.pulling[template_name] = threading.Event()
+            return (None, pulling)
+
+    def invalidate(self, template_name=None):
+        """ Forget resolved image ids, all of them if template_name None. """
+
+        with self.lock:
+            if template_name is None:
+                self.images.clear()
+            else:
+                self.images.pop(template_name, None)
+
+    def resolve(self, conn, template_name, offline=None):
+        """ Return the local image id for template_name.
+
+        @param offline Skip the registry, None uses the cache default.
+
+        :raise docker.errors.ImageNotFound: image is not available locally
+               and could not be pulled.
+        """
+
+        now = time.time()
+        (image_id, pulling) = self._claim(template_name, now)
+        if image_id:
+            return image_id
+        if pulling is None:
+            return self._pull(conn, template_name, offline, now)
+
+        ##
+        # Another thread is pulling, use what it resolved.
+        pulling.wait()
+        with self.lock:
+            (image_id, _) = self.images.get(template_name, (None, None))
+        return image_id if image_id else conn.images.get(template_name).id
+        ##
+
+    def _pull(self, conn, template_name, offline, now):
+        """ Pull template_name unless offline and store its image id.
+
+        Ends the pull claimed by _claim.
+        """
+
+        try:
+            return self._pull_image(conn, template_name, offline, now)
+        finally:
+            with self.lock:
+                self.pulling.pop(template_name).set()
+
+    def _pull_image(self, conn, template_name, offline, now):
+        """ Pull template_name unless offline and store its image id. """
+
+        if offline is None:
+            offline = self.offline
+        if not offline:
+            try:
+                LOGGER.debug("%s: pulling image", template_name)
+                conn.images.pull(template_name)
+            except (docker.errors.APIError,
+                    requests.exceptions.ConnectionError) as arg:
+                ##
+                # Registry is not reachable fall back to the local image.
+                # The time is still recorded so that the next clone
+                # does not wait on the registry again.
+                LOGGER.warning("%s: pull failed using local image %s",
+                               template_name, arg)
+                ##
+
+        image_id = conn.images.get(template_name).id
+        with self.lock:
+            self.images[template_name] = (image_id, now)
+        LOGGER.debug("%s: resolved to image %s", template_name, image_id)
+        return image_id
+
+    def prefetch(self, conn, template_name, offline=None):
+        """ Resolve template_name in the background.
+
+        Nothing is done while it is resolved or being pulled.
+        @return The thread resolving it or None.
+        """
+
+        now = time.time()
+        (image_id, pulling) = self._claim(template_name, now)
+        if image_id or pulling is not None:
+            return None
+
+        def _do_resolve():
+            """ Log failures since nobody waits on the thread. """
+            try:
+                self._pull(conn, template_name, offline, now)
+            except docker.errors.DockerException as arg:
+                LOGGER.warning("%s: prefetch failed %s", template_name, arg)
+
+        thread = threading.Thread(target=_do_resolve)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+IMAGE_CACHE = ImageCache()
+
 
 class HostInfo(testpool.core.api.HostInfo):
     """ Hold container information. """
@@ -31,15 +199,25 @@ class Pool(testpool.core.api.Pool):
     """ Interface to KVM Pool manager. """
 
     # pylint: disable=no-self-use
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, url_name, context, frozen=False, offline=False):
+        """ Constructor.
 
-    def __init__(self, url_name, context):
-        """ Constructor. """
+        @param frozen Pause READY containers until they are acquired.
+        @param offline Use local images only, never pull from the registry.
+        """
 
         testpool.core.api.Pool.__init__(self, context)
 
         self.context = context
         self.url_name = url_name
+        self.frozen = frozen
+        self.offline = offline
         self.conn = docker.from_env()
+        self.images = IMAGE_CACHE
+        self.snapshot = None
+        self.snapshot_time = 0
 
     def check(self):
         """ Check connection to docker container.
@@ -73,18 +251,45 @@ class Pool(testpool.core.api.Pool):
 
         return "docker"
 
+    def _containers_get(self):
+        """ Return the pool containers keyed by name.
+
+        A single label filtered list call returns name, state and IP
+        address of every container in the pool. The result is reused until
+        it is older than SNAPSHOT_AGE or a container is changed.
+        """
+
+        now = time.time()
+        if self.snapshot is not None and \
+           now - self.snapshot_time < SNAPSHOT_AGE:
+            return self.snapshot
+
+        filters = {"label": "%s=%s" % (LABEL_POOL, self.context)}
+        self.snapshot = {}
+        for info in self.conn.api.containers(all=True, filters=filters):
+            for name in info.get("Names", []):
+                self.snapshot[name.lstrip("/")] = info
+        self.snapshot_time = now
+        return self.snapshot
+
+    def _containers_changed(self):
+        """ Force the next call to re-read containers. """
+
+        self.snapshot = None
+
     def state_get(self, name):
         """ Return the state of the resource. """
 
         LOGGER.debug("%s: state_get", name)
 
-        try:
-            cntnr = self.conn.containers.get(name)
-            if cntnr.status == "running":
-                return testpool.core.api.Pool.STATE_RUNNING
-            return testpool.core.api.Pool.STATE_BAD_STATE
-        except docker.errors.NotFound:
+        info = self._containers_get().get(name, None)
+        if info is None:
             return testpool.core.api.Pool.STATE_NONE
+        elif info.get("State") == "running":
+            return testpool.core.api.Pool.STATE_RUNNING
+        elif info.get("State") == "paused":
+            return testpool.core.api.Pool.STATE_FROZEN
+        return testpool.core.api.Pool.STATE_BAD_STATE
 
     def destroy(self, name):
         """ Destroy container.
@@ -94,31 +299,76 @@ class Pool(testpool.core.api.Pool):
 
         LOGGER.debug("%s destroy", name)
         try:
-            cntnr = self.conn.containers.get(name)
-            cntnr.remove(v=True, force=True)
+            self.conn.api.remove_container(name, v=True, force=True)
             return testpool.core.api.Pool.STATE_DESTROYED
         except docker.errors.NotFound:
             LOGGER.debug("container %s does not exist", name)
             return testpool.core.api.Pool.STATE_NONE
+        finally:
+            self._containers_changed()
+
+    def prefetch(self, template_name):
+        """ Pull template_name in the background ahead of cloning. """
+
+        return self.images.prefetch(self.conn, template_name, self.offline)
 
     def clone(self, orig_name, new_name):
-        """ Clone KVM system. """
+        """ Clone container from the cached image of orig_name.
+
+        The container is labelled with its pool and name so that it can be
+        found without relying on the image or the name.
+        """
 
-        self.conn.images.pull(orig_name)
-        self.conn.containers.create(orig_name, detach=True, name=new_name)
+        image_id = self.images.resolve(self.conn, orig_name, self.offline)
+        labels = {LABEL_POOL: self.context, LABEL_RESOURCE: new_name}
+        try:
+            self.conn.containers.create(image_id, detach=True, name=new_name,
+                                        labels=labels)
+        except docker.errors.APIError as arg:
+            if arg.status_code != 409:
+                raise
+            ##
+            # Name is taken by a container created before containers were
+            # labelled. Replace it.
+            LOGGER.warning("%s: replacing unlabelled container", new_name)
+            self.conn.api.remove_container(new_name, v=True, force=True)
+            self.conn.containers.create(image_id, detach=True, name=new_name,
+                                        labels=labels)
+            ##
+        finally:
+            self._containers_changed()
         LOGGER.debug("%s: cloned", new_name)
 
     def start(self, name):
         """ Start container. """
 
         try:
-            cntnr = self.conn.containers.get(name)
-            cntnr.start()
+            self.conn.api.start(name)
             LOGGER.debug("%s started", name)
             return testpool.core.api.Pool.STATE_RUNNING
         except docker.errors.APIError:
             LOGGER.error("%s failed to start", name)
             return testpool.core.api.Pool.STATE_BAD_STATE
+        finally:
+            self._containers_changed()
+
+    def spare_freeze(self, name):
+        """ Pause the READY container so that it holds no CPU. """
+
+        if not self.frozen:
+            return
+
+        self.conn.api.pause(name)
+        self._containers_changed()
+        LOGGER.debug("%s paused", name)
+
+    def spare_thaw(self, name):
+        """ Unpause the container when it is acquired. """
+
+        if self.state_get(name) == testpool.core.api.Pool.STATE_FROZEN:
+            self.conn.api.unpause(name)
+            self._containers_changed()
+            LOGGER.debug("%s unpaused", name)
 
     # pylint: disable=unused-argument
     def ip_get(self, name, source=0):
@@ -128,20 +378,17 @@ class Pool(testpool.core.api.Pool):
         """
 
         LOGGER.debug("%s: ip_get called", name)
-        api = docker.APIClient()
-        info = api.inspect_container(name)
-
-        try:
-            return info["NetworkSettings"]["IPAddress"]
-        except KeyError:
-            return None
+        info = self._containers_get().get(name, {})
+        networks = info.get("NetworkSettings", {}).get("Networks", {})
+        for network in networks.values():
+            if network.get("IPAddress"):
+                return network["IPAddress"]
+        return None
 
     def list(self, pool1):
         """ Return the list of resources. """
 
-        filters = {"ancestor":  pool1.template_name}
-        cntnrs = self.conn.containers.list(filters=filters)
-        return [item.name for item in cntnrs]
+        return sorted(self._containers_get().keys())
 
     # pylint: disable=W0613
     # pylint: disable=R0201
@@ -155,10 +402,9 @@ class Pool(testpool.core.api.Pool):
         return {}
 
     def is_clone(self, pool1, name):
-        """ Return True if resource is a clone of pool1 template. """
+        """ Return True if resource is labelled as part of this pool. """
 
-        return (name.startswith(pool1.template_name) and
-                name != pool1.template_name)
+        return name in self._containers_get()
 
     def info_get(self):
         """ Return information about the hypervisor pool. """
@@ -172,7 +418,8 @@ class Pool(testpool.core.api.Pool):
 def pool_get(pool):
     """ Return a handle to the KVM API. """
     try:
-        return Pool(pool.host.connection, pool.name)
+        return Pool(pool.host.connection, pool.name, algo.spare_frozen(pool),
+                    algo.registry_offline(pool))
     except libvirt.libvirtError, arg:
         # LOGGER.exception(arg)
         raise exceptions.PoolError(str(arg), pool)
@@ -8,9 +8,12 @@ Install python binding to docker.
 
 import time
 import unittest
+import threading
+from argparse import Namespace
 import logging
 import docker
 from testpooldb import models
+import testpool.core.api
 from testpool.core import server
 from testpool.core import ext
 from testpool.core import algo
@@ -101,6 +104,178 @@ class Testsuite(unittest.TestCase):
         host1.destroy(name)
 
 
+# pylint: disable=R0903
+class FakeImages(object):
+    """ Stand in for docker images collection. """
+
+    def __init__(self, online=True):
+        self.online = online
+        self.pulls = 0
+        ##
+        # When set pulls wait for it.
+        self.gate = None
+        ##
+
+    def pull(self, name):
+        """ Count pulls, fail when offline. """
+        # pylint: disable=unused-argument
+
+        if self.gate is not None:
+            self.gate.wait()
+        if not self.online:
+            raise docker.errors.APIError("registry unreachable")
+        self.pulls += 1
+
+    # pylint: disable=no-self-use
+    def get(self, name):
+        """ Return image with an id based on the name. """
+
+        return Namespace(id="sha256:" + name)
+
+
+class FakeAPI(object):
+    """ Stand in for docker low level API client. """
+
+    def __init__(self):
+        self.items = []
+        self.calls = 0
+
+    def containers(self, all=False, filters=None):
+        """ Return containers matching the label filter. """
+        # pylint: disable=redefined-builtin,unused-argument
+
+        self.calls += 1
+        (key, value) = filters["label"].split("=")
+        return [item for item in self.items
+                if item["Labels"].get(key) == value]
+
+
+class FakeConn(object):
+    """ Stand in for docker client. """
+
+    def __init__(self, online=True):
+        self.images = FakeImages(online)
+        self.api = FakeAPI()
+
+
+class TestsuiteImageCache(unittest.TestCase):
+    """ Test image cache without a docker engine. """
+
+    def test_resolve_once(self):
+        """ test_resolve_once. Template pulled once per refresh. """
+
+        conn = FakeConn()
+        cache = api.ImageCache(refresh=60)
+        for _ in range(3):
+            self.assertEqual(cache.resolve(conn, TEMPLATE),
+                             "sha256:" + TEMPLATE)
+        self.assertEqual(conn.images.pulls, 1)
+
+        cache.refresh = 0
+        cache.resolve(conn, TEMPLATE)
+        self.assertEqual(conn.images.pulls, 2)
+
+    def test_offline(self):
+        """ test_offline. Local image used when registry unreachable. """
+
+        conn = FakeConn(online=False)
+        cache = api.ImageCache(refresh=60)
+        self.assertEqual(cache.resolve(conn, TEMPLATE), "sha256:" + TEMPLATE)
+
+        conn = FakeConn()
+        cache = api.ImageCache(refresh=60, offline=True)
+        cache.resolve(conn, TEMPLATE)
+        self.assertEqual(conn.images.pulls, 0)
+
+        cache = api.ImageCache(refresh=60)
+        cache.resolve(conn, TEMPLATE, offline=True)
+        self.assertEqual(conn.images.pulls, 0)
+        cache.prefetch(conn, TEMPLATE + ".2", offline=True).join()
+        self.assertEqual(conn.images.pulls, 0)
+
+    def test_prefetch(self):
+        """ test_prefetch. """
+
+        conn = FakeConn()
+        cache = api.ImageCache(refresh=60)
+        cache.prefetch(conn, TEMPLATE).join()
+        cache.resolve(conn, TEMPLATE)
+        self.assertEqual(conn.images.pulls, 1)
+        self.assertIsNone(cache.prefetch(conn, TEMPLATE))
+
+    def test_prefetch_once(self):
+        """ test_prefetch_once. One pull of a template runs at a time. """
+
+        conn = FakeConn()
+        conn.images.gate = threading.Event()
+        cache = api.ImageCache(refresh=60)
+        thread = cache.prefetch(conn, TEMPLATE)
+        self.assertIsNone(cache.prefetch(conn, TEMPLATE))
+
+        ##
+        # A clone meanwhile waits for the pull in progress.
+        resolved = []
+        clone = threading.Thread(target=lambda: resolved.append(
+            cache.resolve(conn, TEMPLATE)))
+        clone.start()
+        conn.images.gate.set()
+        thread.join()
+        clone.join()
+        ##
+
+        self.assertEqual(conn.images.pulls, 1)
+        self.assertEqual(resolved, ["sha256:" + TEMPLATE])
+        self.assertFalse(cache.pulling)
+
+        ##
+        # Once the refresh lapses the next prefetch pulls again.
+        cache.refresh = 0
+        cache.prefetch(conn, TEMPLATE).join()
+        self.assertEqual(conn.images.pulls, 2)
+        ##
+
+
+class TestsuiteLabels(unittest.TestCase):
+    """ Test label based container tracking without a docker engine. """
+
+    @staticmethod
+    def container(name, pool_name, state, ip_addr):
+        """ Return container information as listed by docker. """
+
+        return {
+            "Names": ["/" + name],
+            "State": state,
+            "Labels": {api.LABEL_POOL: pool_name, api.LABEL_RESOURCE: name},
+            "NetworkSettings": {"Networks": {"bridge": {"IPAddress":
+                                                        ip_addr}}}
+        }
+
+    def test_single_list(self):
+        """ test_single_list. State and IP served from one list call. """
+
+        pool = api.Pool.__new__(api.Pool)
+        testpool.core.api.Pool.__init__(pool, TEST_POOL)
+        pool.conn = FakeConn()
+        pool.snapshot = None
+        pool.snapshot_time = 0
+
+        pool.conn.api.items = [
+            self.container("nginx.0", TEST_POOL, "running", "172.17.0.2"),
+            self.container("nginx.1", TEST_POOL, "paused", "172.17.0.3"),
+            self.container("nginx.2", "other", "running", "172.17.0.4"),
+        ]
+
+        self.assertEqual(pool.list(None), ["nginx.0", "nginx.1"])
+        self.assertEqual(pool.state_get("nginx.0"), api.Pool.STATE_RUNNING)
+        self.assertEqual(pool.state_get("nginx.1"), api.Pool.STATE_FROZEN)
+        self.assertEqual(pool.state_get("nginx.2"), api.Pool.STATE_NONE)
+        self.assertEqual(pool.ip_get("nginx.0"), "172.17.0.2")
+        self.assertIsNone(pool.ip_get("nginx.2"))
+        self.assertTrue(pool.is_clone(None, "nginx.1"))
+        self.assertFalse(pool.is_clone(None, "nginx.2"))
+        self.assertEqual(pool.conn.api.calls, 1)
+
+
 # pylint: disable=R0903
 class FakeArgs(object):
     """ Used in testing to pass values to server.main. """
@@ -227,6 +402,28 @@ class TestsuiteServer(unittest.TestCase):
         pool = exts[PRODUCT].pool_get(pool1)
         self.assertEqual(len(pool.list(pool1)), 3)
 
+    def test_frozen(self):
+        """ test_frozen. READY containers are paused until acquired. """
+
+        (host1, _) = models.Host.objects.get_or_create(connection=CONNECTION,
+                                                       product=PRODUCT)
+        defaults = {"resource_max": 1, "template_name": TEMPLATE}
+        (pool1, _) = models.Pool.objects.update_or_create(
+            name=TEST_POOL, host=host1, defaults=defaults)
+        pool1.kvp_value_set(algo.SPARE_KEY, algo.SPARE_FROZEN)
+
+        args = FakeArgs()
+        server.args_process(args)
+        self.assertEqual(server.main(args), 0)
+
+        rsrc = pool1.resource_set.get(status=models.Resource.READY)
+        pool = api.pool_get(pool1)
+        self.assertTrue(pool.frozen)
+        self.assertEqual(pool.state_get(rsrc.name), api.Pool.STATE_FROZEN)
+
+        algo.spare_thaw(pool1, rsrc)
+        self.assertEqual(pool.state_get(rsrc.name), api.Pool.STATE_RUNNING)
+
     def test_expiration(self):
         """ test_expiration. """
 
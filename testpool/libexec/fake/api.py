@@ -2,66 +2,89 @@
 API for KVM hypervisors.
 """
 import os
+import time
+import random
 import logging
 import unittest
-from contextlib import contextmanager
-import yaml
 import testpool.core.api
+from testpool.core import exceptions
+from testpool.libexec.fake import store
 
 
-__STORE_PATH__ = "/tmp/testpool/fake"
+__STORE_PATH__ = store.STORE_PATH
+
+##
+# Pool KVPs that configure a fake pool. By default resources are kept in
+# the sqlite store, or the yaml store for pools which already have a YAML
+# file, and every operation succeeds immediately.
+KEY_STORE = "fake.store"
+KEY_LATENCY = "fake.latency"
+KEY_JITTER = "fake.jitter"
+KEY_FAILURE = "fake.failure"
+##
 
 
 def db_read(context):
     """ Read the current database of resources. """
 
-    store_path = os.path.join(__STORE_PATH__, context)
-    if os.path.exists(store_path):
-        rsrcs = set()
-        with open(store_path, "r") as stream:
-            try:
-                rsrcs = yaml.safe_load(stream)
-                if not rsrcs:
-                    rsrcs = set()
-            except yaml.YAMLError:
-                rsrcs = set()
-    else:
-        rsrcs = set()
-
-    return rsrcs
+    return store.yaml_read(os.path.join(__STORE_PATH__, context))
 
 
-@contextmanager
 def db_ctx(context):
     """ Return resource list. """
 
-    store_path = __STORE_PATH__
+    return store.yaml_ctx(os.path.join(__STORE_PATH__, context))
 
-    try:
-        os.makedirs(store_path)
-    except OSError:
-        pass
 
-    store_path = os.path.join(store_path, context)
+def store_default(context):
+    """ Return the store of context when the pool does not choose one.
 
-    ##
-    # Check to see if the context creates a sub directory.
-    (store_dir, _) = os.path.split(store_path)
+    Resources of pools created before stores existed stay in their YAML
+    file.
+    """
 
-    try:
-        os.makedirs(store_dir)
-    except OSError:
-        pass
-    ##
-    rsrcs = db_read(context)
+    if os.path.exists(os.path.join(__STORE_PATH__, context)):
+        return store.get(store.STORE_YAML, __STORE_PATH__)
+    return store.get(store.STORE_SQLITE, __STORE_PATH__)
+
+
+class FaultInjected(exceptions.TestpoolError):
+    """ Raised when the fault model decides an operation fails. """
+
+    def __init__(self, message):  # pylint: disable=W0235
+        """ Constructor. """
+        super(FaultInjected, self).__init__(message)
+
+
+# pylint: disable=R0903
+class FaultModel(object):
+    """ Make the fake driver behave like a slow or unreliable hypervisor.
+
+    Each clone, start and destroy waits latency seconds, plus or minus a
+    uniform jitter, then fails with probability failure.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure = failure
+        self.random = random.Random(seed)
+
+    def apply(self, operation, name):
+        """ Delay and possibly fail operation on name.
 
-    yield rsrcs
+        :raise FaultInjected: When the operation should fail.
+        """
+
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
 
-    ##
-    # Now store the rsrcs content into the file.
-    with open(store_path, "w") as stream:
-        stream.write(yaml.dump(rsrcs, default_flow_style=True))
-    ##
+        if self.failure and self.random.random() < self.failure:
+            raise FaultInjected("fake %s %s failure injected" %
+                                (operation, name))
 
 
 # pylint: disable=R0902
@@ -84,9 +107,15 @@ class HostInfo(testpool.core.api.HostInfo):
 class Pool(testpool.core.api.Pool):
     """ Interface to KVM Pool manager. """
 
-    def __init__(self, context):
-        """ Constructor. """
+    def __init__(self, context, rsrcs=None, faults=None):
+        """ Constructor.
+
+        @param rsrcs Store of resources, defaults to store_default.
+        @param faults FaultModel applied to clone, start and destroy.
+        """
         testpool.core.api.Pool.__init__(self, context)
+        self.rsrcs = rsrcs if rsrcs is not None else store_default(context)
+        self.faults = faults if faults is not None else FaultModel()
 
     def new_name_get(self, template_name, index):
         """ Given a pool, generate a new name. """
@@ -120,9 +149,8 @@ class Pool(testpool.core.api.Pool):
         name = str(name)
 
         logging.debug("fake destroy %s", name)
-        with db_ctx(self.context) as rsrcs:
-            if name in rsrcs:
-                rsrcs.remove(name)
+        self.faults.apply("destroy", name)
+        self.rsrcs.remove(self.context, name)
         return 0
 
     def clone(self, orig_name, new_name):
@@ -132,8 +160,8 @@ class Pool(testpool.core.api.Pool):
         new_name = str(new_name)
 
         logging.debug("fake clone %s %s", orig_name, new_name)
-        with db_ctx(self.context) as rsrcs:
-            rsrcs.add(new_name)
+        self.faults.apply("clone", new_name)
+        self.rsrcs.add(self.context, new_name)
 
         return 0
 
@@ -141,26 +169,33 @@ class Pool(testpool.core.api.Pool):
         """ Start resource. """
         logging.debug("fake start %s", name)
 
-        with db_ctx(self.context) as rsrcs:
-            if name in rsrcs:
-                return testpool.core.api.Pool.STATE_RUNNING
-            return testpool.core.api.Pool.STATE_BAD_STATE
+        self.faults.apply("start", name)
+        if self.rsrcs.contains(self.context, str(name)):
+            return testpool.core.api.Pool.STATE_RUNNING
+        return testpool.core.api.Pool.STATE_BAD_STATE
 
     def state_get(self, name):
         """ Return the state of a resource. """
         logging.debug("fake state_get %s", name)
 
-        with db_ctx(self.context) as rsrcs:
-            if name in rsrcs:
-                return testpool.core.api.Pool.STATE_RUNNING
-            return testpool.core.api.Pool.STATE_NONE
+        if self.rsrcs.contains(self.context, str(name)):
+            return testpool.core.api.Pool.STATE_RUNNING
+        return testpool.core.api.Pool.STATE_NONE
+
+    def states_get(self, names):
+        """ Return the state of each of names with one store read. """
+
+        existing = set(self.rsrcs.names(self.context))
+        return dict((name, testpool.core.api.Pool.STATE_RUNNING
+                     if str(name) in existing else
+                     testpool.core.api.Pool.STATE_NONE) for name in names)
 
     def list(self, pool1):
         """ Start resource. """
 
         logging.debug("fake list")
 
-        result = list(db_read(self.context))
+        result = self.rsrcs.names(self.context)
 
         result = [item for item in result if self.is_clone(pool1, item)]
 
@@ -199,11 +234,39 @@ class Pool(testpool.core.api.Pool):
         return ret_value
 
 
+def _number(pool1, kvps, key):
+    """ Return the number held by pool KVP key, 0 when absent or malformed.
+    """
+
+    value = kvps.get(key, 0)
+    try:
+        return float(value)
+    except ValueError:
+        logging.error("%s: %s %s must be a number", pool1.name, key, value)
+        return 0.0
+
+
 def pool_get(pool1):
-    """ Return a handle to the KVM API. """
+    """ Return a handle to the KVM API.
+
+    Store and fault model are configured through the pool KVPs fake.store,
+    fake.latency, fake.jitter and fake.failure.
+    """
 
     context = "%s/%s" % (pool1.host.connection, pool1.name)
-    return Pool(context)
+
+    kvps = pool1.kvp_values()
+    if not any(item.startswith("fake.") for item in kvps):
+        return Pool(context)
+
+    if KEY_STORE in kvps:
+        rsrcs = store.get(kvps[KEY_STORE], __STORE_PATH__)
+    else:
+        rsrcs = store_default(context)
+    faults = FaultModel(_number(pool1, kvps, KEY_LATENCY),
+                        _number(pool1, kvps, KEY_JITTER),
+                        _number(pool1, kvps, KEY_FAILURE))
+    return Pool(context, rsrcs, faults)
 
 
 class Testsuite(unittest.TestCase):
@@ -0,0 +1,264 @@
+# Copyright (c) 2015-2018 Mark Hamilton, All rights reserved
+"""
+Storage for fake resources.
+
+The fake driver only needs to remember which resources exist. Each store
+keeps a set of resource names per context, where context identifies the
+pool. Stores are:
+
+  memory - process local, used by unit tests.
+  sqlite - durable and shared between processes through SQLite locking.
+  yaml   - original one file per context, rewritten on change.
+"""
+import os
+import fcntl
+import sqlite3
+import threading
+from contextlib import contextmanager
+import yaml
+
+STORE_PATH = "/tmp/testpool/fake"
+
+STORE_MEMORY = "memory"
+STORE_SQLITE = "sqlite"
+STORE_YAML = "yaml"
+
+
+def _makedirs(path):
+    """ Create path if it does not exist. """
+
+    try:
+        os.makedirs(path)
+    except OSError:
+        pass
+
+
+class Store(object):
+    """ Set of resource names for each context. """
+
+    def add(self, context, name):
+        """ Add name to context. """
+        raise NotImplementedError("add not implemented")
+
+    def remove(self, context, name):
+        """ Remove name from context if it exists. """
+        raise NotImplementedError("remove not implemented")
+
+    def contains(self, context, name):
+        """ Return True if name exists in context. """
+        raise NotImplementedError("contains not implemented")
+
+    def names(self, context):
+        """ Return the list of names in context. """
+        raise NotImplementedError("names not implemented")
+
+    def clear(self, context):
+        """ Remove every name in context. """
+        raise NotImplementedError("clear not implemented")
+
+
+class MemoryStore(Store):
+    """ Resources held in this process only. """
+
+    def __init__(self):
+        Store.__init__(self)
+        self.rsrcs = {}
+        self.lock = threading.Lock()
+
+    def add(self, context, name):
+        """ Add name to context. """
+
+        with self.lock:
+            self.rsrcs.setdefault(context, set()).add(name)
+
+    def remove(self, context, name):
+        """ Remove name from context if it exists. """
+
+        with self.lock:
+            self.rsrcs.get(context, set()).discard(name)
+
+    def contains(self, context, name):
+        """ Return True if name exists in context. """
+
+        with self.lock:
+            return name in self.rsrcs.get(context, set())
+
+    def names(self, context):
+        """ Return the list of names in context. """
+
+        with self.lock:
+            return list(self.rsrcs.get(context, set()))
+
+    def clear(self, context):
+        """ Remove every name in context. """
+
+        with self.lock:
+            self.rsrcs.pop(context, None)
+
+
+class SqliteStore(Store):
+    """ Resources stored in a single SQLite database.
+
+    Each call is a single indexed statement so cost does not grow with the
+    number of resources. SQLite file locking serializes writers across
+    processes, readers wait at most timeout seconds.
+    """
+
+    def __init__(self, path, timeout=30):
+        Store.__init__(self)
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        _makedirs(os.path.dirname(path))
+
+        self._conn().execute("CREATE TABLE IF NOT EXISTS rsrc ("
+                             "context TEXT NOT NULL, name TEXT NOT NULL, "
+                             "PRIMARY KEY (context, name))")
+
+    def _conn(self):
+        """ Return this thread's connection. """
+
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def add(self, context, name):
+        """ Add name to context. """
+
+        self._conn().execute("INSERT OR IGNORE INTO rsrc VALUES (?, ?)",
+                             (context, name))
+
+    def remove(self, context, name):
+        """ Remove name from context if it exists. """
+
+        self._conn().execute("DELETE FROM rsrc WHERE context = ? AND "
+                             "name = ?", (context, name))
+
+    def contains(self, context, name):
+        """ Return True if name exists in context. """
+
+        cursor = self._conn().execute("SELECT 1 FROM rsrc WHERE "
+                                      "context = ? AND name = ?",
+                                      (context, name))
+        return cursor.fetchone() is not None
+
+    def names(self, context):
+        """ Return the list of names in context. """
+
+        cursor = self._conn().execute("SELECT name FROM rsrc WHERE "
+                                      "context = ?", (context,))
+        return [str(row[0]) for row in cursor]
+
+    def clear(self, context):
+        """ Remove every name in context. """
+
+        self._conn().execute("DELETE FROM rsrc WHERE context = ?",
+                             (context,))
+
+
+def yaml_read(store_path):
+    """ Read the set of resources stored in store_path. """
+
+    rsrcs = set()
+    if os.path.exists(store_path):
+        with open(store_path, "r") as stream:
+            try:
+                rsrcs = yaml.safe_load(stream)
+                if not rsrcs:
+                    rsrcs = set()
+            except yaml.YAMLError:
+                rsrcs = set()
+    return rsrcs
+
+
+@contextmanager
+def yaml_ctx(store_path):
+    """ Return resource set stored in store_path.
+
+    An exclusive lock is held on a companion lock file while the set is in
+    use. The file is only rewritten when the set changed.
+    """
+
+    _makedirs(os.path.dirname(store_path))
+
+    with open(store_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            rsrcs = yaml_read(store_path)
+            original = set(rsrcs)
+
+            yield rsrcs
+
+            if rsrcs != original or not os.path.exists(store_path):
+                with open(store_path, "w") as stream:
+                    stream.write(yaml.dump(rsrcs, default_flow_style=True))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class YamlStore(Store):
+    """ One YAML file per context. """
+
+    def __init__(self, path):
+        Store.__init__(self)
+        self.path = path
+
+    def _ctx(self, context):
+        """ Return locked resource set for context. """
+        return yaml_ctx(os.path.join(self.path, context))
+
+    def add(self, context, name):
+        """ Add name to context. """
+
+        with self._ctx(context) as rsrcs:
+            rsrcs.add(name)
+
+    def remove(self, context, name):
+        """ Remove name from context if it exists. """
+
+        with self._ctx(context) as rsrcs:
+            rsrcs.discard(name)
+
+    def contains(self, context, name):
+        """ Return True if name exists in context. """
+
+        with self._ctx(context) as rsrcs:
+            return name in rsrcs
+
+    def names(self, context):
+        """ Return the list of names in context. """
+
+        with self._ctx(context) as rsrcs:
+            return list(rsrcs)
+
+    def clear(self, context):
+        """ Remove every name in context. """
+
+        with self._ctx(context) as rsrcs:
+            rsrcs.clear()
+
+
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+
+def get(kind=STORE_SQLITE, path=STORE_PATH):
+    """ Return the store of the given kind, shared within this process. """
+
+    with STORES_LOCK:
+        if (kind, path) not in STORES:
+            if kind == STORE_MEMORY:
+                store = MemoryStore()
+            elif kind == STORE_SQLITE:
+                store = SqliteStore(os.path.join(path, "fake.sqlite3"))
+            elif kind == STORE_YAML:
+                store = YamlStore(path)
+            else:
+                raise ValueError("fake store %s unknown" % kind)
+            STORES[(kind, path)] = store
+        return STORES[(kind, path)]
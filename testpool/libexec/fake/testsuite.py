@@ -3,6 +3,7 @@ Test fake API.
 
 Useful for developing Testpool algorithms.
 """
+import os
 import unittest
 import logging
 from testpool.core import ext
@@ -10,6 +11,7 @@ from testpool.core import algo
 from testpool.core import database
 from testpool.core import server
 from testpool.libexec.fake import api
+from testpool.libexec.fake import store
 
 ##
 # database init is required to add to the system path so that models can
@@ -130,6 +132,114 @@ class Testsuite(unittest.TestCase):
             pass
 
 
+class TestsuiteStore(unittest.TestCase):
+    """ Test each fake store and the fault model. """
+
+    context = "testsuite/store"
+
+    def check_store(self, rsrcs):
+        """ Exercise store. """
+
+        rsrcs.clear(self.context)
+        for item in range(100):
+            rsrcs.add(self.context, "rsrc.%d" % item)
+        rsrcs.add(self.context, "rsrc.0")
+        self.assertEqual(len(rsrcs.names(self.context)), 100)
+        self.assertTrue(rsrcs.contains(self.context, "rsrc.99"))
+
+        rsrcs.remove(self.context, "rsrc.99")
+        rsrcs.remove(self.context, "rsrc.99")
+        self.assertFalse(rsrcs.contains(self.context, "rsrc.99"))
+        self.assertEqual(rsrcs.names("testsuite/other"), [])
+
+        rsrcs.clear(self.context)
+        self.assertEqual(rsrcs.names(self.context), [])
+
+    def test_memory(self):
+        """ test_memory. """
+        self.check_store(store.get(store.STORE_MEMORY))
+
+    def test_sqlite(self):
+        """ test_sqlite. """
+        self.check_store(store.get(store.STORE_SQLITE))
+
+    def test_yaml(self):
+        """ test_yaml. """
+        self.check_store(store.get(store.STORE_YAML))
+
+    def test_unknown(self):
+        """ test_unknown. """
+
+        with self.assertRaises(ValueError):
+            store.get("bogus")
+
+    def test_faults(self):
+        """ test_faults. Every operation fails. """
+
+        pool = api.Pool(self.context, store.get(store.STORE_MEMORY),
+                        api.FaultModel(failure=1.0))
+        with self.assertRaises(api.FaultInjected):
+            pool.clone("test.template", "test.template.0")
+        self.assertEqual(pool.state_get("test.template.0"),
+                         api.Pool.STATE_NONE)
+
+    def test_pool_kvp(self):
+        """ test_pool_kvp. Pool KVPs select the store. """
+
+        (host1, _) = models.Host.objects.get_or_create(connection="localhost",
+                                                       product="fake")
+        (pool1, _) = models.Pool.objects.get_or_create(
+            name="fake.pool", host=host1, template_name="test.template",
+            resource_max=10)
+        pool1.kvp_value_set(api.KEY_STORE, store.STORE_MEMORY)
+        pool1.kvp_value_set(api.KEY_LATENCY, "0.001")
+
+        pool = api.pool_get(pool1)
+        self.assertTrue(isinstance(pool.rsrcs, store.MemoryStore))
+        self.assertEqual(pool.faults.latency, 0.001)
+
+        algo.destroy(pool, pool1)
+        self.assertEqual(algo.adapt(pool, pool1), 10)
+
+    def test_pool_kvp_malformed(self):
+        """ test_pool_kvp_malformed. Malformed fault KVPs are ignored. """
+
+        (host1, _) = models.Host.objects.get_or_create(connection="localhost",
+                                                       product="fake")
+        (pool1, _) = models.Pool.objects.get_or_create(
+            name="fake.pool", host=host1, template_name="test.template",
+            resource_max=10)
+        pool1.kvp_value_set(api.KEY_STORE, store.STORE_MEMORY)
+        pool1.kvp_value_set(api.KEY_LATENCY, "slow")
+        pool1.kvp_value_set(api.KEY_FAILURE, "0.5")
+
+        pool = api.pool_get(pool1)
+        self.assertEqual(pool.faults.latency, 0)
+        self.assertEqual(pool.faults.failure, 0.5)
+
+    def test_store_default(self):
+        """ test_store_default. Pools with a YAML file keep using it. """
+
+        context = "testsuite/test_store_default"
+        store.get(store.STORE_YAML).clear(context)
+        self.assertTrue(isinstance(api.store_default(context),
+                                   store.YamlStore))
+        os.remove(os.path.join(api.__STORE_PATH__, context))
+        self.assertTrue(isinstance(api.store_default(context),
+                                   store.SqliteStore))
+
+    def tearDown(self):
+        """ Remove fake pool. """
+
+        try:
+            pool1 = models.Pool.objects.get(name="fake.pool")
+            for rsrc in models.Resource.objects.filter(pool=pool1):
+                rsrc.delete()
+            pool1.delete()
+        except models.Pool.DoesNotExist:
+            pass
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     unittest.main()
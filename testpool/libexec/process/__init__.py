@@ -0,0 +1,4 @@
+"""
+Local process API and testsuite content.
+"""
+from . import api
@@ -0,0 +1,340 @@
+"""
+API for local process pools.
+
+Each resource is a process tree started in its own PID, mount, UTS and IPC
+namespace with unshare. The template is a directory which every resource
+sees through its own overlay, changes land in the resource upper
+directory and the template is never modified. Resources are reached
+through a loopback alias, the whole of 127.0.0.0/8 is routed to the
+loopback interface on Linux so no network setup is required.
+
+When unshare is not available resources are plain process trees in their
+own session running from a copy of the template.
+"""
+import os
+import zlib
+import shlex
+import shutil
+import signal
+import logging
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+import testpool.core.api
+from testpool.core import exceptions
+
+STORE_PATH = "/tmp/testpool/process"
+
+ISOLATION_NAMESPACE = "namespace"
+ISOLATION_NONE = "none"
+
+COMMAND = "sleep 2147483647"
+
+##
+# Pool KVPs that configure a process pool.
+KEY_COMMAND = "process.command"
+KEY_ISOLATION = "process.isolation"
+##
+
+##
+# Run inside the new namespaces. Mount the overlay, falling back to a copy
+# when overlay is not permitted, then replace the shell with the command.
+NAMESPACE_SCRIPT = (
+    'mount -t overlay overlay -o "lowerdir=$TESTPOOL_LOWER,'
+    'upperdir=$TESTPOOL_UPPER,workdir=$TESTPOOL_WORK" "$TESTPOOL_ROOT" '
+    '2>/dev/null || cp -a "$TESTPOOL_LOWER/." "$TESTPOOL_ROOT/"; '
+    'hostname "$TESTPOOL_NAME"; '
+    'cd "$TESTPOOL_ROOT" && exec "$@"')
+##
+
+
+def isolation_default():
+    """ Return namespace isolation when unshare is installed. """
+
+    if find_executable("unshare"):
+        return ISOLATION_NAMESPACE
+    return ISOLATION_NONE
+
+
+def _rmtree(path):
+    """ Remove path even when overlayfs left unreadable directories. """
+
+    def _do_chmod(func, name, _):
+        """ Make parent and name writable then retry. """
+        os.chmod(os.path.dirname(name), 0o700)
+        if os.path.isdir(name):
+            os.chmod(name, 0o700)
+        func(name)
+
+    shutil.rmtree(path, onerror=_do_chmod)
+
+
+def _proc_start_time(pid):
+    """ Return start time of pid or None if pid is not alive.
+
+    The start time distinguishes pid from a later process that reused it.
+    """
+
+    try:
+        with open("/proc/%d/stat" % pid) as stream:
+            stat = stream.read()
+    except IOError:
+        return None
+
+    ##
+    # Fields after the command name which may contain spaces.
+    fields = stat[stat.rindex(")") + 2:].split()
+    if fields[0] == "Z":
+        return None
+    return fields[19]
+    ##
+
+
+# pylint: disable=R0902
+# pylint: disable=R0903
+class HostInfo(testpool.core.api.HostInfo):
+    """ Host info. """
+
+    def __init__(self):
+        testpool.core.api.HostInfo.__init__(self)
+        self.model = os.uname()[4]
+        self.cpus = multiprocessing.cpu_count()
+
+
+class Pool(testpool.core.api.Pool):
+    """ Interface to local process pools. """
+
+    def __init__(self, context, command=COMMAND, isolation=None,
+                 store_path=STORE_PATH):
+        """ Constructor.
+
+        @param command Command line each resource runs.
+        @param isolation ISOLATION_NAMESPACE or ISOLATION_NONE, defaults to
+                         namespace when unshare is installed.
+        """
+        testpool.core.api.Pool.__init__(self, context)
+        self.command = shlex.split(command)
+        self.isolation = isolation if isolation else isolation_default()
+        self.store_path = os.path.join(store_path, context)
+
+    def _path(self, name, *args):
+        """ Return path within the resource directory. """
+        return os.path.join(self.store_path, name, *args)
+
+    def _lower(self, template_name):
+        """ Return the template directory.
+
+        Templates that are not a directory share an empty one.
+        """
+
+        if os.path.isdir(template_name):
+            return os.path.abspath(template_name)
+
+        lower = os.path.join(self.store_path, ".empty")
+        if not os.path.isdir(lower):
+            os.makedirs(lower)
+        return lower
+
+    def _pid_get(self, name):
+        """ Return pid of the resource if it is running or None. """
+
+        try:
+            with open(self._path(name, "pid")) as stream:
+                (pid, start_time) = stream.read().split()
+                pid = int(pid)
+        except (IOError, ValueError):
+            return None
+
+        ##
+        # Reap the process if this process started it.
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            pass
+        ##
+
+        if _proc_start_time(pid) != start_time:
+            return None
+        return pid
+
+    def new_name_get(self, template_name, index):
+        """ Given a pool, generate a new name. """
+
+        base_name = os.path.basename(template_name.rstrip("/"))
+        return base_name + ".%d" % index
+
+    def timing_get(self, request):
+        """ Return algorithm timing based on the request.
+
+        :return time (sec) Return the amount of time to wait in seconds. """
+
+        if request == testpool.core.api.Pool.TIMING_REQUEST_DESTROY:
+            return 0.1
+        elif request == testpool.core.api.Pool.TIMING_REQUEST_ATTR:
+            return 0.1
+        elif request == testpool.core.api.Pool.TIMING_REQUEST_CLONE:
+            return 0.1
+        elif request == testpool.core.api.Pool.TIMING_REQUEST_NONE:
+            return 0.1
+        else:
+            raise ValueError("unknown timing request %s" % request)
+
+    def type_get(self):
+        """ Return the type of the interface. """
+        return "process"
+
+    def clone(self, orig_name, new_name):
+        """ Create the resource directory for new_name.
+
+        With namespace isolation the overlay is mounted when the resource
+        starts, otherwise the template is copied now.
+        """
+
+        logging.debug("process clone %s %s", orig_name, new_name)
+
+        if os.path.isdir(self._path(new_name)):
+            self.destroy(new_name)
+
+        lower = self._lower(orig_name)
+        for item in ["upper", "work", "root"]:
+            os.makedirs(self._path(new_name, item))
+        with open(self._path(new_name, "lower"), "w") as stream:
+            stream.write(lower)
+
+        if self.isolation == ISOLATION_NONE:
+            os.rmdir(self._path(new_name, "root"))
+            shutil.copytree(lower, self._path(new_name, "root"),
+                            symlinks=True)
+        return 0
+
+    def start(self, name):
+        """ Start the resource process tree. """
+
+        logging.debug("process start %s", name)
+
+        if not os.path.isdir(self._path(name)):
+            return testpool.core.api.Pool.STATE_BAD_STATE
+        if self._pid_get(name):
+            return testpool.core.api.Pool.STATE_RUNNING
+
+        with open(self._path(name, "lower")) as stream:
+            lower = stream.read()
+
+        env = dict(os.environ)
+        env.update({
+            "TESTPOOL_NAME": name,
+            "TESTPOOL_IP": self.ip_get(name),
+            "TESTPOOL_LOWER": lower,
+            "TESTPOOL_UPPER": self._path(name, "upper"),
+            "TESTPOOL_WORK": self._path(name, "work"),
+            "TESTPOOL_ROOT": self._path(name, "root"),
+        })
+
+        if self.isolation == ISOLATION_NAMESPACE:
+            args = ["unshare", "--fork", "--pid", "--mount-proc", "--mount",
+                    "--uts", "--ipc", "--kill-child"]
+            if os.geteuid() != 0:
+                args += ["--user", "--map-root-user"]
+            args += ["sh", "-c", NAMESPACE_SCRIPT, "sh"] + self.command
+        else:
+            args = self.command
+
+        with open(self._path(name, "log"), "a") as log:
+            proc = subprocess.Popen(args, cwd=self._path(name, "root"),
+                                    env=env, stdout=log,
+                                    stderr=subprocess.STDOUT,
+                                    close_fds=True, preexec_fn=os.setsid)
+
+        start_time = _proc_start_time(proc.pid)
+        if start_time is None:
+            logging.error("process %s failed to start", name)
+            return testpool.core.api.Pool.STATE_BAD_STATE
+
+        with open(self._path(name, "pid"), "w") as stream:
+            stream.write("%d %s" % (proc.pid, start_time))
+        return testpool.core.api.Pool.STATE_RUNNING
+
+    def state_get(self, name):
+        """ Return the state of a resource. """
+
+        if not os.path.isdir(self._path(name)):
+            return testpool.core.api.Pool.STATE_NONE
+        if self._pid_get(name):
+            return testpool.core.api.Pool.STATE_RUNNING
+        return testpool.core.api.Pool.STATE_BAD_STATE
+
+    def destroy(self, name):
+        """ Kill the process tree and remove the resource directory. """
+
+        logging.debug("process destroy %s", name)
+
+        if not os.path.isdir(self._path(name)):
+            return testpool.core.api.Pool.STATE_NONE
+
+        pid = self._pid_get(name)
+        if pid:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        _rmtree(self._path(name))
+        return testpool.core.api.Pool.STATE_DESTROYED
+
+    def list(self, pool1):
+        """ Return the list of resources. """
+
+        if not os.path.isdir(self.store_path):
+            return []
+        return [item for item in os.listdir(self.store_path)
+                if self.is_clone(pool1, item)]
+
+    def ip_get(self, name):
+        """ Return the loopback alias of the resource.
+
+        The address is derived from the pool context and name so that it is
+        stable across restarts. 127.0.0.0/24 is avoided.
+        """
+
+        value = zlib.crc32("%s/%s" % (self.context, name)) & 0xffffff
+        value = max(value, 0x100)
+        return "127.%d.%d.%d" % (value >> 16, (value >> 8) & 0xff,
+                                 value & 0xff)
+
+    def resource_attr_get(self, name):
+        """ Return the list of attributes for the resource.
+
+        These attributes are stored in the database, eventually they are
+        passed through the REST interface to the client.
+        """
+
+        return {"ip": self.ip_get(name), "root": self._path(name, "root")}
+
+    def is_clone(self, pool1, name):
+        """ Return True if resource is a clone of pool1 template. """
+
+        base_name = self.new_name_get(pool1.template_name, 0)[:-1]
+        return name.startswith(base_name)
+
+    def info_get(self):
+        """ Return information about the hypervisor pool. """
+        # pylint: disable=R0201
+
+        return HostInfo()
+
+
+def pool_get(pool1):
+    """ Return a handle to the process API.
+
+    The command and isolation are configured through the pool KVPs
+    process.command and process.isolation.
+    """
+
+    context = "%s/%s" % (pool1.host.connection, pool1.name)
+
+    kvps = pool1.kvp_values()
+    isolation = kvps.get(KEY_ISOLATION, None)
+    if isolation not in [None, ISOLATION_NAMESPACE, ISOLATION_NONE]:
+        raise exceptions.PoolError("isolation %s unknown" % isolation, pool1)
+    return Pool(context, kvps.get(KEY_COMMAND, COMMAND), isolation)
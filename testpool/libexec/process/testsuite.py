@@ -0,0 +1,136 @@
+"""
+Test process API.
+"""
+import os
+import time
+import shutil
+import unittest
+from testpool.core import algo
+from testpool.core import database
+from testpool.core import server
+from testpool.libexec.process import api
+
+##
+# database init is required to add to the system path so that models can
+# be found
+# pylint: disable=C0413
+database.init()  # nopep8
+from testpooldb import models
+##
+
+CONNECTION = "localhost"
+PRODUCT = "process"
+TEST_POOL = "process.pool"
+STORE_PATH = "/tmp/testpool/testsuite/process"
+
+
+class Testsuite(unittest.TestCase):
+    """ Test process resources directly. """
+
+    def setUp(self):
+        """ Create template directory. """
+
+        self.template = os.path.join(STORE_PATH, "template")
+        if not os.path.isdir(self.template):
+            os.makedirs(self.template)
+        with open(os.path.join(self.template, "hello"), "w") as stream:
+            stream.write("hello")
+
+    def tearDown(self):
+        """ Remove any resources. """
+
+        for isolation in [api.ISOLATION_NONE, api.isolation_default()]:
+            pool = api.Pool("testsuite", isolation=isolation,
+                            store_path=STORE_PATH)
+            for count in range(3):
+                pool.destroy(pool.new_name_get(self.template, count))
+        shutil.rmtree(STORE_PATH, ignore_errors=True)
+
+    def check_lifecycle(self, isolation):
+        """ Clone, start and destroy several resources. """
+
+        pool = api.Pool("testsuite", isolation=isolation,
+                        store_path=STORE_PATH)
+        names = [pool.new_name_get(self.template, count)
+                 for count in range(3)]
+
+        for name in names:
+            self.assertEqual(pool.state_get(name), api.Pool.STATE_NONE)
+            pool.clone(self.template, name)
+            self.assertEqual(pool.state_get(name), api.Pool.STATE_BAD_STATE)
+            self.assertEqual(pool.start(name), api.Pool.STATE_RUNNING)
+            self.assertEqual(pool.state_get(name), api.Pool.STATE_RUNNING)
+
+        ips = set(pool.ip_get(name) for name in names)
+        self.assertEqual(len(ips), 3)
+        for ip_addr in ips:
+            self.assertTrue(ip_addr.startswith("127."))
+
+        for name in names:
+            self.assertEqual(pool.destroy(name), api.Pool.STATE_DESTROYED)
+            self.assertEqual(pool.state_get(name), api.Pool.STATE_NONE)
+            self.assertEqual(pool.destroy(name), api.Pool.STATE_NONE)
+
+        ##
+        # The template is never changed.
+        self.assertEqual(os.listdir(self.template), ["hello"])
+        ##
+
+    def test_none(self):
+        """ test_none. Plain process trees. """
+
+        self.check_lifecycle(api.ISOLATION_NONE)
+
+    def test_namespace(self):
+        """ test_namespace. Process trees in their own namespaces. """
+
+        if api.isolation_default() != api.ISOLATION_NAMESPACE:
+            self.skipTest("unshare not installed")
+        self.check_lifecycle(api.ISOLATION_NAMESPACE)
+
+    def test_exit(self):
+        """ test_exit. Resource whose command exits is in a bad state. """
+
+        pool = api.Pool("testsuite", "true", api.ISOLATION_NONE, STORE_PATH)
+        name = pool.new_name_get(self.template, 0)
+        pool.clone(self.template, name)
+        pool.start(name)
+        time.sleep(0.5)
+        self.assertEqual(pool.state_get(name), api.Pool.STATE_BAD_STATE)
+
+
+class TestsuiteServer(unittest.TestCase):
+    """ Run the server against a process pool. """
+
+    def tearDown(self):
+        """ Remove pool and its resources. """
+
+        try:
+            pool1 = models.Pool.objects.get(name=TEST_POOL)
+            algo.destroy(api.pool_get(pool1), pool1)
+            pool1.delete()
+        except models.Pool.DoesNotExist:
+            pass
+
+    def test_setup(self):
+        """ test_setup. """
+
+        (host1, _) = models.Host.objects.get_or_create(connection=CONNECTION,
+                                                       product=PRODUCT)
+        defaults = {"resource_max": 3, "template_name": "process.template"}
+        (pool1, _) = models.Pool.objects.update_or_create(
+            name=TEST_POOL, host=host1, defaults=defaults)
+
+        args = server.FakeArgs()
+        self.assertEqual(server.main(args), 0)
+
+        rsrcs = pool1.resource_set.filter(status=models.Resource.READY)
+        self.assertEqual(rsrcs.count(), 3)
+        pool = api.pool_get(pool1)
+        for rsrc in rsrcs:
+            self.assertEqual(pool.state_get(rsrc.name),
+                             api.Pool.STATE_RUNNING)
+
+
+if __name__ == "__main__":
+    unittest.main()